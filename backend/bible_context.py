@@ -0,0 +1,111 @@
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional
+import json
+import threading
+
+import crud
+
+# Per-story cache of pre-rendered bible context. Entries are keyed by element
+# id and version, validated against the story revision (one PK lookup), and
+# resynced incrementally: only elements whose version changed are reloaded.
+# A StoryContext is never changed once cached; updates replace it.
+
+@dataclass
+class CompiledElement:
+    id: int
+    type: str
+    name: str
+    version: int
+    content: str
+    block: str  # "### Type: Name\ncontent"
+    catalog_line: str  # "- Name (type)"
+    description: Optional[str] = None  # parsed content["description"], if any
+
+    @property
+    def key(self) -> str:
+        return self.name.lower()
+
+@dataclass
+class StoryContext:
+    story_id: int
+    revision: Optional[int]
+    elements: Dict[int, CompiledElement] = field(default_factory=dict)
+
+    def ordered(self) -> List[CompiledElement]:
+        return [self.elements[i] for i in sorted(self.elements)]
+
+    def settings(self) -> Optional[CompiledElement]:
+        return next((el for el in self.ordered() if el.type == "story_settings"), None)
+
+    def select(self, names: Iterable[str]) -> List[CompiledElement]:
+        wanted = {n.lower() for n in names}
+        return [el for el in self.ordered() if el.key in wanted]
+
+    def blocks(self, elements: Optional[List[CompiledElement]] = None) -> str:
+        return "\n".join(el.block for el in (self.ordered() if elements is None else elements))
+
+    def catalog(self, elements: Optional[List[CompiledElement]] = None) -> str:
+        return "\n".join(el.catalog_line for el in (self.ordered() if elements is None else elements))
+
+def compile_element(element) -> CompiledElement:
+    description = None
+    try:
+        parsed = json.loads(element.content) if isinstance(element.content, str) else element.content
+        if isinstance(parsed, dict) and "description" in parsed:
+            description = str(parsed["description"])
+    except (TypeError, ValueError):
+        pass
+    return CompiledElement(
+        id=element.id,
+        type=element.type,
+        name=element.name,
+        version=element.version,
+        content=element.content,
+        block=f"### {element.type.capitalize()}: {element.name}\n{element.content}",
+        catalog_line=f"- {element.name} ({element.type})",
+        description=description,
+    )
+
+cache: Dict[int, StoryContext] = {}
+lock = threading.Lock()
+
+def get_story_context(story_id: int) -> StoryContext:
+    # Blocking; async callers go through database.run_db
+    revision = crud.get_story_revision(story_id)
+    with lock:
+        entry = cache.get(story_id)
+        if entry is not None and revision is not None and entry.revision == revision:
+            return entry
+        known = dict(entry.elements) if entry is not None else {}
+
+    versions = crud.get_bible_element_versions(story_id)
+    elements = {i: el for i, el in known.items() if versions.get(i) == el.version}
+    stale = [i for i in versions if i not in elements]
+    if stale:
+        for element in crud.get_bible_elements_by_id(stale):
+            elements[element.id] = compile_element(element)
+
+    entry = StoryContext(story_id=story_id, revision=revision, elements=elements)
+    with lock:
+        cache[story_id] = entry
+    return entry
+
+def element_saved(element):
+    # Write-through from crud: keep the cached block current without a reload.
+    # Readers hold on to the StoryContext they got, so swap in a new one rather than edit it.
+    if element is None:
+        return
+    compiled = None if element.is_deleted else compile_element(element)
+    with lock:
+        entry = cache.get(element.story_id)
+        if entry is None:
+            return
+        elements = {i: el for i, el in entry.elements.items() if i != element.id}
+        if compiled is not None:
+            elements[element.id] = compiled
+        # revision moved; next read revalidates versions only
+        cache[element.story_id] = StoryContext(story_id=entry.story_id, revision=None, elements=elements)
+
+def story_deleted(story_id: int):
+    with lock:
+        cache.pop(story_id, None)
@@ -0,0 +1,52 @@
+import asyncio
+from typing import AsyncIterator, List, Optional
+
+# One producer, many consumers. Every chunk is kept so a subscriber that
+# attaches late first replays what it missed, then follows live output.
+
+class Broadcast:
+    def __init__(self):
+        self.chunks: List[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.abandoned = False  # every subscriber left before the producer finished
+        self.task: Optional[asyncio.Task] = None  # producer, cancelled when the last subscriber leaves
+        self.changed = asyncio.Condition()
+
+    async def publish(self, chunk: str):
+        self.chunks.append(chunk)
+        async with self.changed:
+            self.changed.notify_all()
+
+    async def finish(self, error: Optional[BaseException] = None):
+        self.done = True
+        self.error = error
+        async with self.changed:
+            self.changed.notify_all()
+
+    async def subscribe(self, start: int = 0) -> AsyncIterator[str]:
+        self.subscribers += 1
+        i = start
+        try:
+            while True:
+                while i < len(self.chunks):
+                    yield self.chunks[i]
+                    i += 1
+                if self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                async with self.changed:
+                    await self.changed.wait_for(lambda: i < len(self.chunks) or self.done)
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.done and self.task is not None:
+                self.abandoned = True
+                self.cancel_task()
+
+    def cancel_task(self):
+        # httpx can swallow a cancel that lands while it is still connecting, so keep asking until the producer stops
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+            asyncio.get_running_loop().call_later(0.5, self.cancel_task)
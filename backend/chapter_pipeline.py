@@ -0,0 +1,344 @@
+import asyncio
+import uuid
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+import bible_context
+import context_packer
+import crud
+import database
+import jobs
+import json_stream
+import llm
+import prompt_layout
+import retrieval
+import router
+import settings_service
+import sse
+import structured
+import summaries
+from defaults import DEFAULT_CHAPTER_PIPELINE
+
+# New-chapter workflow: smart context -> outline -> prose. The stages back the
+# /ai/smart-context, /ai/generate-outline and /ai/write-chapter-v2 endpoints,
+# and run() chains them in one request on a single story snapshot, so the
+# bible is compiled and settings are read once and smart_context never makes
+# a round trip through the client.
+
+def config() -> dict:
+    return {**DEFAULT_CHAPTER_PIPELINE, **(settings_service.get("chapter_pipeline") or {})}
+
+class Snapshot:
+    def __init__(self, context: "bible_context.StoryContext", chapters: list, url: str, system: str, model: Optional[str] = None):
+        self.context = context
+        self.chapters = chapters
+        self.url = url
+        self.system = system  # shared system prompt for the writing stages
+        self.model = model  # model the router would send to, for context budgets
+
+async def snapshot(story_id: int) -> Snapshot:
+    context = await database.run_db(bible_context.get_story_context, story_id)
+    chapters = await database.run_db(crud.get_chapter_summaries, story_id)
+    url = await settings_service.get_llm_url_async()
+    return Snapshot(context, chapters, url, await settings_service.get_system_prompt_async(), router.model(url))
+
+async def smart_context_events(story_id: int, snap: Snapshot, brief: str, retrieval_mode: Optional[str] = None,
+                               no_cache: bool = False, structured_output: Optional[bool] = None) -> AsyncIterator[dict]:
+    # Fields as the model closes them ({"path": [...], "value": ...}), then {"result": smart context}
+    context, chapters, url = snap.context, snap.chapters, snap.url
+
+    # 1. Get Story So Far Summary from cached chapter summaries (only edited chapters are re-summarized)
+    story_so_far = None
+    if chapters:
+        chapter_list = "\n".join([f"{c.order}. {c.title}" for c in chapters])
+        try:
+            story_so_far = await summaries.story_so_far(story_id, url)
+        except Exception as e:
+            print(f"DEBUG: Story summary unavailable, asking the model instead: {e}")
+    else:
+        chapter_list = "NONE (This is the first chapter)"
+        story_so_far = "Start of Story"
+
+    # 2. Pick relevant elements locally, or narrow the catalog the LLM picks from
+    retrieval_config = retrieval.config(retrieval_mode)
+    if retrieval_config["mode"] == "lexical":
+        found = await database.run_db(retrieval.search, story_id, brief, retrieval_config["top_k"])
+        yield {"result": {
+            "story_so_far": story_so_far or f"Previous chapters:\n{chapter_list}",
+            "relevant_elements": [el["name"] for el in found["elements"]],
+            "suggested_new_elements": [],
+            "related_chapters": found["chapters"],
+        }}
+        return
+    if retrieval_config["mode"] == "hybrid":
+        bible_catalog = context.catalog(await database.run_db(retrieval.candidates, story_id, brief, retrieval_config["candidates"]))
+    else:
+        bible_catalog = context.catalog()
+    
+    # 3. Construct Prompt
+    if story_so_far is not None:
+        # Summary is already known: the model only picks and suggests elements
+        system_prompt = """You are a story bible manager and continuity assistant. 
+    Your job is to analyze a new chapter brief and the existing story context to:
+    1. Select relevant existing story bible elements that should be in the context.
+    2. Suggest NEW story bible elements that should be created based on the brief.
+    
+    Return pure JSON with this structure:
+    {
+        "relevant_elements": ["Exact Name 1", "Exact Name 2"],
+        "suggested_new_elements": [
+            {"name": "New Character/Place", "type": "character|location|etc", "reason": "Why it is needed"}
+        ]
+    }"""
+        sections = [context_packer.Section("story_so_far", story_so_far, context_packer.RECENT_TEXT, truncate=context_packer.KEEP_TAIL)]
+        story_heading = "STORY SO FAR"
+    else:
+        system_prompt = """You are a story bible manager and continuity assistant. 
+    Your job is to analyze a new chapter brief and the existing story context to:
+    1. Write a "Story So Far" summary ensuring the new chapter fits the continuity.
+       - IF there are no previous chapters, "story_so_far" MUST be exactly "Start of Story".
+    2. Select relevant existing story bible elements that should be in the context.
+    3. Suggest NEW story bible elements that should be created based on the brief.
+    
+    Return pure JSON with this structure:
+    {
+        "story_so_far": "High level summary of previous events...",
+        "relevant_elements": ["Exact Name 1", "Exact Name 2"],
+        "suggested_new_elements": [
+            {"name": "New Character/Place", "type": "character|location|etc", "reason": "Why it is needed"}
+        ]
+    }"""
+        last_chapter = await database.run_db(crud.get_chapter, chapters[-1].id)
+        sections = [context_packer.Section("story_so_far", last_chapter.content if last_chapter else "N/A", context_packer.BACKGROUND, truncate=context_packer.KEEP_TAIL)]
+        story_heading = "LAST CHAPTER CONTENT"
+    
+    # Keep the catalog whole where possible; the end of the story matters most for continuity
+    packed = context_packer.pack([
+        context_packer.Section("brief", brief, context_packer.REQUIRED),
+        context_packer.Section("catalog", bible_catalog, context_packer.SELECTED_ELEMENTS, truncate=context_packer.KEEP_HEAD),
+        context_packer.Section("chapter_list", chapter_list, context_packer.RECENT_TEXT, truncate=context_packer.KEEP_TAIL),
+        *sections,
+    ], snap.model, overhead=system_prompt)
+    context_packer.log_report("smart_context", packed.report)
+    
+    user_prompt = f"""
+    EXISTING BIBLE ELEMENTS:
+    {packed.text("catalog")}
+    
+    PREVIOUS CHAPTERS:
+    {packed.text("chapter_list")}
+    
+    {story_heading}:
+    {packed.text("story_so_far")}
+    
+    NEW CHAPTER BRIEF:
+    {brief}
+    """
+    
+    # 4. Stream from the LLM, passing fields on as they close
+    if story_so_far is not None:
+        yield {"path": ["story_so_far"], "value": story_so_far}
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt}
+    ]
+    spec = structured.Spec("smart_context", structured.smart_context_schema([el.name for el in context.ordered()], story_so_far is None))
+    constrained = structured.enabled(structured_output)
+    params = {"temperature": 0.7, **(spec.params() if constrained else {})}
+    if constrained:
+        messages = spec.instruct(messages)
+    parser = json_stream.Parser(depth=2)
+    source = llm.stream_cached(url, messages, "smart_context", cache=not no_cache, **params)
+    async for path, value in json_stream.fields(source, parser):
+        if not (story_so_far is not None and path[0] == "story_so_far"):
+            yield {"path": list(path), "value": value}
+
+    result = await structured.settle(spec, parser, constrained, url, messages, **params)
+    if isinstance(result, dict):
+        if story_so_far is not None:
+            result["story_so_far"] = story_so_far
+        yield {"result": {**result, "context_report": packed.report}}
+    else:
+        # Fallback if specific schema fails
+        structured.fell_back("smart_context")
+        yield {"result": {
+            "story_so_far": story_so_far or "Could not generate summary.",
+            "relevant_elements": [],
+            "suggested_new_elements": [],
+            "raw_response": parser.text(),
+            "context_report": packed.report
+        }}
+
+def outline_prompt(context: "bible_context.StoryContext", system: str, smart: dict, brief: str, current_outline: Optional[str] = None,
+                   comments: Optional[str] = None, model: Optional[str] = None) -> Tuple[List[dict], context_packer.PackResult]:
+    # Filter elements if relevant_elements is provided in smart_context
+    relevant_names = smart.get("relevant_elements", [])
+    elements = context.select(relevant_names) if relevant_names else context.ordered()
+
+    if current_outline:
+        task = "You are an expert story outliner. Refine the current outline based on the feedback. Maintain the structure but improve the content."
+    else:
+        task = ("You are an expert story outliner. Create a detailed step-by-step outline for this chapter.\n"
+                "Focus on pacing, key beats, and character moments.")
+
+    packed = context_packer.pack([
+        context_packer.Section("brief", brief, context_packer.REQUIRED),
+        context_packer.Section("current_outline", current_outline or "", context_packer.REQUIRED),
+        context_packer.Section("comments", comments or "", context_packer.REQUIRED),
+        *prompt_layout.bible_sections(context, elements),
+        context_packer.Section("story_so_far", smart.get("story_so_far", ""), context_packer.RECENT_TEXT, truncate=context_packer.KEEP_TAIL),
+    ], model, overhead=system + task)
+    context_packer.log_report("generate_outline", packed.report)
+
+    messages = prompt_layout.messages(system, [
+        ("BIBLE CONTEXT", packed.group_text("bible")),
+        ("STORY SO FAR", packed.text("story_so_far")),
+        ("CHAPTER BRIEF", brief),
+        ("CURRENT OUTLINE", current_outline or ""),
+        ("USER FEEDBACK/INSTRUCTIONS", comments or ""),
+    ], task)
+    return messages, packed
+
+def prose_prompt(context: "bible_context.StoryContext", system: str, smart: dict, outline: str, current_content: Optional[str] = None,
+                 comments: Optional[str] = None, model: Optional[str] = None) -> Tuple[List[dict], context_packer.PackResult]:
+    # Story settings always go in; other elements only if smart context picked them
+    relevant_names = smart.get("relevant_elements", [])
+    elements = context.select(relevant_names) if relevant_names else []
+
+    if current_content:
+        task = "Rewrite the chapter (or sections of it) to address the user feedback while adhering to the outline."
+    else:
+        task = "Write the full chapter prose based on the outline. Match the tone and style of the story."
+
+    # The draft being revised is recent text: keep its opening if it has to be cut
+    packed = context_packer.pack([
+        context_packer.Section("outline", outline, context_packer.REQUIRED),
+        context_packer.Section("comments", comments or "", context_packer.REQUIRED),
+        *prompt_layout.bible_sections(context, elements),
+        context_packer.Section("current_content", current_content or "", context_packer.RECENT_TEXT, truncate=context_packer.KEEP_HEAD),
+        context_packer.Section("story_so_far", smart.get("story_so_far", ""), context_packer.RECENT_TEXT, truncate=context_packer.KEEP_TAIL),
+    ], model, overhead=system + task)
+    context_packer.log_report("write_chapter_v2", packed.report)
+
+    messages = prompt_layout.messages(system, [
+        ("BIBLE CONTEXT", packed.group_text("bible")),
+        ("STORY SO FAR", packed.text("story_so_far")),
+        ("OUTLINE", outline),
+        ("CURRENT DRAFT", packed.text("current_content")),
+        ("USER COMMENTS/FEEDBACK", comments or ""),
+    ], task)
+    return messages, packed
+
+# --- One-request pipeline ---
+
+PAUSE_POINTS = ("context", "outline")
+
+class PauseTimeout(asyncio.TimeoutError):
+    def __init__(self, stage: str):
+        super().__init__(f"Timed out waiting for edits after {stage}")
+        self.stage = stage
+
+class Pipeline:
+    def __init__(self, story_id: int, pause_after: List[str]):
+        self.id = uuid.uuid4().hex
+        self.story_id = story_id
+        self.pause_after = pause_after
+        self.paused: Optional[str] = None  # stage waiting for edits
+        self.edits: Optional[asyncio.Future] = None
+
+    async def pause(self, stage: str) -> dict:
+        # Park until the client posts its edits (or nothing) to /ai/chapter-pipeline/{id}/resume
+        self.paused = stage
+        self.edits = asyncio.get_running_loop().create_future()
+        try:
+            return await asyncio.wait_for(self.edits, config()["pause_timeout"])
+        except asyncio.TimeoutError:
+            # paused is cleared below, so the stage travels with the error
+            raise PauseTimeout(stage)
+        finally:
+            self.paused = None
+            self.edits = None
+
+    def resume(self, edits: dict) -> bool:
+        # Call on the event loop: the future is not thread-safe, and the
+        # done() check must not race the pause timeout
+        if self.edits is None or self.edits.done():
+            return False
+        self.edits.set_result(edits)
+        return True
+
+pipelines: Dict[str, Pipeline] = {}
+
+def get(pipeline_id: str) -> Optional[Pipeline]:
+    return pipelines.get(pipeline_id)
+
+async def recorded(source: AsyncIterator[str], parts: List[str], errors: List[Exception]) -> AsyncIterator[str]:
+    # Keeps what the relay streams out, and whether the source failed (the relay only reports it to the client)
+    try:
+        async for content in source:
+            parts.append(content)
+            yield content
+    except Exception as e:
+        errors.append(e)
+        raise
+
+async def run(pipeline: Pipeline, brief: str, retrieval_mode: Optional[str] = None, no_cache: bool = False,
+              outline: Optional[str] = None, structured_output: Optional[bool] = None) -> AsyncIterator[str]:
+    story_id = pipeline.story_id
+    pipelines[pipeline.id] = pipeline
+    try:
+        yield sse.event({"stage": "context", "status": "started", "pipeline_id": pipeline.id})
+
+        # 1. One snapshot of the story for every stage
+        snap = await snapshot(story_id)
+        try:
+            async for event in smart_context_events(story_id, snap, brief, retrieval_mode, no_cache, structured_output):
+                if "result" in event:
+                    smart = event["result"]
+                else:
+                    yield sse.event({"stage": "context", **event})
+        except Exception as e:
+            print(f"ERROR in chapter pipeline context stage: {e}")
+            yield sse.event({"stage": "context", "error": str(e)})
+            return
+        yield sse.event({"stage": "context", "status": "done", "smart_context": smart})
+        if "context" in pipeline.pause_after:
+            yield sse.event({"stage": "context", "status": "paused", "pipeline_id": pipeline.id})
+            edits = await pipeline.pause("context")
+            smart = {**smart, **(edits.get("smart_context") or {})}
+
+        # 2. Outline, streamed (skipped when the client brings its own)
+        if outline is None:
+            messages, packed = outline_prompt(snap.context, snap.system, smart, brief, model=snap.model)
+            router.check(snap.url)
+            parts, errors = [], []
+            source = recorded(llm.stream_llm(snap.url, messages, "generate_outline"), parts, errors)
+            prelude = [{"stage": "outline", "status": "started", "context_report": packed.report}]
+            async for event in sse.relay(source, prelude, "chapter_pipeline", fields={"stage": "outline"}):
+                yield event
+            if errors:
+                return
+            outline = "".join(parts)
+            yield sse.event({"stage": "outline", "status": "done", "outline": outline})
+            if "outline" in pipeline.pause_after:
+                yield sse.event({"stage": "outline", "status": "paused", "pipeline_id": pipeline.id})
+                edits = await pipeline.pause("outline")
+                outline = edits.get("outline") or outline
+
+        # 3. Prose as a resumable generation job
+        messages, packed = prose_prompt(snap.context, snap.system, smart, outline, model=snap.model)
+        router.check(snap.url)
+        job = await jobs.start("write_chapter_v2", story_id, llm.stream_llm(snap.url, messages, "write_chapter_v2"))
+        parts, errors = [], []
+        prelude = [{"stage": "prose", "status": "started", "job_id": job.id, "context_report": packed.report}]
+        async for event in sse.relay(recorded(job.follow(), parts, errors), prelude, "chapter_pipeline", job_id=job.id, fields={"stage": "prose"}):
+            yield event
+        if not errors:
+            yield sse.event({"stage": "prose", "status": "done", "job_id": job.id})
+    except PauseTimeout as e:
+        yield sse.event({"stage": e.stage, "error": "Timed out waiting for edits"})
+    except Exception as e:
+        # Overloaded from router.check and other failures between stages
+        print(f"ERROR in chapter pipeline: {e}")
+        yield sse.event({"error": str(e), **({"retry_after": e.retry_after} if hasattr(e, "retry_after") else {})})
+    finally:
+        pipelines.pop(pipeline.id, None)
@@ -0,0 +1,137 @@
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional
+
+import settings_service
+from defaults import DEFAULT_LLM_CONTEXT
+
+# Token-budgeted prompt packing. Sections are admitted in priority order
+# (lower number first) until the model's budget is spent; sections that do
+# not fit are truncated when allowed and dropped otherwise. Required sections
+# (the brief, outline, user feedback) are always kept.
+
+REQUIRED = 0
+STORY_SETTINGS = 1
+SELECTED_ELEMENTS = 2
+RECENT_TEXT = 3
+BACKGROUND = 4
+
+# Truncation modes: keep the start ("head") or the most recent end ("tail")
+KEEP_HEAD = "head"
+KEEP_TAIL = "tail"
+
+MIN_TRUNCATED_TOKENS = 64
+TRUNCATION_MARKER = "[...]"
+
+def estimate_chars(text: str) -> int:
+    # ~4 characters per token for English prose on BPE tokenizers
+    return (len(text) + 3) // 4
+
+def estimate_words(text: str) -> int:
+    return int(len(text.split()) * 1.35) + 1
+
+ESTIMATORS: Dict[str, Callable[[str], int]] = {
+    "chars": estimate_chars,
+    "words": estimate_words,
+}
+
+@dataclass
+class Section:
+    name: str
+    text: str
+    priority: int
+    group: Optional[str] = None
+    truncate: Optional[str] = None  # KEEP_HEAD / KEEP_TAIL / None (all or nothing)
+
+@dataclass
+class PackResult:
+    texts: Dict[str, str]
+    groups: Dict[str, List[str]]
+    report: dict = field(default_factory=dict)
+
+    def text(self, name: str) -> str:
+        return self.texts.get(name, "")
+
+    def group_text(self, group: str, sep: str = "\n") -> str:
+        return sep.join(self.texts[name] for name in self.groups.get(group, []))
+
+def model_budget(model: Optional[str] = None) -> dict:
+    config = settings_service.get("llm_context") or {}
+    budgets = {**DEFAULT_LLM_CONTEXT["budgets"], **config.get("budgets", {})}
+    budget = budgets.get(model) or budgets["default"]
+    return {
+        "estimator": config.get("estimator", DEFAULT_LLM_CONTEXT["estimator"]),
+        "context_window": budget["context_window"],
+        "reserve_output": budget["reserve_output"],
+    }
+
+def estimator(model: Optional[str] = None) -> Callable[[str], int]:
+    return ESTIMATORS.get(model_budget(model)["estimator"], estimate_chars)
+
+def truncate(text: str, tokens: int, mode: str, estimate: Callable[[str], int]) -> str:
+    total = estimate(text)
+    if total <= tokens:
+        return text
+    # Proportional cut, then trim until it fits (estimators are near-linear)
+    keep = max(0, int(len(text) * tokens / total) - len(TRUNCATION_MARKER) - 1)
+    while True:
+        if mode == KEEP_TAIL:
+            candidate = f"{TRUNCATION_MARKER} {text[len(text) - keep:]}" if keep else ""
+        else:
+            candidate = f"{text[:keep]} {TRUNCATION_MARKER}" if keep else ""
+        if estimate(candidate) <= tokens or keep == 0:
+            return candidate
+        keep = int(keep * 0.9)
+
+def pack(sections: List[Section], model: Optional[str] = None, overhead: str = "") -> PackResult:
+    # overhead: fixed prompt text (system prompt, template) that is always sent
+    budget = model_budget(model)
+    estimate = estimator(model)
+    available = budget["context_window"] - budget["reserve_output"] - estimate(overhead)
+    remaining = available
+
+    texts, kept, truncated, dropped = {}, [], [], []
+    for section in sorted(sections, key=lambda s: s.priority):
+        cost = estimate(section.text)
+        if section.priority == REQUIRED or cost <= remaining:
+            texts[section.name] = section.text
+            kept.append(section.name)
+            remaining -= cost
+        elif section.truncate and remaining >= MIN_TRUNCATED_TOKENS:
+            texts[section.name] = truncate(section.text, remaining, section.truncate, estimate)
+            truncated.append({"name": section.name, "tokens": cost, "kept_tokens": estimate(texts[section.name])})
+            remaining -= estimate(texts[section.name])
+        else:
+            dropped.append({"name": section.name, "tokens": cost})
+
+    # Preserve the caller's section order within each group
+    groups: Dict[str, List[str]] = {}
+    for section in sections:
+        if section.group and section.name in texts:
+            groups.setdefault(section.group, []).append(section.name)
+
+    report = {
+        "budget": available,
+        "used": available - remaining,
+        "estimator": budget["estimator"],
+        "model": model,
+        "kept": kept,
+        "truncated": truncated,
+        "dropped": dropped,
+    }
+    return PackResult(texts=texts, groups=groups, report=report)
+
+def element_sections(elements, priority: int = SELECTED_ELEMENTS, group: str = "bible") -> List[Section]:
+    # One section per compiled bible element so whole elements are kept or
+    # dropped; story settings always outrank the rest and may be cut short.
+    sections = []
+    for el in elements:
+        if el.type == "story_settings":
+            sections.append(Section(f"{group}:{el.id}:{el.name}", el.block, STORY_SETTINGS, group, KEEP_HEAD))
+        else:
+            sections.append(Section(f"{group}:{el.id}:{el.name}", el.block, priority, group))
+    return sections
+
+def log_report(endpoint: str, report: dict):
+    if report["truncated"] or report["dropped"]:
+        print(f"DEBUG: {endpoint} context packed to {report['used']}/{report['budget']} tokens, "
+              f"truncated {[s['name'] for s in report['truncated']]}, dropped {[s['name'] for s in report['dropped']]}")
@@ -1,40 +1,156 @@
-from models import Story, BibleElement, Chapter, VersionHistory, GlobalSetting
-from database import engine
-from sqlmodel import Session, select
+from models import Story, BibleElement, Chapter, VersionHistory, GlobalSetting, ChapterSummary, BibleElementSummary, ChapterSynopsis, StorySynopsis, LLMCacheEntry, GenerationJob
+from database import engine, unit_of_work
+from history import new_version, read_history, read_version, list_versions, owner_filter, word_count
+from sqlmodel import Session, delete, func, insert, or_, select, text, update
+from datetime import datetime
+from typing import List, Optional, Tuple
+import bible_context
 import json
+import retrieval
+import settings_service
+import writer
 
-def get_global_setting(key: str):
-    with Session(engine) as session:
+def get_global_setting(key: str, session: Optional[Session] = None):
+    with unit_of_work(session) as session:
         return session.get(GlobalSetting, key)
 
-def set_global_setting(key: str, value: dict):
-    with Session(engine) as session:
+def set_global_setting(key: str, value: dict, session: Optional[Session] = None):
+    with unit_of_work(session) as session:
         setting = session.get(GlobalSetting, key)
         if setting:
             setting.value = json.dumps(value)
         else:
             setting = GlobalSetting(key=key, value=json.dumps(value))
         session.add(setting)
+        # Same commit, so other processes see the new version with the new value
+        session.exec(text("UPDATE settings_version SET version = version + 1 WHERE id = 1"))
         session.commit()
-        session.commit()
+        settings_service.reload()
         return setting
 
-def get_all_global_settings():
-    with Session(engine) as session:
-        return session.exec(select(GlobalSetting)).all()
-
 def get_stories():
     with Session(engine) as session:
         return session.exec(select(Story).where(Story.is_deleted == False)).all()
 
-def create_story(story: Story):
+def get_bible_elements(story_id: int):
+    with Session(engine) as session:
+        return session.exec(select(BibleElement).where(BibleElement.story_id == story_id, BibleElement.is_deleted == False)).all()
+
+def get_chapters(story_id: int):
+    with Session(engine) as session:
+        return session.exec(select(Chapter).where(Chapter.story_id == story_id, Chapter.is_deleted == False).order_by(Chapter.order)).all()
+
+def get_bible_element_versions(story_id: int):
+    # Served from the covering summary index; no content is read
+    with Session(engine) as session:
+        rows = session.exec(
+            select(BibleElement.id, BibleElement.version).where(BibleElement.story_id == story_id, BibleElement.is_deleted == False)
+        ).all()
+        return {row.id: row.version for row in rows}
+
+def get_bible_elements_by_id(element_ids: List[int]):
+    with Session(engine) as session:
+        return session.exec(select(BibleElement).where(BibleElement.id.in_(element_ids))).all()
+
+def get_chapter_version_map(story_id: int):
+    # Served from the covering summary index; no content is read
+    with Session(engine) as session:
+        rows = session.exec(
+            select(Chapter.id, Chapter.version).where(Chapter.story_id == story_id, Chapter.is_deleted == False)
+        ).all()
+        return {row.id: row.version for row in rows}
+
+def get_chapters_by_id(chapter_ids: List[int]):
+    with Session(engine) as session:
+        return session.exec(select(Chapter).where(Chapter.id.in_(chapter_ids))).all()
+
+def get_bible_summaries(story_id: int):
+    with Session(engine) as session:
+        rows = session.exec(
+            select(BibleElement.id, BibleElement.type, BibleElement.name, BibleElement.version, BibleElement.word_count, BibleElement.updated_at)
+            .where(BibleElement.story_id == story_id, BibleElement.is_deleted == False)
+        ).all()
+        return [BibleElementSummary(**row._mapping) for row in rows]
+
+def get_chapter_summaries(story_id: int):
+    with Session(engine) as session:
+        rows = session.exec(
+            select(Chapter.id, Chapter.order, Chapter.title, Chapter.version, Chapter.word_count, Chapter.updated_at)
+            .where(Chapter.story_id == story_id, Chapter.is_deleted == False)
+            .order_by(Chapter.order)
+        ).all()
+        return [ChapterSummary(**row._mapping) for row in rows]
+
+def get_bible_element(element_id: int):
+    with Session(engine) as session:
+        element = session.get(BibleElement, element_id)
+        return element if element and not element.is_deleted else None
+
+def get_chapter(chapter_id: int):
+    with Session(engine) as session:
+        chapter = session.get(Chapter, chapter_id)
+        return chapter if chapter and not chapter.is_deleted else None
+
+def get_chapter_history(chapter_id: int):
+    with Session(engine) as session:
+        return read_history(session, chapter_id=chapter_id)
+
+def get_bible_history(element_id: int):
+    with Session(engine) as session:
+        return read_history(session, bible_element_id=element_id)
+
+def get_chapter_versions(chapter_id: int, cursor: int = None, limit: int = 50):
+    with Session(engine) as session:
+        return list_versions(session, cursor, limit, chapter_id=chapter_id)
+
+def get_bible_versions(element_id: int, cursor: int = None, limit: int = 50):
+    with Session(engine) as session:
+        return list_versions(session, cursor, limit, bible_element_id=element_id)
+
+def get_chapter_version(chapter_id: int, version: int):
+    with Session(engine) as session:
+        return read_version(session, version, chapter_id=chapter_id)
+
+def get_bible_version(element_id: int, version: int):
+    with Session(engine) as session:
+        return read_version(session, version, bible_element_id=element_id)
+
+# --- Version fingerprints for ETags (no content is read) ---
+
+def touch_story(session: Session, story_id: int):
+    session.exec(update(Story).where(Story.id == story_id).values(revision=Story.revision + 1))
+
+def get_stories_fingerprint():
+    with Session(engine) as session:
+        return tuple(session.exec(
+            select(func.count(), func.max(Story.id), func.sum(Story.revision)).where(Story.is_deleted == False)
+        ).one())
+
+def get_story_revision(story_id: int):
+    with Session(engine) as session:
+        return session.exec(select(Story.revision).where(Story.id == story_id)).first()
+
+def get_chapter_revision(chapter_id: int):
     with Session(engine) as session:
+        return session.exec(select(Story.revision).join(Chapter, Chapter.story_id == Story.id).where(Chapter.id == chapter_id)).first()
+
+def get_bible_element_revision(element_id: int):
+    with Session(engine) as session:
+        return session.exec(select(Story.revision).join(BibleElement, BibleElement.story_id == Story.id).where(BibleElement.id == element_id)).first()
+
+def get_history_fingerprint(chapter_id: Optional[int] = None, bible_element_id: Optional[int] = None):
+    with Session(engine) as session:
+        return tuple(session.exec(
+            select(func.count(), func.max(VersionHistory.version)).where(owner_filter(chapter_id, bible_element_id))
+        ).one())
+
+def create_story(story: Story, session: Optional[Session] = None):
+    with unit_of_work(session) as session:
         session.add(story)
-        session.commit()
-        session.refresh(story)
+        session.flush()
         
         # Create default Story Settings
-        settings_schema = get_global_setting("bible_schema")
+        settings_schema = get_global_setting("bible_schema", session)
         default_content = ""
         if settings_schema:
             schema_data = json.loads(settings_schema.value)
@@ -56,123 +172,242 @@ def create_story(story: Story):
             story_id=story.id,
             type="story_settings",
             name="Story Settings",
-            content=default_content
+            content=default_content,
+            word_count=word_count(default_content)
         )
         session.add(settings_element)
-        session.commit()
+        session.flush()
         
         # Initial version history for settings
-        history = VersionHistory(
-            bible_element_id=settings_element.id,
-            version=1,
-            content=settings_element.content
-        )
+        history = new_version(session, None, 1, settings_element.content, bible_element_id=settings_element.id)
         session.add(history)
         session.commit()
         
         return story
 
-def create_bible_element(element: BibleElement):
-    with Session(engine) as session:
+def create_bible_element(element: BibleElement, session: Optional[Session] = None):
+    with unit_of_work(session) as session:
+        element.word_count = word_count(element.content)
         session.add(element)
-        session.commit()
-        session.refresh(element)
+        session.flush()
+        touch_story(session, element.story_id)
         
         # Initial version history
-        history = VersionHistory(
-            bible_element_id=element.id,
-            version=element.version,
-            content=element.content
-        )
+        history = new_version(session, None, element.version, element.content, bible_element_id=element.id)
         session.add(history)
         session.commit()
+        bible_context.element_saved(element)
         return element
 
+def _update_bible_element(session: Session, element_id: int, name: str, content: str):
+    element = session.get(BibleElement, element_id)
+    if not element:
+        return None
+
+    previous_content = element.content
+    element.name = name
+    element.content = content
+    element.version += 1
+    element.word_count = word_count(content)
+    element.updated_at = datetime.utcnow()
+
+    history = new_version(session, previous_content, element.version, element.content, bible_element_id=element.id)
+    session.add(element)
+    session.add(history)
+    touch_story(session, element.story_id)
+    return element
+
 def update_bible_element(element_id: int, name: str, content: str):
-    with Session(engine) as session:
-        element = session.get(BibleElement, element_id)
-        if not element:
-            return None
-        
-        element.name = name
-        element.content = content
-        element.version += 1
-        
-        history = VersionHistory(
-            bible_element_id=element.id,
-            version=element.version,
-            content=element.content
-        )
-        session.add(element)
-        session.add(history)
-        session.commit()
-        session.refresh(element)
-        return element
+    element = writer.submit(_update_bible_element, element_id, name, content)
+    bible_context.element_saved(element)
+    return element
 
-def create_chapter(chapter: Chapter):
-    with Session(engine) as session:
+def create_chapter(chapter: Chapter, session: Optional[Session] = None):
+    with unit_of_work(session) as session:
+        chapter.word_count = word_count(chapter.content)
         session.add(chapter)
-        session.commit()
-        session.refresh(chapter)
+        session.flush()
+        touch_story(session, chapter.story_id)
         
-        history = VersionHistory(
-            chapter_id=chapter.id,
-            version=chapter.version,
-            content=chapter.content
-        )
+        history = new_version(session, None, chapter.version, chapter.content, chapter_id=chapter.id)
         session.add(history)
         session.commit()
         return chapter
 
+def _update_chapter(session: Session, chapter_id: int, title: str, content: str):
+    chapter = session.get(Chapter, chapter_id)
+    if not chapter:
+        return None
+
+    previous_content = chapter.content
+    chapter.title = title
+    chapter.content = content
+    chapter.version += 1
+    chapter.word_count = word_count(content)
+    chapter.updated_at = datetime.utcnow()
+
+    history = new_version(session, previous_content, chapter.version, chapter.content, chapter_id=chapter.id)
+    session.add(chapter)
+    session.add(history)
+    touch_story(session, chapter.story_id)
+    return chapter
+
 def update_chapter(chapter_id: int, title: str, content: str):
-    with Session(engine) as session:
-        chapter = session.get(Chapter, chapter_id)
-        if not chapter:
-            return None
-        
-        chapter.title = title
-        chapter.content = content
-        chapter.version += 1
-        
-        history = VersionHistory(
-            chapter_id=chapter.id,
-            version=chapter.version,
-            content=chapter.content
-        )
-        session.add(chapter)
-        session.add(history)
-        session.commit()
-        session.refresh(chapter)
-        return chapter
+    return writer.submit(_update_chapter, chapter_id, title, content)
 
-def delete_story(story_id: int):
-    with Session(engine) as session:
+def delete_story(story_id: int, session: Optional[Session] = None):
+    with unit_of_work(session) as session:
         story = session.get(Story, story_id)
         if story:
             story.is_deleted = True
             session.add(story)
             session.commit()
+            bible_context.story_deleted(story_id)
+            retrieval.story_deleted(story_id)
             return True
         return False
 
-def delete_bible_element(element_id: int):
-    with Session(engine) as session:
+def delete_bible_element(element_id: int, session: Optional[Session] = None):
+    with unit_of_work(session) as session:
         element = session.get(BibleElement, element_id)
         if element:
             if element.type == "story_settings":
                 return False  # Protect from deletion
             element.is_deleted = True
             session.add(element)
+            touch_story(session, element.story_id)
             session.commit()
+            bible_context.element_saved(element)
             return True
         return False
 
-def delete_chapter(chapter_id: int):
-    with Session(engine) as session:
+def delete_chapter(chapter_id: int, session: Optional[Session] = None):
+    with unit_of_work(session) as session:
         chapter = session.get(Chapter, chapter_id)
         if chapter:
             chapter.is_deleted = True
             session.add(chapter)
+            touch_story(session, chapter.story_id)
             session.commit()
             return True
         return False
+
+# --- Story so far summary cache ---
+
+def get_chapter_synopses(chapter_ids: List[int]):
+    with Session(engine) as session:
+        rows = session.exec(
+            select(ChapterSynopsis.chapter_id, ChapterSynopsis.version, ChapterSynopsis.content)
+            .where(ChapterSynopsis.chapter_id.in_(chapter_ids))
+        ).all()
+        return {(row.chapter_id, row.version): row.content for row in rows}
+
+def save_chapter_synopsis(chapter_id: int, version: int, content: str):
+    with unit_of_work() as session:
+        session.exec(delete(ChapterSynopsis).where(ChapterSynopsis.chapter_id == chapter_id, ChapterSynopsis.version < version))
+        # A concurrent request may have summarized the same version first
+        session.exec(insert(ChapterSynopsis).prefix_with("OR IGNORE").values(
+            chapter_id=chapter_id, version=version, content=content, created_at=datetime.utcnow()
+        ))
+        session.commit()
+
+def get_story_synopsis(story_id: int, digest: str):
+    with Session(engine) as session:
+        return session.exec(
+            select(StorySynopsis.content).where(StorySynopsis.story_id == story_id, StorySynopsis.digest == digest)
+        ).first()
+
+def save_story_synopsis(story_id: int, digest: str, level: int, content: str):
+    with unit_of_work() as session:
+        session.exec(insert(StorySynopsis).prefix_with("OR IGNORE").values(
+            story_id=story_id, digest=digest, level=level, content=content, created_at=datetime.utcnow()
+        ))
+        session.commit()
+
+def prune_story_synopses(story_id: int, keep: List[str]):
+    with unit_of_work() as session:
+        session.exec(delete(StorySynopsis).where(StorySynopsis.story_id == story_id, StorySynopsis.digest.not_in(keep)))
+        session.commit()
+
+# --- LLM response cache (disk tier) ---
+
+def get_llm_cache_entry(key: str, now: datetime):
+    # (value, expires_at) of a live entry, or None; a hit moves it to the back of the eviction order
+    with unit_of_work() as session:
+        row = session.exec(
+            select(LLMCacheEntry.value, LLMCacheEntry.expires_at).where(LLMCacheEntry.key == key, LLMCacheEntry.expires_at > now)
+        ).first()
+        if row is not None:
+            session.exec(update(LLMCacheEntry).where(LLMCacheEntry.key == key).values(last_hit_at=now))
+            session.commit()
+        return row
+
+def get_llm_cache_size() -> int:
+    with Session(engine) as session:
+        return session.exec(select(func.sum(LLMCacheEntry.size))).one() or 0
+
+def put_llm_cache_entry(key: str, value: str, expires_at: datetime) -> int:
+    # Returns how many bytes the disk tier grew by (expired rows purged here are not subtracted)
+    now = datetime.utcnow()
+    size = len(value.encode())
+    with unit_of_work() as session:
+        session.exec(delete(LLMCacheEntry).where(LLMCacheEntry.expires_at <= now))
+        previous = session.exec(select(LLMCacheEntry.size).where(LLMCacheEntry.key == key)).first()
+        session.merge(LLMCacheEntry(key=key, value=value, size=size, created_at=now, expires_at=expires_at, last_hit_at=now))
+        session.commit()
+        return size - (previous or 0)
+
+def evict_llm_cache(max_bytes: int) -> Tuple[int, int]:
+    # Least recently used entries go first until the disk tier fits; returns (evicted, bytes left)
+    with unit_of_work() as session:
+        total = session.exec(select(func.sum(LLMCacheEntry.size))).one() or 0
+        evicted = []
+        excess = total - max_bytes
+        if excess > 0:
+            for row in session.exec(select(LLMCacheEntry.key, LLMCacheEntry.size).order_by(LLMCacheEntry.last_hit_at)):
+                if excess <= 0:
+                    break
+                evicted.append(row.key)
+                excess -= row.size
+                total -= row.size
+            session.exec(delete(LLMCacheEntry).where(LLMCacheEntry.key.in_(evicted)))
+            session.commit()
+        return len(evicted), total
+
+def clear_llm_cache():
+    with unit_of_work() as session:
+        session.exec(delete(LLMCacheEntry))
+        session.commit()
+
+# --- Generation jobs ---
+
+def create_generation_job(job_id: str, endpoint: str, story_id: Optional[int], owner: Optional[int] = None):
+    with unit_of_work() as session:
+        session.add(GenerationJob(id=job_id, endpoint=endpoint, story_id=story_id, owner=owner))
+        session.commit()
+
+def append_generation_job(job_id: str, text: str, status: str, error: Optional[str] = None):
+    # Appends only the new text so long generations are not rewritten on every flush
+    with unit_of_work() as session:
+        session.exec(update(GenerationJob).where(GenerationJob.id == job_id).values(
+            content=GenerationJob.content + text, status=status, error=error, updated_at=datetime.utcnow()
+        ))
+        session.commit()
+
+def get_generation_job(job_id: str):
+    with Session(engine) as session:
+        return session.get(GenerationJob, job_id)
+
+def get_running_job_owners() -> List[Optional[int]]:
+    with Session(engine) as session:
+        return list(session.exec(select(GenerationJob.owner).where(GenerationJob.status == "running").distinct()).all())
+
+def interrupt_generation_jobs(owners: List[Optional[int]], before: datetime):
+    # Jobs left "running" by processes that are gone keep their text but can no longer grow
+    with unit_of_work() as session:
+        dead = GenerationJob.owner.in_([owner for owner in owners if owner is not None])
+        if None in owners:  # rows from before jobs had owners
+            dead = or_(dead, GenerationJob.owner.is_(None))
+        session.exec(update(GenerationJob).where(GenerationJob.status == "running", dead).values(status="interrupted", error="Generation interrupted by a server restart"))
+        session.exec(delete(GenerationJob).where(GenerationJob.updated_at < before))
+        session.commit()
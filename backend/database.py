@@ -1,10 +1,73 @@
-from sqlmodel import SQLModel, create_engine
+from sqlmodel import SQLModel, Session, create_engine
+from sqlalchemy import event
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Optional
+import asyncio
+import functools
 import os
 
 DATABASE_URL = "sqlite:///./story_agent.db"
 
-engine = create_engine(DATABASE_URL, echo=True, connect_args={"check_same_thread": False})
+# Connection-level SQLite tuning. "performance" trades a little durability on
+# power loss (synchronous=NORMAL under WAL) for far fewer fsyncs per commit.
+STORAGE_PROFILES = {
+    "performance": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "busy_timeout": 5000,
+        "mmap_size": 268435456,  # 256 MiB
+        "cache_size": -65536,  # 64 MiB
+        "temp_store": "MEMORY",
+    },
+    "safe": {
+        "journal_mode": "WAL",
+        "synchronous": "FULL",
+        "busy_timeout": 10000,
+        "cache_size": -16384,
+    },
+    "default": {},
+}
+
+STORAGE_PROFILE = os.environ.get("STORY_AGENT_STORAGE_PROFILE", "performance")
+DB_ECHO = os.environ.get("STORY_AGENT_DB_ECHO", "0") == "1"
+
+engine = create_engine(DATABASE_URL, echo=DB_ECHO, connect_args={"check_same_thread": False})
+
+@event.listens_for(engine, "connect")
+def apply_storage_profile(dbapi_connection, connection_record):
+    pragmas = STORAGE_PROFILES.get(STORAGE_PROFILE, STORAGE_PROFILES["performance"])
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas.items():
+        cursor.execute(f"PRAGMA {name}={value}")
+    cursor.close()
+
+# Each API operation is one unit of work: a single request-scoped session and
+# a single commit issued by the crud function that owns the operation.
+# Objects stay readable after commit so responses need no refresh query.
+def get_session():
+    with Session(engine, expire_on_commit=False) as session:
+        yield session
+
+@contextmanager
+def unit_of_work(session: Optional[Session] = None):
+    if session is not None:
+        yield session
+        return
+    with Session(engine, expire_on_commit=False) as session:
+        yield session
+
+# Async routes must never touch a Session on the event loop. All of their
+# database work goes through this bounded executor via run_db().
+DB_EXECUTOR_WORKERS = int(os.environ.get("STORY_AGENT_DB_WORKERS", "4"))
+db_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="db")
+
+async def run_db(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, functools.partial(fn, *args, **kwargs))
 
 def create_db_and_tables():
     from models import Story, BibleElement, Chapter, VersionHistory
+    from migrations import run_migrations
     SQLModel.metadata.create_all(engine)
+    run_migrations(engine)
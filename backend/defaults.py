@@ -32,3 +32,137 @@ DEFAULT_SETTINGS = {
     "llm_url": "http://localhost:1234/v1/chat/completions",
     "llm_system_prompt": "You are a creative writing assistant. Use the provided story bible context to help write engaging and consistent chapters."
 }
+
+# HTTP client used for all LLM calls. Can be overridden via the "llm_client" global setting.
+DEFAULT_LLM_CLIENT = {
+    "max_connections": 20,
+    "max_keepalive_connections": 10,
+    "keepalive_expiry": 60.0,
+    "connect_timeout": 10.0,
+    "timeouts": {
+        "default": 120.0,
+        "generate_chapter": 120.0,
+        "smart_context": 180.0,
+        "generate_outline": 180.0,
+        "write_chapter_v2": 180.0,
+        "analyze_bible_brief": 30.0,
+        "propose_bible_element": 60.0,
+        "summarize_chapter": 120.0,
+        "summarize_story": 120.0
+    }
+}
+
+# Prompt budgets per model for the context packer. Can be overridden via the "llm_context" global setting.
+DEFAULT_LLM_CONTEXT = {
+    "estimator": "chars",
+    "budgets": {
+        "default": {"context_window": 8192, "reserve_output": 2048}
+    }
+}
+
+# Lexical (BM25) retrieval used to pick relevant bible elements. Can be overridden via the "retrieval" global setting.
+# mode: "llm" (LLM picks from the full catalog), "lexical" (index only, no LLM call),
+# "hybrid" (index pre-filters the catalog to the top `candidates` before the LLM picks)
+DEFAULT_RETRIEVAL = {
+    "mode": "hybrid",
+    "candidates": 20,
+    "top_k": 5,
+    "k1": 1.5,
+    "b": 0.75
+}
+
+# Cached "story so far" summaries. Can be overridden via the "summaries" global setting.
+# Chapter summaries are combined as-is while they fit in story_tokens; past that they are
+# summarized again in groups of group_size, level by level.
+DEFAULT_SUMMARIES = {
+    "chapter_words": 150,
+    "story_tokens": 1500,
+    "group_size": 8,
+    "concurrency": 2
+}
+
+# Response cache for non-streaming LLM calls. Can be overridden via the "llm_cache" global setting.
+DEFAULT_LLM_CACHE = {
+    "enabled": True,
+    "ttl": 86400,
+    "memory_entries": 256,
+    "memory_bytes": 8 * 1024 * 1024,
+    "disk_bytes": 64 * 1024 * 1024
+}
+
+# Admission control for upstream LLM calls. Can be overridden via the "llm_scheduler" global setting.
+# max_concurrency is per backend URL ("backends" maps a URL to its own limit); lower priority values
+# are served first and give up after queue_timeout seconds.
+DEFAULT_LLM_SCHEDULER = {
+    "max_concurrency": 2,
+    "max_queue": 32,
+    "backends": {},
+    "classes": {
+        "interactive": {"priority": 0, "queue_timeout": 60.0},
+        "outline": {"priority": 1, "queue_timeout": 120.0},
+        "analysis": {"priority": 2, "queue_timeout": 300.0}
+    },
+    "endpoints": {
+        "generate_chapter": "interactive",
+        "write_chapter_v2": "interactive",
+        "generate_outline": "outline",
+        "smart_context": "outline",
+        "analyze_bible_brief": "analysis",
+        "propose_bible_element": "analysis",
+        "summarize_chapter": "analysis",
+        "summarize_story": "analysis"
+    },
+    "default_class": "analysis"
+}
+
+# Pool of model servers for the LLM router. Can be overridden via the "llm_backends" global setting.
+# Each backend: {"url", "model" (replaces the requested model), "max_slots" (scheduler limit), "weight",
+# "server", "params" (extra payload fields, replacing the pool-wide ones)}. With no backends listed, every
+# call goes to the llm_url setting, described by the pool-wide "server". "server": "llama.cpp" or
+# "lmstudio" adds cache_prompt, which asks those servers to reuse the KV cache of the shared prompt
+# prefix; other APIs may reject unknown fields, so nothing is added by default. "response_format": false
+# marks a backend that can't constrain output to a JSON schema (also learned when a backend rejects it).
+DEFAULT_LLM_BACKENDS = {
+    "backends": [],
+    "server": None,
+    "params": {},
+    "response_format": True,
+    "health_interval": 15.0,
+    "health_timeout": 3.0,
+    "failure_threshold": 3,
+    "max_attempts": 2
+}
+
+# SSE relay for streaming endpoints. Can be overridden via the "sse" global setting.
+# With coalesce on, upstream deltas are sent every flush_ms or once flush_chars have accumulated.
+DEFAULT_SSE = {
+    "coalesce": True,
+    "flush_ms": 50,
+    "flush_chars": 256
+}
+
+# One-request chapter pipeline (smart context -> outline -> prose). Can be overridden via the "chapter_pipeline" global setting.
+# pause_timeout: seconds a paused pipeline waits for the client's edits.
+DEFAULT_CHAPTER_PIPELINE = {
+    "pause_timeout": 900
+}
+
+# Server-side generation jobs behind the streaming endpoints. Can be overridden via the "jobs" global setting.
+# Text is persisted every persist_ms; finished jobs stay in memory for keep_seconds, in the DB for retention_hours.
+DEFAULT_JOBS = {
+    "persist_ms": 1000,
+    "orphan_grace_ms": 3000,
+    "disconnect_poll_ms": 1000,
+    "keep_seconds": 600,
+    "retention_hours": 168
+}
+
+# Schema-constrained replies for the JSON endpoints (smart context, analyze brief, propose element).
+# Can be overridden via the "structured_output" global setting or per request ("structured": true).
+# repair_calls: follow-up requests asking only for fields still missing or invalid after local fixes.
+# max_enum: name lists longer than this are not sent as an enum.
+DEFAULT_STRUCTURED_OUTPUT = {
+    "enabled": False,
+    "repair_calls": 1,
+    "max_enum": 200
+}
@@ -0,0 +1,30 @@
+from fastapi import Request, Response
+from typing import Optional
+
+# Strong ETags built from version counters that already change on every
+# write (story revision, chapter/element version, settings fingerprint), so
+# checking one never requires loading or serializing content.
+
+def make(*parts) -> str:
+    return '"' + "-".join(str(p) for p in parts) + '"'
+
+def matches(request: Request, etag: Optional[str]) -> bool:
+    if etag is None:
+        return False
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    # If-None-Match uses weak comparison
+    candidates = [tag.strip() for tag in header.split(",")]
+    return any(tag.removeprefix("W/") == etag for tag in candidates)
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+
+def tag(response: Response, etag: Optional[str]):
+    if etag is not None:
+        response.headers["ETag"] = etag
+        # Always revalidate, so browsers turn refetches into cheap 304s
+        response.headers["Cache-Control"] = "no-cache"
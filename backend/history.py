@@ -0,0 +1,151 @@
+from difflib import SequenceMatcher
+from typing import List, Optional
+from sqlmodel import Session, select
+import json
+import re
+import zlib
+
+from models import VersionHistory, VersionHistoryRead, VersionSummary, VersionPage
+
+# History rows are stored as periodic full keyframes with zlib-compressed
+# deltas against the previous version in between. Reconstructing any version
+# replays at most KEYFRAME_INTERVAL - 1 deltas on top of a keyframe.
+KEYFRAME_INTERVAL = 20
+
+STORAGE_FULL = "full"
+STORAGE_DELTA = "delta"
+
+# Sentence / line / tag sized segments keep deltas small for prose and for
+# editor HTML that has no newlines at all.
+SEGMENT_RE = re.compile(r"[^\n.!?>]*(?:[.!?]+[ \t]*|>|\n)|[^\n.!?>]+$")
+
+TAG_RE = re.compile(r"<[^>]+>")
+
+def word_count(text: str) -> int:
+    return len(TAG_RE.sub(" ", text).split())
+
+def segments(text: str) -> List[str]:
+    return SEGMENT_RE.findall(text)
+
+def encode_delta(old: str, new: str) -> bytes:
+    a, b = segments(old), segments(new)
+    ops = []
+    for tag, i1, i2, j1, j2 in SequenceMatcher(None, a, b, autojunk=False).get_opcodes():
+        if tag == "equal":
+            ops.append([i1, i2])
+        elif tag in ("replace", "insert"):
+            ops.append("".join(b[j1:j2]))
+    return zlib.compress(json.dumps(ops, separators=(",", ":")).encode("utf-8"))
+
+def apply_delta(old: str, delta: bytes) -> str:
+    a = segments(old)
+    parts = []
+    for op in json.loads(zlib.decompress(delta)):
+        if isinstance(op, str):
+            parts.append(op)
+        else:
+            parts.append("".join(a[op[0]:op[1]]))
+    return "".join(parts)
+
+def owner_filter(chapter_id: Optional[int] = None, bible_element_id: Optional[int] = None):
+    if chapter_id is not None:
+        return VersionHistory.chapter_id == chapter_id
+    return VersionHistory.bible_element_id == bible_element_id
+
+def new_version(session: Session, previous_content: Optional[str], version: int, content: str,
+                chapter_id: Optional[int] = None, bible_element_id: Optional[int] = None) -> VersionHistory:
+    history = VersionHistory(
+        chapter_id=chapter_id,
+        bible_element_id=bible_element_id,
+        version=version,
+        content=content,
+        size=len(content.encode("utf-8")),
+        word_count=word_count(content),
+    )
+    if previous_content is None or version % KEYFRAME_INTERVAL == 1:
+        return history
+    # Only chain onto an existing predecessor; gaps always restart with a keyframe
+    previous = session.exec(
+        select(VersionHistory.id).where(owner_filter(chapter_id, bible_element_id), VersionHistory.version == version - 1)
+    ).first()
+    if previous is None:
+        return history
+    delta = encode_delta(previous_content, content)
+    if len(delta) >= len(content.encode("utf-8")):
+        return history
+    history.storage = STORAGE_DELTA
+    history.delta = delta
+    history.content = ""
+    return history
+
+def replay(rows):
+    # rows must be in ascending version order and start at a keyframe
+    content = None
+    for row in rows:
+        if row.storage == STORAGE_DELTA and content is not None:
+            content = apply_delta(content, row.delta)
+        else:
+            content = row.content
+        yield row, content
+
+def materialize(rows: List[VersionHistory]) -> List[VersionHistoryRead]:
+    result = []
+    for row, content in replay(rows):
+        result.append(VersionHistoryRead(
+            id=row.id,
+            bible_element_id=row.bible_element_id,
+            chapter_id=row.chapter_id,
+            version=row.version,
+            content=content,
+            timestamp=row.timestamp,
+        ))
+    return result
+
+def read_history(session: Session, chapter_id: Optional[int] = None, bible_element_id: Optional[int] = None) -> List[VersionHistoryRead]:
+    rows = session.exec(
+        select(VersionHistory).where(owner_filter(chapter_id, bible_element_id)).order_by(VersionHistory.version)
+    ).all()
+    return list(reversed(materialize(rows)))
+
+def read_version(session: Session, version: int, chapter_id: Optional[int] = None, bible_element_id: Optional[int] = None) -> Optional[VersionHistoryRead]:
+    owner = owner_filter(chapter_id, bible_element_id)
+    keyframe = session.exec(
+        select(VersionHistory.version).where(owner, VersionHistory.version <= version, VersionHistory.storage == STORAGE_FULL)
+        .order_by(VersionHistory.version.desc())
+    ).first()
+    if keyframe is None:
+        return None
+    rows = session.exec(
+        select(VersionHistory).where(owner, VersionHistory.version >= keyframe, VersionHistory.version <= version)
+        .order_by(VersionHistory.version)
+    ).all()
+    if not rows or rows[-1].version != version:
+        return None
+    return materialize(rows)[-1]
+
+def list_versions(session: Session, cursor: Optional[int] = None, limit: int = 50,
+                  chapter_id: Optional[int] = None, bible_element_id: Optional[int] = None) -> VersionPage:
+    # Metadata only: served from the listing index without touching content
+    query = select(
+        VersionHistory.id, VersionHistory.version, VersionHistory.timestamp,
+        VersionHistory.size, VersionHistory.word_count,
+    ).where(owner_filter(chapter_id, bible_element_id))
+    if cursor is not None:
+        query = query.where(VersionHistory.version < cursor)
+    # One extra row tells us whether there is a next page and gives the
+    # word count the last item on this page is compared against
+    rows = session.exec(query.order_by(VersionHistory.version.desc()).limit(limit + 1)).all()
+
+    items = []
+    for i, row in enumerate(rows[:limit]):
+        older = rows[i + 1].word_count if i + 1 < len(rows) else 0
+        items.append(VersionSummary(
+            id=row.id,
+            version=row.version,
+            timestamp=row.timestamp,
+            size=row.size or 0,
+            word_count=row.word_count or 0,
+            word_delta=(row.word_count or 0) - (older or 0),
+        ))
+    next_cursor = items[-1].version if len(rows) > limit else None
+    return VersionPage(items=items, next_cursor=next_cursor)
@@ -0,0 +1,231 @@
+import asyncio
+import bisect
+import os
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import AsyncIterator, Dict, Iterable, List, Optional
+
+from fastapi import Request
+from fastapi.responses import StreamingResponse
+
+import crud
+import database
+import settings_service
+import sse
+from broadcast import Broadcast
+from defaults import DEFAULT_JOBS
+
+# Streaming generations run as server-side jobs, detached from the request
+# that started them. Text is kept in memory for live followers and appended
+# to the generationjob table, so a client that drops can reconnect with
+# Last-Event-ID ("<job id>:<offset>") and replay from where it stopped.
+# A job nobody is following for orphan_grace_ms is cancelled, which closes
+# the upstream request and frees its scheduler slot.
+# Rows carry the pid of the process streaming them, so a worker starting up
+# next to live ones only interrupts the jobs of processes that are gone.
+
+def config() -> dict:
+    return {**DEFAULT_JOBS, **(settings_service.get("jobs") or {})}
+
+class Job:
+    def __init__(self, job_id: str, endpoint: str, story_id: Optional[int]):
+        self.id = job_id
+        self.endpoint = endpoint
+        self.story_id = story_id
+        self.stream = Broadcast()
+        self.ends: List[int] = []  # cumulative text length after each chunk
+        self.status = "running"
+        self.error: Optional[str] = None
+        self.persisted = 0  # characters already written to the DB
+        self.finished_at: Optional[float] = None
+        self.task: Optional[asyncio.Task] = None
+        self.followers = 0
+        self.orphan_timer: Optional[asyncio.TimerHandle] = None
+
+    @property
+    def length(self) -> int:
+        return self.ends[-1] if self.ends else 0
+
+    def text(self, offset: int = 0) -> str:
+        return "".join(self.stream.chunks)[offset:]
+
+    @property
+    def running(self) -> bool:
+        return self.task is not None and not self.task.done()
+
+    def cancel(self, reason: str = "cancelled") -> bool:
+        if not self.running:
+            return False
+        print(f"DEBUG: Cancelling {self.endpoint} job {self.id} ({reason})")
+        self.task.cancel()
+        return True
+
+    def attach(self):
+        self.followers += 1
+        if self.orphan_timer is not None:
+            self.orphan_timer.cancel()
+            self.orphan_timer = None
+
+    def detach(self):
+        # Last follower gone: give the client a moment to reconnect, then stop the upstream
+        self.followers -= 1
+        if self.followers == 0 and self.running:
+            grace = config()["orphan_grace_ms"] / 1000
+            self.orphan_timer = asyncio.get_running_loop().call_later(grace, self.cancel, "no clients")
+
+    async def follow(self, offset: int = 0) -> AsyncIterator[str]:
+        # Replay from a character offset, then keep following live output
+        self.attach()
+        index = bisect.bisect_right(self.ends, offset)
+        subscription = None
+        try:
+            if index < len(self.ends):
+                start = self.ends[index - 1] if index else 0
+                if offset > start:
+                    yield self.stream.chunks[index][offset - start:]
+                    index += 1
+            subscription = self.stream.subscribe(index)
+            async for chunk in subscription:
+                yield chunk
+        finally:
+            if subscription is not None:
+                await subscription.aclose()
+            self.detach()
+
+    async def persist(self):
+        text = self.text(self.persisted)
+        self.persisted += len(text)
+        await database.run_db(crud.append_generation_job, self.id, text, self.status, self.error)
+
+    async def run(self, source: AsyncIterator[str]):
+        persist_after = config()["persist_ms"] / 1000
+        last_persist = time.monotonic()
+        error = None
+        try:
+            async for content in source:
+                self.ends.append(self.length + len(content))
+                await self.stream.publish(content)
+                if time.monotonic() - last_persist >= persist_after:
+                    await self.persist()
+                    last_persist = time.monotonic()
+            self.status = "completed"
+        except asyncio.CancelledError:
+            self.status = "cancelled"
+            self.error = "Generation cancelled"
+            error = Exception(self.error)
+        except Exception as e:
+            print(f"ERROR in {self.endpoint} job {self.id}: {e}")
+            self.status = "failed"
+            self.error = str(e)
+            error = e
+        finally:
+            self.finished_at = time.monotonic()
+            if self.orphan_timer is not None:
+                self.orphan_timer.cancel()
+            await self.stream.finish(error)
+            await self.persist()
+
+jobs: Dict[str, Job] = {}
+
+def evict_finished(keep_seconds: float):
+    now = time.monotonic()
+    for job_id in [i for i, job in jobs.items() if job.finished_at is not None and now - job.finished_at > keep_seconds]:
+        del jobs[job_id]
+
+async def start(endpoint: str, story_id: Optional[int], source: AsyncIterator[str]) -> Job:
+    evict_finished(config()["keep_seconds"])
+    job = Job(uuid.uuid4().hex, endpoint, story_id)
+    await database.run_db(crud.create_generation_job, job.id, endpoint, story_id, os.getpid())
+    jobs[job.id] = job
+    job.task = asyncio.ensure_future(job.run(source))
+    return job
+
+def get(job_id: str) -> Optional[Job]:
+    return jobs.get(job_id)
+
+def parse_last_event_id(value: Optional[str], job_id: str) -> int:
+    if not value or ":" not in value:
+        return 0
+    event_job, _, offset = value.rpartition(":")
+    if event_job != job_id or not offset.isdigit():
+        return 0
+    return int(offset)
+
+async def until_disconnected(request: Request, events: AsyncIterator[str], label: str) -> AsyncIterator[str]:
+    # Servers that don't cancel the response on disconnect only notice on the next write,
+    # which can be a long way off while the model is still reading the prompt
+    poll = config()["disconnect_poll_ms"] / 1000
+    iterator = events.__aiter__()
+    pending = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+            done, _ = await asyncio.wait({pending}, timeout=poll)
+            if not done:
+                if await request.is_disconnected():
+                    print(f"DEBUG: Client disconnected from {label} stream")
+                    return
+                continue
+            try:
+                event = pending.result()
+            except StopAsyncIteration:
+                return
+            finally:
+                pending = None
+            yield event
+    finally:
+        if pending is not None:
+            pending.cancel()
+            try:
+                await pending
+            except (asyncio.CancelledError, StopAsyncIteration, Exception):
+                pass
+        await iterator.aclose()
+
+def response(job: Job, offset: int = 0, prelude: Iterable[dict] = (), request: Optional[Request] = None) -> StreamingResponse:
+    stream = sse.relay(job.follow(offset), [*prelude, {"job_id": job.id}], job.endpoint, job_id=job.id, offset=offset)
+    if request is not None:
+        stream = until_disconnected(request, stream, job.endpoint)
+    return StreamingResponse(stream, media_type="text/event-stream", headers={"X-Generation-Id": job.id})
+
+async def replay(text: str, error: Optional[str]) -> AsyncIterator[str]:
+    if text:
+        yield text
+    if error:
+        raise Exception(error)
+
+def record_response(record, offset: int = 0) -> StreamingResponse:
+    # Job no longer in memory (finished long ago or cut off by a restart): replay what was persisted
+    prelude = [{"job_id": record.id, "status": record.status}]
+    stream = sse.relay(replay(record.content[offset:], record.error), prelude, record.endpoint, job_id=record.id, offset=offset)
+    return StreamingResponse(stream, media_type="text/event-stream", headers={"X-Generation-Id": record.id})
+
+def alive(pid: Optional[int]) -> bool:
+    if pid is None or pid == os.getpid():
+        # No owner (rows from before owners were kept), or a process before us
+        # that had our pid: nothing of ours is running yet at startup
+        return False
+    if os.name == "nt":
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(0x1000, False, pid)  # PROCESS_QUERY_LIMITED_INFORMATION
+        if not handle:
+            return False
+        code = ctypes.c_ulong()
+        kernel32.GetExitCodeProcess(handle, ctypes.byref(code))
+        kernel32.CloseHandle(handle)
+        return code.value == 259  # STILL_ACTIVE
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True  # someone else's process
+    return True
+
+def startup():
+    cfg = config()
+    dead = [owner for owner in crud.get_running_job_owners() if not alive(owner)]
+    crud.interrupt_generation_jobs(dead, datetime.utcnow() - timedelta(hours=cfg["retention_hours"]))
@@ -0,0 +1,350 @@
+import json
+import re
+from typing import Any, AsyncIterator, List, Optional, Set, Tuple
+
+# Incremental, forgiving JSON parser for model output. Text is fed in as it
+# streams; every value that closes at or above `depth` is reported with its
+# path (("relevant_elements", 0), ("story_so_far",)) so callers can act on it
+# before the completion ends. Common model mistakes are repaired in place
+# instead of re-asking the model:
+#   prose or ``` fences around the object, trailing text after it
+#   trailing / missing commas, // and /* */ comments
+#   raw newlines and control characters inside strings, bad escapes
+#   quotes inside strings that were never escaped
+#   'single quoted' strings, bare keys, True/False/None
+#   output cut off mid-way (open strings and containers are closed)
+
+Path = Tuple[Any, ...]
+
+ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+STRING_END = {'"': re.compile(r'["\\]'), "'": re.compile(r"['\\]")}
+CONTROL = re.compile(r"[\x00-\x1f]")
+SURROGATE = re.compile("[\ud800-\udfff]")  # halves of a \u-escaped pair
+WORD = re.compile(r"[A-Za-z0-9_$+\-.]*")
+LITERALS = {"true": True, "false": False, "null": None, "True": True, "False": False, "None": None}
+WHITESPACE = " \t\r\n"
+
+class Frame:
+    def __init__(self, container, path: Optional[Path]):
+        self.container = container
+        self.path = path  # None for a container with nowhere to go (e.g. in key position)
+        self.key: Optional[str] = None
+        self.expect = "key" if isinstance(container, dict) else "value"
+        self.comma = False  # a comma was seen since the last value
+
+class Parser:
+    def __init__(self, depth: int = 1):
+        self.depth = depth
+        self.chunks: List[str] = []
+        self.buf = ""
+        self.pos = 0
+        self.started = False
+        self.complete = False  # the root value closed normally
+        self.value: Any = None  # the root, filled in as it is parsed
+        self.stack: List[Frame] = []
+        self.string: Optional[List[str]] = None  # chars of the open string
+        self.quote = '"'
+        self.repairs: Set[str] = set()
+        self.events: List[Tuple[Path, Any]] = []
+
+    def text(self) -> str:
+        return "".join(self.chunks)
+
+    def feed(self, text: str) -> List[Tuple[Path, Any]]:
+        self.chunks.append(text)
+        if self.complete:
+            if text.strip():
+                self.repairs.add("text around JSON")
+            return []
+        self.buf = self.buf[self.pos:] + text
+        self.pos = 0
+        return self.run(final=False)
+
+    def close(self) -> List[Tuple[Path, Any]]:
+        # End of input: settle what was waiting on lookahead, then close whatever is still open
+        if self.complete:
+            return []
+        events = self.run(final=True)
+        if self.string is not None:
+            self.repairs.add("unclosed string")
+            self.end_string()
+        if self.stack:
+            self.repairs.add("truncated")
+        while self.stack:
+            self.close_container()
+        return events + self.flush()
+
+    def flush(self) -> List[Tuple[Path, Any]]:
+        events, self.events = self.events, []
+        return events
+
+    # -- values --
+
+    def emit(self, path: Path, value: Any):
+        if len(path) <= self.depth:
+            self.events.append((path, value))
+
+    def place(self, value: Any) -> Optional[Path]:
+        # Puts a value into the open container; returns its path, or None if it was dropped
+        if not self.stack:
+            self.value = value
+            return ()
+        frame = self.stack[-1]
+        container = frame.container
+        if isinstance(container, list):
+            if container and not frame.comma:
+                self.repairs.add("missing comma")
+            container.append(value)
+            frame.comma = False
+            return frame.path + (len(container) - 1,) if frame.path is not None else None
+        if frame.expect == "key":
+            if isinstance(value, str):
+                if container and not frame.comma:
+                    self.repairs.add("missing comma")
+                frame.key = value
+                frame.expect = "colon"
+            return None
+        if frame.expect == "colon":
+            self.repairs.add("missing colon")
+        key = frame.key
+        container[key] = value
+        frame.key = None
+        frame.expect = "key"
+        frame.comma = False
+        return frame.path + (key,) if frame.path is not None else None
+
+    def add(self, value: Any):
+        path = self.place(value)
+        if path is not None and self.stack:
+            self.emit(path, value)
+
+    def open_container(self, container):
+        path = self.place(container)
+        self.stack.append(Frame(container, path))
+
+    def close_container(self):
+        frame = self.stack.pop()
+        if frame.comma and frame.container:
+            self.repairs.add("trailing comma")
+        if not self.stack:
+            self.complete = not self.repairs.intersection({"truncated", "unclosed string"})
+        if frame.path:
+            self.emit(frame.path, frame.container)
+
+    def end_string(self):
+        value = "".join(self.string)
+        if SURROGATE.search(value):
+            value = value.encode("utf-16", "surrogatepass").decode("utf-16", "replace")
+        self.string = None
+        self.add(value)
+
+    # -- scanning --
+
+    def run(self, final: bool) -> List[Tuple[Path, Any]]:
+        buf = self.buf
+        if not self.started:
+            start = min((i for i in (buf.find("{"), buf.find("[")) if i != -1), default=-1)
+            if start == -1:
+                # Prose before the object, dropped a chunk at a time
+                if buf.strip():
+                    self.repairs.add("text around JSON")
+                self.pos = len(buf)
+                return []
+            if buf[:start].strip():
+                self.repairs.add("text around JSON")
+            self.pos = start
+            self.started = True
+        while self.pos < len(buf) and not self.complete:
+            if self.string is not None:
+                if not self.scan_string(final):
+                    break
+                continue
+            c = buf[self.pos]
+            if c in WHITESPACE:
+                self.pos += 1
+            elif c == "{" or c == "[":
+                self.pos += 1
+                self.open_container({} if c == "{" else [])
+            elif c == "}" or c == "]":
+                self.pos += 1
+                self.close_container()
+            elif c == ",":
+                self.pos += 1
+                frame = self.stack[-1]
+                if frame.expect != "key" and isinstance(frame.container, dict):
+                    frame.key = None
+                    frame.expect = "key"
+                frame.comma = True
+            elif c == ":":
+                self.pos += 1
+                self.stack[-1].expect = "value"
+            elif c == '"' or c == "'":
+                if c == "'":
+                    self.repairs.add("single quotes")
+                self.pos += 1
+                self.quote = c
+                self.string = []
+            elif c == "/":
+                if not self.skip_comment(final):
+                    break
+            else:
+                if not self.scan_word(final):
+                    break
+        if self.complete and buf[self.pos:].strip():
+            self.repairs.add("text around JSON")
+        return self.flush()
+
+    def scan_string(self, final: bool) -> bool:
+        # False when more input is needed to decide how the string goes on
+        buf, pattern = self.buf, STRING_END[self.quote]
+        while True:
+            match = pattern.search(buf, self.pos)
+            if match is None:
+                self.append_text(buf[self.pos:])
+                self.pos = len(buf)
+                return False
+            self.append_text(buf[self.pos:match.start()])
+            self.pos = match.start()
+            if buf[self.pos] == "\\":
+                if not self.scan_escape(final):
+                    return False
+                continue
+            closes = self.string_closes(self.pos + 1, final)
+            if closes is None:
+                return False
+            self.pos += 1
+            if closes:
+                self.end_string()
+                return True
+            self.repairs.add("unescaped quote")
+            self.string.append(self.quote)
+
+    def append_text(self, text: str):
+        if text:
+            if CONTROL.search(text):
+                self.repairs.add("control characters")
+            self.string.append(text)
+
+    def scan_escape(self, final: bool) -> bool:
+        buf, pos = self.buf, self.pos
+        if pos + 1 >= len(buf):
+            if final:
+                self.pos = len(buf)
+            return final
+        char = buf[pos + 1]
+        if char == "u":
+            if pos + 6 > len(buf) and not final:
+                return False
+            try:
+                self.string.append(chr(int(buf[pos + 2:pos + 6], 16)))
+                self.pos = pos + 6
+                return True
+            except ValueError:
+                pass
+        if char not in ESCAPES:
+            self.repairs.add("bad escape")
+        self.string.append(ESCAPES.get(char, char))
+        self.pos = pos + 2
+        return True
+
+    def string_closes(self, i: int, final: bool) -> Optional[bool]:
+        # A quote ends the string only if JSON structure follows it; otherwise it is part of the text.
+        # None: not enough input yet to tell.
+        buf = self.buf
+        i = next_significant(buf, i)
+        if i >= len(buf):
+            return True if final else None
+        char = buf[i]
+        if char in ":}]/" or char == self.quote:
+            return True
+        if char != ",":
+            return False
+        i = next_significant(buf, i + 1)
+        if i >= len(buf):
+            return True if final else None
+        char = buf[i]
+        if char in "\"'{[]}-" or char.isdigit() or buf.startswith(("true", "false", "null"), i):
+            return True
+        # A bare key ("..., name: ...") also counts
+        end = WORD.match(buf, i).end()
+        if end == i:
+            return False
+        end = next_significant(buf, end)
+        if end >= len(buf):
+            return final or None
+        return buf[end] == ":"
+
+    def skip_comment(self, final: bool) -> bool:
+        buf, pos = self.buf, self.pos
+        if pos + 1 >= len(buf):
+            if final:
+                self.pos = len(buf)
+            return final
+        if buf[pos + 1] == "/":
+            end = buf.find("\n", pos)
+            skip_to = end + 1 if end != -1 else len(buf)
+        elif buf[pos + 1] == "*":
+            end = buf.find("*/", pos + 2)
+            skip_to = end + 2 if end != -1 else len(buf)
+        else:
+            end, skip_to = pos, pos + 1
+        if end == -1 and not final:
+            return False
+        self.repairs.add("comments")
+        self.pos = skip_to
+        return True
+
+    def scan_word(self, final: bool) -> bool:
+        # Numbers, literals and bare words (unquoted keys or values)
+        match = WORD.match(self.buf, self.pos)
+        word = match.group()
+        if match.end() >= len(self.buf) and not final:
+            return False
+        if not word:
+            self.repairs.add("stray characters")
+            self.pos += 1
+            return True
+        self.pos = match.end()
+        frame = self.stack[-1]
+        if isinstance(frame.container, dict) and frame.expect == "key":
+            self.repairs.add("bare key")
+            self.add(word)
+        elif word in LITERALS:
+            if word[0].isupper():
+                self.repairs.add("python literals")
+            self.add(LITERALS[word])
+        else:
+            try:
+                self.add(json.loads(word))
+            except ValueError:
+                self.repairs.add("bare word")
+                self.add(word)
+        return True
+
+def next_significant(buf: str, i: int) -> int:
+    while i < len(buf) and buf[i] in WHITESPACE:
+        i += 1
+    return i
+
+def loads(text: str) -> Any:
+    # One-shot tolerant parse; None if the text holds no object or array
+    parser = Parser()
+    parser.feed(text)
+    parser.close()
+    return parser.value
+
+async def fields(source: AsyncIterator[str], parser: Parser) -> AsyncIterator[Tuple[Path, Any]]:
+    # Feeds a stream of deltas through the parser, yielding values as they close
+    async for content in source:
+        for field in parser.feed(content):
+            yield field
+    for field in parser.close():
+        yield field
+
+async def result(events: AsyncIterator[dict]) -> Any:
+    # Non-streaming callers of a structured endpoint only want the final {"result": ...}
+    value = None
+    async for event in events:
+        if "result" in event:
+            value = event["result"]
+    return value
@@ -0,0 +1,224 @@
+import asyncio
+import time
+from typing import AsyncIterator, Dict, Optional, Tuple
+
+import httpx
+
+import database
+import llm_cache
+import router
+import scheduler
+import sse
+from broadcast import Broadcast
+from defaults import DEFAULT_LLM_CLIENT
+
+DEFAULT_MODEL = "model-identifier"
+
+# App-scoped client shared by every /ai/* handler so requests reuse warm
+# keep-alive connections to the model server instead of reconnecting per call.
+client: Optional[httpx.AsyncClient] = None
+config = dict(DEFAULT_LLM_CLIENT)
+
+# In-flight upstream work by request key (see call_llm / stream_llm)
+inflight: Dict[str, asyncio.Future] = {}
+streams: Dict[str, Broadcast] = {}
+stats = {"calls": 0, "coalesced_calls": 0, "streams": 0, "coalesced_streams": 0}
+
+
+class LLMError(Exception):
+    def __init__(self, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def configure(overrides: Optional[dict] = None):
+    global config
+    config = {**DEFAULT_LLM_CLIENT, **(overrides or {})}
+    config["timeouts"] = {**DEFAULT_LLM_CLIENT["timeouts"], **(overrides or {}).get("timeouts", {})}
+
+
+def start_client(overrides: Optional[dict] = None):
+    global client
+    configure(overrides)
+    limits = httpx.Limits(
+        max_connections=config["max_connections"],
+        max_keepalive_connections=config["max_keepalive_connections"],
+        keepalive_expiry=config["keepalive_expiry"],
+    )
+    client = httpx.AsyncClient(
+        limits=limits,
+        timeout=httpx.Timeout(config["timeouts"]["default"], connect=config["connect_timeout"]),
+    )
+    return client
+
+
+async def close_client():
+    global client
+    if client is not None:
+        await client.aclose()
+        client = None
+
+
+def get_client() -> httpx.AsyncClient:
+    if client is None:
+        return start_client(config)
+    return client
+
+
+def timeout_for(endpoint: str) -> httpx.Timeout:
+    timeouts = config["timeouts"]
+    return httpx.Timeout(timeouts.get(endpoint, timeouts["default"]), connect=config["connect_timeout"])
+
+
+async def request_llm(url: str, payload: dict, endpoint: str) -> str:
+    # url names the pool when no llm_backends are configured; otherwise the router picks
+    tried = []
+    while True:
+        target = router.choose(url, tried)
+        tried.append(target.url)
+        try:
+            async with scheduler.slot(target.url, endpoint, target.max_slots):
+                start = time.monotonic()
+                resp = await get_client().post(target.url, json=target.payload(payload), timeout=timeout_for(endpoint))
+            if resp.status_code != 200:
+                raise LLMError(f"LLM Error: {resp.text}", resp.status_code)
+        except (httpx.TransportError, LLMError) as e:
+            if router.rejected_format(target, e, payload) or router.failed(target, e, tried, url):
+                continue
+            raise
+        target.succeeded(time.monotonic() - start)
+        data = resp.json()
+        return data["choices"][0]["message"]["content"]
+
+
+async def cached_reply(key: str, cache: Optional[bool]) -> Tuple[bool, Optional[str]]:
+    # cache: None = not cacheable, True = serve from the response cache, False = bypass the lookup but store the fresh reply
+    cacheable = cache is not None and llm_cache.cache.config()["enabled"]
+    if cacheable:
+        if cache:
+            return cacheable, await database.run_db(llm_cache.cache.get, key)
+        llm_cache.cache.bypassed()
+    return cacheable, None
+
+
+async def call_llm(url: str, messages: list, endpoint: str = "default", model: str = DEFAULT_MODEL, cache: Optional[bool] = None, **params) -> str:
+    key = llm_cache.make_key(url, model, messages, params)
+    cacheable, cached = await cached_reply(key, cache)
+    if cached is not None:
+        return cached
+
+    # Single flight: identical concurrent calls share one upstream request
+    task = inflight.get(key)
+    leader = task is None
+    if leader:
+        payload = {"model": model, "messages": messages, **params, "stream": False}
+        task = asyncio.ensure_future(request_llm(url, payload, endpoint))
+        inflight[key] = task
+        task.add_done_callback(lambda _: inflight.pop(key, None))
+        stats["calls"] += 1
+    else:
+        stats["coalesced_calls"] += 1
+
+    # Shielded so one caller going away does not fail the others
+    content = await asyncio.shield(task)
+    if leader and cacheable:
+        await database.run_db(llm_cache.cache.put, key, content)
+    return content
+
+
+async def deltas(response: httpx.Response) -> AsyncIterator[str]:
+    # Split raw bytes ourselves: cheaper than decoding every line to str first
+    pending = b""
+    async for chunk in response.aiter_bytes():
+        lines = (pending + chunk).split(b"\n")
+        pending = lines.pop()
+        for line in lines:
+            if not line.startswith(b"data: "):
+                continue
+            data_bytes = line[6:].strip()
+            if data_bytes == b"[DONE]":
+                return
+            try:
+                data = sse.loads(data_bytes)
+            except ValueError as e:
+                print(f"DEBUG: Parse Error in stream: {e} for line: {line!r}")
+                continue
+            # OpenAI Streaming format: choices[0].delta.content
+            choices = data.get("choices")
+            if choices:
+                content = choices[0].get("delta", {}).get("content")
+                if content:
+                    yield content
+
+
+async def open_stream(url: str, payload: dict, endpoint: str) -> AsyncIterator[str]:
+    # Fails over to another backend only until the first token; after that the client has seen output
+    tried = []
+    while True:
+        target = router.choose(url, tried)
+        tried.append(target.url)
+        started = False
+        try:
+            async with scheduler.slot(target.url, endpoint, target.max_slots):
+                start = time.monotonic()
+                async with get_client().stream("POST", target.url, json=target.payload(payload), timeout=timeout_for(endpoint)) as response:
+                    if response.status_code != 200:
+                        detail = (await response.aread()).decode(errors="replace")[:500]
+                        raise LLMError(f"LLM Error: {response.status_code} {detail}", response.status_code)
+                    async for content in deltas(response):
+                        if not started:
+                            started = True
+                            target.succeeded(time.monotonic() - start, streamed=True)
+                        yield content
+            return
+        except (httpx.TransportError, LLMError) as e:
+            if (not started and router.rejected_format(target, e, payload)) or router.failed(target, e, tried, url, retry=not started):
+                continue
+            raise
+
+
+async def pump(key: str, stream: Broadcast, url: str, payload: dict, endpoint: str):
+    try:
+        async for content in open_stream(url, payload, endpoint):
+            await stream.publish(content)
+        await stream.finish()
+    except asyncio.CancelledError:
+        await stream.finish(LLMError("LLM stream cancelled"))
+        raise
+    except Exception as e:
+        await stream.finish(e)
+    finally:
+        if streams.get(key) is stream:
+            del streams[key]
+
+
+async def stream_llm(url: str, messages: list, endpoint: str = "default", model: str = DEFAULT_MODEL, **params) -> AsyncIterator[str]:
+    # Identical concurrent streams share one upstream generation; late subscribers replay what they missed
+    key = llm_cache.make_key(url, model, messages, {**params, "stream": True})
+    stream = streams.get(key)
+    if stream is None or stream.abandoned:
+        stream = Broadcast()
+        streams[key] = stream
+        payload = {"model": model, "messages": messages, **params, "stream": True}
+        stream.task = asyncio.ensure_future(pump(key, stream, url, payload, endpoint))
+        stats["streams"] += 1
+    else:
+        stats["coalesced_streams"] += 1
+
+    async for content in stream.subscribe():
+        yield content
+
+
+async def stream_cached(url: str, messages: list, endpoint: str = "default", model: str = DEFAULT_MODEL, cache: Optional[bool] = None, **params) -> AsyncIterator[str]:
+    # stream_llm behind call_llm's response cache (same key): a hit arrives as one delta, a finished stream is stored
+    key = llm_cache.make_key(url, model, messages, params)
+    cacheable, cached = await cached_reply(key, cache)
+    if cached is not None:
+        yield cached
+        return
+    parts = []
+    async for content in stream_llm(url, messages, endpoint, model, **params):
+        parts.append(content)
+        yield content
+    if cacheable:
+        await database.run_db(llm_cache.cache.put, key, "".join(parts))
@@ -0,0 +1,119 @@
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Optional, Tuple
+import hashlib
+import json
+import threading
+import time
+
+import crud
+import settings_service
+from defaults import DEFAULT_LLM_CACHE
+
+# Content-addressed cache for complete LLM replies (non-streaming calls and
+# the streamed structured endpoints, see llm.stream_cached). The key covers
+# everything that determines the reply (url, model, messages, sampling
+# params), so edits to the bible or brief simply produce a new key. Hot
+# entries live in an in-memory LRU; the SQLite tier survives restarts and,
+# once it passes disk_bytes, drops the entries least recently stored or read
+# from disk. Its size is kept as a running total and only summed again when
+# a put takes the total over the limit.
+
+def make_key(url: str, model: str, messages: list, params: dict) -> str:
+    raw = json.dumps({"url": url, "model": model, "messages": messages, "params": params}, sort_keys=True)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+class ResponseCache:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.memory: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()  # key -> (value, expires monotonic)
+        self.memory_bytes = 0
+        self.disk_bytes: Optional[int] = None  # running total of the disk tier, summed once on first put
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "bypassed": 0,
+                      "memory_evictions": 0, "disk_evictions": 0}
+
+    def config(self) -> dict:
+        return {**DEFAULT_LLM_CACHE, **(settings_service.get("llm_cache") or {})}
+
+    def remember(self, key: str, value: str, ttl: float, cfg: dict):
+        # Caller holds the lock
+        if key in self.memory:
+            self.memory_bytes -= len(self.memory.pop(key)[0])
+        self.memory[key] = (value, time.monotonic() + ttl)
+        self.memory_bytes += len(value)
+        while self.memory and (len(self.memory) > cfg["memory_entries"] or self.memory_bytes > cfg["memory_bytes"]):
+            _, (old, _) = self.memory.popitem(last=False)
+            self.memory_bytes -= len(old)
+            self.stats["memory_evictions"] += 1
+
+    def get(self, key: str) -> Optional[str]:
+        # Blocking (disk tier); async callers go through database.run_db
+        cfg = self.config()
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None:
+                if entry[1] > time.monotonic():
+                    self.memory.move_to_end(key)
+                    self.stats["memory_hits"] += 1
+                    return entry[0]
+                self.memory_bytes -= len(self.memory.pop(key)[0])
+
+        now = datetime.utcnow()
+        row = crud.get_llm_cache_entry(key, now)
+        with self.lock:
+            if row is None:
+                self.stats["misses"] += 1
+                return None
+            self.stats["disk_hits"] += 1
+            # Promoted with what is left of the stored lifetime, not a fresh ttl
+            value, expires_at = row
+            self.remember(key, value, (expires_at - now).total_seconds(), cfg)
+            return value
+
+    def put(self, key: str, value: str, ttl: Optional[float] = None):
+        cfg = self.config()
+        ttl = cfg["ttl"] if ttl is None else ttl
+        with self.lock:
+            self.remember(key, value, ttl, cfg)
+            self.stats["stores"] += 1
+        added = crud.put_llm_cache_entry(key, value, datetime.utcnow() + timedelta(seconds=ttl))
+        with self.lock:
+            if self.disk_bytes is not None:
+                self.disk_bytes += added
+            total = self.disk_bytes
+        if total is None:
+            total = crud.get_llm_cache_size()
+            with self.lock:
+                if self.disk_bytes is None:
+                    self.disk_bytes = total
+        if total > cfg["disk_bytes"]:
+            # Other processes share the table, so the exact size is checked before evicting
+            evicted, total = crud.evict_llm_cache(cfg["disk_bytes"])
+            with self.lock:
+                self.stats["disk_evictions"] += evicted
+                self.disk_bytes = total
+
+    def bypassed(self):
+        with self.lock:
+            self.stats["bypassed"] += 1
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+            self.memory_bytes = 0
+            self.disk_bytes = 0
+        crud.clear_llm_cache()
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            lookups = self.stats["memory_hits"] + self.stats["disk_hits"] + self.stats["misses"]
+            hits = self.stats["memory_hits"] + self.stats["disk_hits"]
+            return {
+                **self.stats,
+                "hit_rate": round(hits / lookups, 3) if lookups else None,
+                "memory_entries": len(self.memory),
+                "memory_bytes": self.memory_bytes,
+                "disk_bytes": self.disk_bytes,
+            }
+
+cache = ResponseCache()
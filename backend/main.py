@@ -1,7 +1,9 @@
-from fastapi import FastAPI, HTTPException, Body
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Body, Query, Depends, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from typing import List, Any
-import crud, models, database, json
+from fastapi.responses import JSONResponse
+from typing import List, Any, Optional
+from sqlmodel import Session
+import asyncio, bible_context, chapter_pipeline, context_packer, crud, models, database, etags, jobs, json, json_stream, llm, llm_cache, prompt_layout, retrieval, router, scheduler, settings_service, sse, structured, summaries, writer
 
 app = FastAPI(title="Story Writing Agent API")
 
@@ -12,8 +14,13 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "Retry-After", "X-Generation-Id", "X-Pipeline-Id"],
 )
 
+@app.exception_handler(scheduler.Overloaded)
+async def llm_overloaded(request: Request, exc: scheduler.Overloaded):
+    return JSONResponse(status_code=429, content={"detail": str(exc)}, headers={"Retry-After": str(exc.retry_after)})
+
 @app.on_event("startup")
 def on_startup():
     database.create_db_and_tables()
@@ -74,23 +81,67 @@ def on_startup():
     if not existing:
         crud.set_global_setting("bible_schema", default_schema)
 
+    # Shared LLM client, optionally tuned via the "llm_client" setting
+    llm.start_client(settings_service.get("llm_client"))
+    # Health checks for the llm_backends pool, if one is configured
+    router.start(llm.get_client)
+
+    # Generations cut off by a restart stay replayable but are marked interrupted
+    jobs.startup()
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    await router.stop()
+    await llm.close_client()
+    database.db_executor.shutdown(wait=False)
+
+def story_etag(resource: str, story_id: int):
+    revision = crud.get_story_revision(story_id)
+    return etags.make(resource, story_id, revision) if revision is not None else None
+
 @app.get("/stories", response_model=List[models.Story])
-def read_stories():
+def read_stories(request: Request, response: Response):
+    etag = etags.make("stories", *crud.get_stories_fingerprint())
+    if etags.matches(request, etag):
+        return etags.not_modified(etag)
+    etags.tag(response, etag)
     return crud.get_stories()
 
 @app.post("/stories", response_model=models.Story)
-def create_story(story: models.Story):
-    return crud.create_story(story)
+def create_story(story: models.Story, session: Session = Depends(database.get_session)):
+    return crud.create_story(story, session)
 
 @app.get("/stories/{story_id}/bible", response_model=List[models.BibleElement])
-def read_bible_elements(story_id: int):
-    from sqlmodel import Session, select
-    with Session(database.engine) as session:
-        return session.exec(select(models.BibleElement).where(models.BibleElement.story_id == story_id, models.BibleElement.is_deleted == False)).all()
+def read_bible_elements(story_id: int, request: Request, response: Response):
+    etag = story_etag("bible", story_id)
+    if etags.matches(request, etag):
+        return etags.not_modified(etag)
+    etags.tag(response, etag)
+    return crud.get_bible_elements(story_id)
+
+@app.get("/stories/{story_id}/bible/summary", response_model=List[models.BibleElementSummary])
+def read_bible_summaries(story_id: int, request: Request, response: Response):
+    etag = story_etag("bible-summary", story_id)
+    if etags.matches(request, etag):
+        return etags.not_modified(etag)
+    etags.tag(response, etag)
+    return crud.get_bible_summaries(story_id)
+
+@app.get("/bible/{element_id}", response_model=models.BibleElement)
+def read_bible_element(element_id: int, request: Request, response: Response):
+    revision = crud.get_bible_element_revision(element_id)
+    etag = etags.make("bible-element", element_id, revision) if revision is not None else None
+    if etags.matches(request, etag):
+        return etags.not_modified(etag)
+    etags.tag(response, etag)
+    element = crud.get_bible_element(element_id)
+    if not element:
+        raise HTTPException(status_code=404, detail="Element not found")
+    return element
 
 @app.post("/bible", response_model=models.BibleElement)
-def create_bible_element(element: models.BibleElement):
-    return crud.create_bible_element(element)
+def create_bible_element(element: models.BibleElement, session: Session = Depends(database.get_session)):
+    return crud.create_bible_element(element, session)
 
 @app.put("/bible/{element_id}", response_model=models.BibleElement)
 def update_bible_element(element_id: int, element: models.BibleElement):
@@ -100,14 +151,40 @@ def update_bible_element(element_id: int, element: models.BibleElement):
     return updated
 
 @app.get("/stories/{story_id}/chapters", response_model=List[models.Chapter])
-def read_chapters(story_id: int):
-    from sqlmodel import Session, select
-    with Session(database.engine) as session:
-        return session.exec(select(models.Chapter).where(models.Chapter.story_id == story_id, models.Chapter.is_deleted == False).order_by(models.Chapter.order)).all()
+def read_chapters(story_id: int, request: Request, response: Response):
+    etag = story_etag("chapters", story_id)
+    if etags.matches(request, etag):
+        return etags.not_modified(etag)
+    etags.tag(response, etag)
+    return crud.get_chapters(story_id)
+
+@app.get("/stories/{story_id}/chapters/summary", response_model=List[models.ChapterSummary])
+def read_chapter_summaries(story_id: int, request: Request, response: Response):
+    etag = story_etag("chapters-summary", story_id)
+    if etags.matches(request, etag):
+        return etags.not_modified(etag)
+    etags.tag(response, etag)
+    return crud.get_chapter_summaries(story_id)
+
+@app.get("/stories/{story_id}/search")
+def search_story(story_id: int, q: str = Query(..., min_length=1), limit: int = Query(10, ge=1, le=100)):
+    return retrieval.search(story_id, q, limit)
+
+@app.get("/chapters/{chapter_id}", response_model=models.Chapter)
+def read_chapter(chapter_id: int, request: Request, response: Response):
+    revision = crud.get_chapter_revision(chapter_id)
+    etag = etags.make("chapter", chapter_id, revision) if revision is not None else None
+    if etags.matches(request, etag):
+        return etags.not_modified(etag)
+    etags.tag(response, etag)
+    chapter = crud.get_chapter(chapter_id)
+    if not chapter:
+        raise HTTPException(status_code=404, detail="Chapter not found")
+    return chapter
 
 @app.post("/chapters", response_model=models.Chapter)
-def create_chapter(chapter: models.Chapter):
-    return crud.create_chapter(chapter)
+def create_chapter(chapter: models.Chapter, session: Session = Depends(database.get_session)):
+    return crud.create_chapter(chapter, session)
 
 @app.put("/chapters/{chapter_id}", response_model=models.Chapter)
 def update_chapter(chapter_id: int, chapter: models.Chapter):
@@ -116,63 +193,106 @@ def update_chapter(chapter_id: int, chapter: models.Chapter):
         raise HTTPException(status_code=404, detail="Chapter not found")
     return updated
 
-@app.get("/chapters/{chapter_id}/history", response_model=List[models.VersionHistory])
-def read_chapter_history(chapter_id: int):
-    from sqlmodel import Session, select
-    with Session(database.engine) as session:
-        return session.exec(select(models.VersionHistory).where(models.VersionHistory.chapter_id == chapter_id).order_by(models.VersionHistory.version.desc())).all()
-
-@app.get("/bible/{element_id}/history", response_model=List[models.VersionHistory])
-def read_bible_history(element_id: int):
-    from sqlmodel import Session, select
-    with Session(database.engine) as session:
-        return session.exec(select(models.VersionHistory).where(models.VersionHistory.bible_element_id == element_id).order_by(models.VersionHistory.version.desc())).all()
+@app.get("/chapters/{chapter_id}/history", response_model=List[models.VersionHistoryRead])
+def read_chapter_history(chapter_id: int, request: Request, response: Response):
+    etag = etags.make("chapter-history", chapter_id, *crud.get_history_fingerprint(chapter_id=chapter_id))
+    if etags.matches(request, etag):
+        return etags.not_modified(etag)
+    etags.tag(response, etag)
+    return crud.get_chapter_history(chapter_id)
+
+@app.get("/bible/{element_id}/history", response_model=List[models.VersionHistoryRead])
+def read_bible_history(element_id: int, request: Request, response: Response):
+    etag = etags.make("bible-history", element_id, *crud.get_history_fingerprint(bible_element_id=element_id))
+    if etags.matches(request, etag):
+        return etags.not_modified(etag)
+    etags.tag(response, etag)
+    return crud.get_bible_history(element_id)
+
+# Lightweight history: metadata pages plus on-demand content per version
+@app.get("/chapters/{chapter_id}/versions", response_model=models.VersionPage)
+def list_chapter_versions(chapter_id: int, request: Request, response: Response, cursor: Optional[int] = None, limit: int = Query(50, ge=1, le=500)):
+    etag = etags.make("chapter-versions", chapter_id, *crud.get_history_fingerprint(chapter_id=chapter_id), cursor, limit)
+    if etags.matches(request, etag):
+        return etags.not_modified(etag)
+    etags.tag(response, etag)
+    return crud.get_chapter_versions(chapter_id, cursor, limit)
+
+@app.get("/chapters/{chapter_id}/versions/{version}", response_model=models.VersionHistoryRead)
+def read_chapter_version(chapter_id: int, version: int, request: Request, response: Response):
+    # History rows are immutable, so the tag needs no lookup at all
+    etag = etags.make("chapter", chapter_id, "v", version)
+    if etags.matches(request, etag):
+        return etags.not_modified(etag)
+    found = crud.get_chapter_version(chapter_id, version)
+    if not found:
+        raise HTTPException(status_code=404, detail="Version not found")
+    etags.tag(response, etag)
+    return found
+
+@app.get("/bible/{element_id}/versions", response_model=models.VersionPage)
+def list_bible_versions(element_id: int, request: Request, response: Response, cursor: Optional[int] = None, limit: int = Query(50, ge=1, le=500)):
+    etag = etags.make("bible-versions", element_id, *crud.get_history_fingerprint(bible_element_id=element_id), cursor, limit)
+    if etags.matches(request, etag):
+        return etags.not_modified(etag)
+    etags.tag(response, etag)
+    return crud.get_bible_versions(element_id, cursor, limit)
+
+@app.get("/bible/{element_id}/versions/{version}", response_model=models.VersionHistoryRead)
+def read_bible_version(element_id: int, version: int, request: Request, response: Response):
+    etag = etags.make("bible-element", element_id, "v", version)
+    if etags.matches(request, etag):
+        return etags.not_modified(etag)
+    found = crud.get_bible_version(element_id, version)
+    if not found:
+        raise HTTPException(status_code=404, detail="Version not found")
+    etags.tag(response, etag)
+    return found
 
 @app.delete("/stories/{story_id}")
-def delete_story(story_id: int):
-    if not crud.delete_story(story_id):
+def delete_story(story_id: int, session: Session = Depends(database.get_session)):
+    if not crud.delete_story(story_id, session):
         raise HTTPException(status_code=404, detail="Story not found")
     return {"message": "Story deleted"}
 
 @app.delete("/bible/{element_id}")
-def delete_bible_element(element_id: int):
-    if not crud.delete_bible_element(element_id):
+def delete_bible_element(element_id: int, session: Session = Depends(database.get_session)):
+    if not crud.delete_bible_element(element_id, session):
         raise HTTPException(status_code=404, detail="Element not found")
     return {"message": "Element deleted"}
 
 @app.delete("/chapters/{chapter_id}")
-def delete_chapter(chapter_id: int):
-    if not crud.delete_chapter(chapter_id):
+def delete_chapter(chapter_id: int, session: Session = Depends(database.get_session)):
+    if not crud.delete_chapter(chapter_id, session):
         raise HTTPException(status_code=404, detail="Chapter not found")
     return {"message": "Chapter deleted"}
 
 @app.get("/settings")
-def read_all_settings():
-    settings = crud.get_all_global_settings()
-    result = {}
-    for s in settings:
-        try:
-            result[s.key] = json.loads(s.value)
-        except:
-            result[s.key] = s.value
-    return result
+def read_all_settings(request: Request, response: Response):
+    etag = settings_service.etag()
+    if etags.matches(request, etag):
+        return etags.not_modified(etag)
+    etags.tag(response, etag)
+    return settings_service.get_all()
 
 @app.get("/settings/{key}")
-def read_setting(key: str):
-    setting = crud.get_global_setting(key)
-    if not setting:
+def read_setting(key: str, request: Request, response: Response):
+    etag = settings_service.etag(key)
+    if etag is None:
         raise HTTPException(status_code=404, detail="Setting not found")
-    return json.loads(setting.value)
+    if etags.matches(request, etag):
+        return etags.not_modified(etag)
+    etags.tag(response, etag)
+    return settings_service.get(key)
 
 @app.post("/settings/{key}")
-def update_setting(key: str, value: Any = Body(...)):
+def update_setting(key: str, value: Any = Body(...), session: Session = Depends(database.get_session)):
     print(f"DEBUG: Received update for setting '{key}': {value}")
-    crud.set_global_setting(key, value)
+    crud.set_global_setting(key, value, session)
     return {"message": "Setting updated"}
 
 @app.post("/ai/generate-chapter")
-async def generate_chapter(payload: dict):
-    from fastapi.responses import StreamingResponse
+async def generate_chapter(payload: dict, request: Request):
     story_id = payload.get("story_id")
     description = payload.get("description")
     
@@ -180,191 +300,127 @@ async def generate_chapter(payload: dict):
         raise HTTPException(status_code=400, detail="Missing story_id or description")
     
     # 1. Fetch Bible Context
-    with models.Session(database.engine) as session:
-        elements = session.exec(
-            models.select(models.BibleElement).where(
-                models.BibleElement.story_id == story_id, 
-                models.BibleElement.is_deleted == False
-            )
-        ).all()
-    
-    bible_context = "\n".join([f"### {el.type.capitalize()}: {el.name}\n{el.content}" for el in elements])
+    context = await database.run_db(bible_context.get_story_context, story_id)
     
-    llm_url_setting = crud.get_global_setting("llm_url")
-    system_prompt_setting = crud.get_global_setting("llm_system_prompt")
-    
-    def parse_setting(setting, default):
-        if not setting: return default
-        try:
-            val = json.loads(setting.value)
-            if isinstance(val, str):
-                return val.strip('"').strip("'")
-            return val if val else default
-        except:
-            if isinstance(setting.value, str):
-                return setting.value.strip('"').strip("'")
-            return setting.value if setting.value else default
-
-    url = parse_setting(llm_url_setting, "http://localhost:1234/v1/chat/completions")
-    sys_prompt = parse_setting(system_prompt_setting, "You are a creative writing assistant.")
+    url = await settings_service.get_llm_url_async()
+    sys_prompt = await settings_service.get_system_prompt_async()
     
     print(f"DEBUG: Using LLM URL for streaming: {url}")
+    router.check(url)
     
-    # 2. Construct Messages
-    messages = [
-        {"role": "system", "content": sys_prompt},
-        {"role": "user", "content": f"STORY BIBLE CONTEXT:\n{bible_context}\n\nTASK:\nWrite a chapter based on this description: {description}"}
-    ]
+    # 2. Pack the bible into the model's budget
+    task = "Write a chapter based on the chapter description."
+    packed = context_packer.pack([
+        context_packer.Section("description", description, context_packer.REQUIRED),
+        *prompt_layout.bible_sections(context, context.ordered()),
+    ], router.model(url), overhead=sys_prompt + task)
+    context_packer.log_report("generate_chapter", packed.report)
     
-    async def sse_generator():
-        import httpx
-        try:
-            async with httpx.AsyncClient() as client:
-                async with client.stream("POST", url, json={
-                    "model": "model-identifier",
-                    "messages": messages,
-                    "stream": True # Enable streaming
-                }, timeout=120.0) as response:
-                    
-                    if response.status_code != 200:
-                        yield f"data: {json.dumps({'error': f'LLM Error: {response.status_code}'})}\n\n"
-                        return
-
-                    async for line in response.aiter_lines():
-                        if not line: continue
-                        if line.startswith("data: "):
-                            data_str = line[6:].strip()
-                            if data_str == "[DONE]": break
-                            try:
-                                data = json.loads(data_str)
-                                # OpenAI Streaming format: choices[0].delta.content
-                                if "choices" in data and len(data["choices"]) > 0:
-                                    delta = data["choices"][0].get("delta", {})
-                                    if "content" in delta:
-                                        yield f"data: {json.dumps({'content': delta['content']})}\n\n"
-                            except Exception as e:
-                                print(f"DEBUG: Parse Error in stream: {e} for line: {line}")
-                                continue
-        except Exception as e:
-            print(f"ERROR in streaming generator: {str(e)}")
-            yield f"data: {json.dumps({'error': str(e)})}\n\n"
-
-    return StreamingResponse(sse_generator(), media_type="text/event-stream")
+    # 3. Construct Messages (same stable prefix as the outline and prose prompts)
+    messages = prompt_layout.messages(sys_prompt, [
+        ("BIBLE CONTEXT", packed.group_text("bible")),
+        ("CHAPTER DESCRIPTION", description),
+    ], task)
+    
+    job = await jobs.start("generate_chapter", story_id, llm.stream_llm(url, messages, "generate_chapter"))
+    return jobs.response(job, prelude=[{"context_report": packed.report}], request=request)
 
 # --- New Chapter Workflow Endpoints ---
 
 from pydantic import BaseModel
 from typing import Optional
 
+def structured_response(events, request: Request, label: str):
+    # stream=true on the JSON endpoints: field events over SSE instead of one response at the end
+    from fastapi.responses import StreamingResponse
+    stream = jobs.until_disconnected(request, sse.structured(events, label), label)
+    return StreamingResponse(stream, media_type="text/event-stream")
+
 class SmartContextRequest(BaseModel):
     story_id: int
     chapter_brief: str
+    retrieval_mode: Optional[str] = None  # "llm" | "lexical" | "hybrid"; defaults to the "retrieval" setting
+    no_cache: bool = False  # skip the LLM response cache and fetch a fresh answer
+    stream: bool = False  # SSE: {"path": [...], "value": ...} as fields close, then {"result": ...}
+    structured: Optional[bool] = None  # constrain the reply to a JSON schema; defaults to the "structured_output" setting
 
 @app.post("/ai/smart-context")
-async def get_smart_context(payload: SmartContextRequest):
-    story_id = payload.story_id
-    brief = payload.chapter_brief
-    
-    # 1. Fetch Bible Elements and Story Settings
-    from sqlmodel import select
-    with models.Session(database.engine) as session:
-        elements = session.exec(select(models.BibleElement).where(models.BibleElement.story_id == story_id, models.BibleElement.is_deleted == False)).all()
-        chapters = session.exec(select(models.Chapter).where(models.Chapter.story_id == story_id, models.Chapter.is_deleted == False).order_by(models.Chapter.order)).all()
-        
-    bible_catalog = "\n".join([f"- {el.name} ({el.type})" for el in elements])
-    
-    # 2. Get Story So Far Summary (using last few chapters if available)
-    if chapters:
-        chapter_list = "\n".join([f"{c.order}. {c.title}" for c in chapters])
-        last_chapter_content = chapters[-1].content
-    else:
-        chapter_list = "NONE (This is the first chapter)"
-        last_chapter_content = "N/A"
-    
-    # 3. Construct Prompt
-    llm_url = crud.get_global_setting("llm_url")
-    # Helper to parse setting since it might be JSON string
-    def parse_url(s): 
-        if not s: return "http://localhost:1234/v1/chat/completions"
-        try: 
-            v = json.loads(s.value)
-            return v if isinstance(v, str) else s.value
-        except: return s.value
-            
-    url = parse_url(llm_url)
-    
-    system_prompt = """You are a story bible manager and continuity assistant. 
-    Your job is to analyze a new chapter brief and the existing story context to:
-    1. Write a "Story So Far" summary ensuring the new chapter fits the continuity.
-       - IF there are no previous chapters, "story_so_far" MUST be exactly "Start of Story".
-    2. Select relevant existing story bible elements that should be in the context.
-    3. Suggest NEW story bible elements that should be created based on the brief.
-    
-    Return pure JSON with this structure:
-    {
-        "story_so_far": "High level summary of previous events...",
-        "relevant_elements": ["Exact Name 1", "Exact Name 2"],
-        "suggested_new_elements": [
-            {"name": "New Character/Place", "type": "character|location|etc", "reason": "Why it is needed"}
-        ]
-    }"""
-    
-    user_prompt = f"""
-    EXISTING BIBLE ELEMENTS:
-    {bible_catalog}
-    
-    PREVIOUS CHAPTERS:
-    {chapter_list}
-    
-    LAST CHAPTER CONTENT:
-    {last_chapter_content}
-    
-    NEW CHAPTER BRIEF:
-    {brief}
-    """
-    
-    # Call LLM
-    import httpx
+async def get_smart_context(payload: SmartContextRequest, request: Request):
     try:
-        async with httpx.AsyncClient() as client:
-            resp = await client.post(url, json={
-                "model": "model-identifier",
-                "messages": [
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt}
-                ],
-                "temperature": 0.7,
-                "stream": False 
-            }, timeout=180.0)
-            
-            if resp.status_code != 200:
-                raise HTTPException(status_code=500, detail=f"LLM Error: {resp.text}")
-                
-            data = resp.json()
-            content = data["choices"][0]["message"]["content"]
-            
-            # extract JSON from content
-            try:
-                # Find first { and last }
-                start = content.find('{')
-                end = content.rfind('}') + 1
-                if start != -1 and end != -1:
-                    json_str = content[start:end]
-                    return json.loads(json_str)
-                else:
-                    raise Exception("No JSON found")
-            except Exception as e:
-                # Fallback if specific schema fails
-                return {
-                    "story_so_far": "Could not generate summary.",
-                    "relevant_elements": [],
-                    "suggested_new_elements": [],
-                    "raw_response": content
-                }
-                
+        snap = await chapter_pipeline.snapshot(payload.story_id)
+        events = chapter_pipeline.smart_context_events(payload.story_id, snap, payload.chapter_brief, payload.retrieval_mode, payload.no_cache, payload.structured)
+        if payload.stream:
+            router.check(snap.url)
+            return structured_response(events, request, "smart_context")
+        return await json_stream.result(events)
+    except scheduler.Overloaded:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/ai/stats")
+async def read_ai_stats():
+    # On the loop, like the scheduler and router state it reads
+    return {"llm": llm.stats, "backends": router.snapshot(), "scheduler": scheduler.snapshot(), "llm_cache": llm_cache.cache.snapshot(),
+            "structured_output": structured.snapshot(), "write_queue": writer.write_queue.stats}
+
+@app.delete("/ai/cache")
+def clear_ai_cache():
+    llm_cache.cache.clear()
+    return {"message": "Cache cleared"}
+
+@app.get("/ai/jobs/{job_id}")
+async def read_generation_job(job_id: str):
+    job = jobs.get(job_id)
+    if job:
+        return {"id": job.id, "endpoint": job.endpoint, "story_id": job.story_id, "status": job.status, "error": job.error, "content": job.text()}
+    record = await database.run_db(crud.get_generation_job, job_id)
+    if not record:
+        raise HTTPException(status_code=404, detail="Generation not found")
+    return record
+
+@app.get("/ai/jobs/{job_id}/stream")
+async def resume_generation_job(job_id: str, request: Request, offset: Optional[int] = Query(None, ge=0)):
+    # Reconnect with Last-Event-ID (or ?offset=) to replay missed text, then follow live
+    if offset is None:
+        offset = jobs.parse_last_event_id(request.headers.get("last-event-id"), job_id)
+    job = jobs.get(job_id)
+    if job:
+        return jobs.response(job, offset, request=request)
+    record = await database.run_db(crud.get_generation_job, job_id)
+    if not record:
+        raise HTTPException(status_code=404, detail="Generation not found")
+    return jobs.record_response(record, offset)
+
+@app.post("/ai/jobs/{job_id}/cancel")
+async def cancel_generation_job(job_id: str):
+    # Stop button: closes the upstream request now instead of letting it run to the end
+    job = jobs.get(job_id)
+    if job is None:
+        record = await database.run_db(crud.get_generation_job, job_id)
+        if not record:
+            raise HTTPException(status_code=404, detail="Generation not found")
+        return {"id": job_id, "status": record.status, "cancelled": False}
+    cancelled = job.cancel("cancel requested")
+    if job.task is not None:
+        await asyncio.wait({job.task})
+    return {"id": job_id, "status": job.status, "cancelled": cancelled, "length": job.length}
+
+class StorySummaryRequest(BaseModel):
+    story_id: int
+    wait: bool = False  # summarize now and return the result instead of scheduling it
+
+@app.post("/ai/summarize-story")
+async def summarize_story(payload: StorySummaryRequest, background_tasks: BackgroundTasks):
+    # Warms the chapter summary cache so the next smart-context call does no summarizing
+    if payload.wait:
+        try:
+            return {"story_so_far": await summaries.story_so_far(payload.story_id) or "Start of Story"}
+        except llm.LLMError as e:
+            raise HTTPException(status_code=500, detail=str(e))
+    background_tasks.add_task(summaries.story_so_far, payload.story_id)
+    return {"message": "Summarization scheduled"}
+
 
 class GenerateOutlineRequest(BaseModel):
     story_id: int
@@ -372,90 +428,24 @@ class GenerateOutlineRequest(BaseModel):
     chapter_brief: str
     current_outline: Optional[str] = None
     comments: Optional[str] = None
+    no_cache: bool = False
 
 @app.post("/ai/generate-outline")
 async def generate_outline(payload: GenerateOutlineRequest):
-    from sqlmodel import select
     # Retrieve full content of relevant bible elements
-    with models.Session(database.engine) as session:
-        elements = session.exec(select(models.BibleElement).where(models.BibleElement.story_id == payload.story_id, models.BibleElement.is_deleted == False)).all()
-        
-    # Filter elements if relevant_elements is provided in smart_context
-    relevant_names = payload.smart_context.get("relevant_elements", [])
-    relevant_context = ""
-    if relevant_names:
-        lower_names = [n.lower() for n in relevant_names]
-        filtered = [el for el in elements if el.name.lower() in lower_names]
-        relevant_context = "\n".join([f"### {el.type.capitalize()}: {el.name}\n{el.content}" for el in filtered])
-    else:
-        relevant_context = "\n".join([f"### {el.type.capitalize()}: {el.name}\n{el.content}" for el in elements])
-
-    story_so_far = payload.smart_context.get("story_so_far", "")
-    
-    system_prompt = "You are an expert story outliner. Create a structured outline for the chapter."
-    
-    if payload.current_outline:
-         user_prompt = f"""
-        STORY SO FAR:
-        {story_so_far}
-        
-        BIBLE CONTEXT:
-        {relevant_context}
-        
-        CHAPTER BRIEF:
-        {payload.chapter_brief}
-        
-        CURRENT OUTLINE:
-        {payload.current_outline}
-        
-        USER FEEDBACK/INSTRUCTIONS:
-        {payload.comments}
-        
-        TASK:
-        Refine the current outline based on the feedback. Maintain the structure but improve the content.
-        """
-    else:
-        user_prompt = f"""
-        STORY SO FAR:
-        {story_so_far}
-        
-        BIBLE CONTEXT:
-        {relevant_context}
-        
-        CHAPTER BRIEF:
-        {payload.chapter_brief}
-        
-        TASK:
-        Create a detailed step-by-step outline for this chapter. 
-        Focus on pacing, key beats, and character moments.
-        """
+    context = await database.run_db(bible_context.get_story_context, payload.story_id)
+    system = await settings_service.get_system_prompt_async()
+    url = await settings_service.get_llm_url_async()
+    messages, packed = chapter_pipeline.outline_prompt(context, system, payload.smart_context, payload.chapter_brief, payload.current_outline,
+                                                       payload.comments, router.model(url))
 
     # Call LLM
-    llm_url = crud.get_global_setting("llm_url")
-    def parse_url(s): 
-        if not s: return "http://localhost:1234/v1/chat/completions"
-        try: 
-            v = json.loads(s.value)
-            return v if isinstance(v, str) else s.value
-        except: return s.value
-    url = parse_url(llm_url)
-
-    import httpx
-    async with httpx.AsyncClient() as client:
-        resp = await client.post(url, json={
-            "model": "model-identifier",
-            "messages": [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
-            "stream": False
-        }, timeout=180.0)
-        
-        if resp.status_code != 200:
-            raise HTTPException(status_code=500, detail=resp.text)
-            
-        data = resp.json()
-        return {"outline": data["choices"][0]["message"]["content"]}
+
+    try:
+        content = await llm.call_llm(url, messages, "generate_outline", cache=not payload.no_cache)
+    except llm.LLMError as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    return {"outline": content, "context_report": packed.report}
 
 class WriteChapterRequest(BaseModel):
     story_id: int
@@ -465,131 +455,75 @@ class WriteChapterRequest(BaseModel):
     comments: Optional[str] = None
 
 @app.post("/ai/write-chapter-v2")
-async def write_chapter_v2(payload: WriteChapterRequest):
+async def write_chapter_v2(payload: WriteChapterRequest, request: Request):
+    context = await database.run_db(bible_context.get_story_context, payload.story_id)
+    system = await settings_service.get_system_prompt_async()
+    url = await settings_service.get_llm_url_async()
+    messages, packed = chapter_pipeline.prose_prompt(context, system, payload.smart_context, payload.outline, payload.current_content,
+                                                     payload.comments, router.model(url))
+    router.check(url)
+    
+    job = await jobs.start("write_chapter_v2", payload.story_id, llm.stream_llm(url, messages, "write_chapter_v2"))
+    return jobs.response(job, prelude=[{"context_report": packed.report}], request=request)
+
+class ChapterPipelineRequest(BaseModel):
+    story_id: int
+    chapter_brief: str
+    outline: Optional[str] = None  # skip the outline stage and write from this one
+    pause_after: List[str] = []  # "context" and/or "outline": wait for edits via /ai/chapter-pipeline/{id}/resume
+    retrieval_mode: Optional[str] = None
+    no_cache: bool = False
+    structured: Optional[bool] = None
+
+@app.post("/ai/chapter-pipeline")
+async def run_chapter_pipeline(payload: ChapterPipelineRequest, request: Request):
     from fastapi.responses import StreamingResponse
-    from sqlmodel import select
-    
-    with models.Session(database.engine) as session:
-        elements = session.exec(select(models.BibleElement).where(models.BibleElement.story_id == payload.story_id, models.BibleElement.is_deleted == False)).all()
-        
-    relevant_names = payload.smart_context.get("relevant_elements", [])
-    relevant_context = ""
-    # Always include Story Settings
-    settings = next((el for el in elements if el.type == "story_settings"), None)
-    if settings:
-        relevant_context += f"### Story Settings\n{settings.content}\n\n"
-        
-    if relevant_names:
-        lower_names = [n.lower() for n in relevant_names]
-        filtered = [el for el in elements if el.name.lower() in lower_names]
-        relevant_context += "\n".join([f"### {el.type.capitalize()}: {el.name}\n{el.content}" for el in filtered])
-    else:
-        # If no relevant elements selected, maybe include all? No, that's too much context usually.
-        # But for 'write-chapter' we want to support user choice.
-        # If the user selected nothing, we might fallback to all OR nothing.
-        # Let's assume if the list is empty, we send everything (as per original logic kinda).
-        pass 
-        # Actually, let's just stick to what was filtered. If nothing filtered, check if relevant_elements key was even present?
-        # If it was empty list, then truly nothing relevant.
-
-    story_so_far = payload.smart_context.get("story_so_far", "")
-    
-    system_prompt = "You are a creative writing assistant. Write the chapter prose based on the outline."
-    
-    if payload.current_content:
-        user_prompt = f"""
-        STORY SO FAR:
-        {story_so_far}
-        
-        BIBLE CONTEXT:
-        {relevant_context}
-        
-        OUTLINE:
-        {payload.outline}
-        
-        CURRENT DRAFT:
-        {payload.current_content}
-        
-        USER COMMENTS/FEEDBACK:
-        {payload.comments}
-        
-        TASK:
-        Rewrite the chapter (or sections of it) to address the user feedback while adhering to the outline.
-        """
-    else:
-        user_prompt = f"""
-        STORY SO FAR:
-        {story_so_far}
-        
-        BIBLE CONTEXT:
-        {relevant_context}
-        
-        OUTLINE:
-        {payload.outline}
-        
-        TASK:
-        Write the full chapter prose. match the tone and style of the story.
-        """
-
-    llm_url = crud.get_global_setting("llm_url")
-    def parse_url(s): 
-        if not s: return "http://localhost:1234/v1/chat/completions"
-        try: 
-            v = json.loads(s.value)
-            return v if isinstance(v, str) else s.value
-        except: return s.value
-    url = parse_url(llm_url)
-    
-    messages = [
-        {"role": "system", "content": system_prompt},
-        {"role": "user", "content": user_prompt}
-    ]
-    
-    async def sse_generator():
-        import httpx
-        try:
-            async with httpx.AsyncClient() as client:
-                async with client.stream("POST", url, json={
-                    "model": "model-identifier",
-                    "messages": messages,
-                    "stream": True
-                }, timeout=180.0) as response:
-                    
-                    if response.status_code != 200:
-                        yield f"data: {json.dumps({'error': f'LLM Error: {response.status_code}'})}\n\n"
-                        return
-
-                    async for line in response.aiter_lines():
-                        if not line: continue
-                        if line.startswith("data: "):
-                            data_str = line[6:].strip()
-                            if data_str == "[DONE]": break
-                            try:
-                                data = json.loads(data_str)
-                                if "choices" in data and len(data["choices"]) > 0:
-                                    delta = data["choices"][0].get("delta", {})
-                                    if "content" in delta:
-                                        yield f"data: {json.dumps({'content': delta['content']})}\n\n"
-                            except: pass
-        except Exception as e:
-            yield f"data: {json.dumps({'error': str(e)})}\n\n"
-
-    return StreamingResponse(sse_generator(), media_type="text/event-stream")
+
+    unknown = [stage for stage in payload.pause_after if stage not in chapter_pipeline.PAUSE_POINTS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Cannot pause after: {', '.join(unknown)}")
+    router.check(await settings_service.get_llm_url_async())
+
+    pipeline = chapter_pipeline.Pipeline(payload.story_id, payload.pause_after)
+    stream = chapter_pipeline.run(pipeline, payload.chapter_brief, payload.retrieval_mode, payload.no_cache, payload.outline, payload.structured)
+    stream = jobs.until_disconnected(request, stream, "chapter_pipeline")
+    return StreamingResponse(stream, media_type="text/event-stream", headers={"X-Pipeline-Id": pipeline.id})
+
+@app.post("/ai/chapter-pipeline/{pipeline_id}/resume")
+async def resume_chapter_pipeline(pipeline_id: str, edits: dict = Body(default={})):
+    # edits: {"smart_context": {...}} after the context stage, {"outline": "..."} after the outline stage
+    # async so resume() settles the pipeline's future on the loop that awaits it
+    pipeline = chapter_pipeline.get(pipeline_id)
+    if pipeline is None:
+        raise HTTPException(status_code=404, detail="Pipeline not found")
+    if not pipeline.resume(edits):
+        raise HTTPException(status_code=409, detail="Pipeline is not paused")
+    return {"id": pipeline_id, "resumed": True}
 
 class AnalyzeBibleBriefRequest(BaseModel):
     story_id: int
     user_brief: str
     element_type: str
-
-@app.post("/ai/analyze-bible-brief")
-async def analyze_bible_brief(payload: AnalyzeBibleBriefRequest):
-    from sqlmodel import select
-    import json
-    
-    with models.Session(database.engine) as session:
-        elements = session.exec(select(models.BibleElement).where(models.BibleElement.story_id == payload.story_id, models.BibleElement.is_deleted == False)).all()
-        
-    bible_catalog = "\n".join([f"- {el.name} ({el.type})" for el in elements])
+    retrieval_mode: Optional[str] = None
+    no_cache: bool = False
+    stream: bool = False
+    structured: Optional[bool] = None
+
+async def bible_brief_events(payload: AnalyzeBibleBriefRequest):
+    context = await database.run_db(bible_context.get_story_context, payload.story_id)
+
+    retrieval_config = retrieval.config(payload.retrieval_mode)
+    if retrieval_config["mode"] == "lexical":
+        ranked = await database.run_db(retrieval.rank_elements, payload.story_id, payload.user_brief, retrieval_config["top_k"])
+        yield {"result": {
+            "relevant_elements": [el.name for el, _ in ranked],
+            "reasoning": "Ranked by lexical (BM25) match against the brief."
+        }}
+        return
+    if retrieval_config["mode"] == "hybrid":
+        bible_catalog = context.catalog(await database.run_db(retrieval.candidates, payload.story_id, payload.user_brief, retrieval_config["candidates"]))
+    else:
+        bible_catalog = context.catalog()
     
     system_prompt = """You are a continuity editor for a story bible.
     Analyze the user's brief for a new story element and identify which EXISTING elements are most relevant to it (e.g. related characters, locations, factions).
@@ -612,98 +546,67 @@ async def analyze_bible_brief(payload: AnalyzeBibleBriefRequest):
     Identify relevant existing elements that should be considered when fleshing out this new element.
     """
     
-    llm_url = crud.get_global_setting("llm_url")
-    def parse_url(s): 
-        if not s: return "http://localhost:1234/v1/chat/completions"
-        try: 
-            v = json.loads(s.value)
-            return v if isinstance(v, str) else s.value
-        except: return s.value
-    url = parse_url(llm_url)
+    url = await settings_service.get_llm_url_async()
     
-    import httpx
-    import re
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt}
+    ]
+    spec = structured.Spec("analyze_bible_brief", structured.bible_brief_schema([el.name for el in context.ordered()]))
+    constrained = structured.enabled(payload.structured)
+    params = {"temperature": 0.3, **(spec.params() if constrained else {})}
+    if constrained:
+        messages = spec.instruct(messages)
     try:
-        async with httpx.AsyncClient() as client:
-            resp = await client.post(url, json={
-                "model": "model-identifier",
-                "messages": [
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt}
-                ],
-                "temperature": 0.3,
-                "stream": False 
-            }, timeout=30.0)
-            
-            data = resp.json()
-            content = data["choices"][0]["message"]["content"]
-            
-            # Helper to strip code fences
-            def clean_markdown_json(text):
-                pattern = r"```(?:json)?\s*([\s\S]*?)\s*```"
-                match = re.search(pattern, text)
-                if match:
-                    return match.group(1)
-                return text.strip()
-
-            cleaned_content = clean_markdown_json(content)
-
-            try:
-                start = cleaned_content.find('{')
-                end = cleaned_content.rfind('}') + 1
-                if start != -1 and end != -1:
-                    json_str = cleaned_content[start:end]
-                    # strict=False allows control characters/newlines in strings
-                    return json.loads(json_str, strict=False)
-                else:
-                    raise Exception("No JSON braces found")
-            except Exception as e:
-                print(f"Smart Context Parse Error: {e} | Content: {cleaned_content}")
-                # Fallback: Regex extract relevant_elements
-                # Look for "relevant_elements": ["Item 1", "Item 2"]
-                # This is a basic regex, might not catch everything but better than nothing.
-                relevant = []
-                try:
-                    # Match header "relevant_elements": [
-                    # Then capture everything until ]
-                    match = re.search(r'"relevant_elements"\s*:\s*\[([\s\S]*?)\]', cleaned_content)
-                    if match:
-                        list_content = match.group(1)
-                        # Find all "String" or 'String' inside
-                        items = re.findall(r'"([^"]+)"', list_content)
-                        if not items:
-                            items = re.findall(r"'([^']+)'", list_content)
-                        relevant = items[:5] # Limit just in case
-                except: pass
-                
-                return {
-                    "relevant_elements": relevant, 
-                    "reasoning": f"Could not fully parse AI response, but found {len(relevant)} elements. (Raw: {content[:100]}...)"
-                }
-                
+        parser = json_stream.Parser(depth=2)
+        source = llm.stream_cached(url, messages, "analyze_bible_brief", cache=not payload.no_cache, **params)
+        async for path, value in json_stream.fields(source, parser):
+            yield {"path": list(path), "value": value}
+    except scheduler.Overloaded:
+        raise
     except Exception as e:
         # Fallback
-        return {"relevant_elements": [], "reasoning": f"Error: {str(e)}"}
+        yield {"result": {"relevant_elements": [], "reasoning": f"Error: {str(e)}"}}
+        return
+
+    result = await structured.settle(spec, parser, constrained, url, messages, **params)
+    if not isinstance(result, dict):
+        structured.fell_back("analyze_bible_brief")
+        content = parser.text()
+        print(f"Smart Context Parse Error: no JSON object | Content: {content}")
+        result = {
+            "relevant_elements": [],
+            "reasoning": f"Could not parse AI response. (Raw: {content[:100]}...)"
+        }
+    yield {"result": result}
+
+@app.post("/ai/analyze-bible-brief")
+async def analyze_bible_brief(payload: AnalyzeBibleBriefRequest, request: Request):
+    events = bible_brief_events(payload)
+    if payload.stream:
+        router.check(await settings_service.get_llm_url_async())
+        return structured_response(events, request, "analyze_bible_brief")
+    return await json_stream.result(events)
 
 class ProposeBibleElementRequest(BaseModel):
     story_id: int
     user_brief: str
     element_type: str
     relevant_elements: Optional[list[str]] = None
+    no_cache: bool = False
+    stream: bool = False
+    structured: Optional[bool] = None
 
-@app.post("/ai/propose-bible-element")
-async def propose_bible_element(payload: ProposeBibleElementRequest):
-    from sqlmodel import select
-    import re
+async def bible_proposal_events(payload: ProposeBibleElementRequest):
     # 1. Fetch Context
-    with models.Session(database.engine) as session:
-        elements = session.exec(select(models.BibleElement).where(models.BibleElement.story_id == payload.story_id, models.BibleElement.is_deleted == False)).all()
+    context = await database.run_db(bible_context.get_story_context, payload.story_id)
+    elements = context.ordered()
         
     # Filter context if relevant_elements provided
     if payload.relevant_elements:
         lower_rels = [r.lower() for r in payload.relevant_elements]
         # Include Story Settings always if exists
-        filtered_elements = [el for el in elements if el.name.lower() in lower_rels or el.type == 'story_settings']
+        filtered_elements = [el for el in elements if el.key in lower_rels or el.type == 'story_settings']
         # Also maybe include few others randomly or generic? No, strict is better for 'smart' context.
         # But if list is empty, maybe fallback to all?
         if not filtered_elements:
@@ -719,13 +622,8 @@ async def propose_bible_element(payload: ProposeBibleElementRequest):
     
     catalog_lines = []
     for el in filtered_elements:
-        desc = ""
-        try:
-            c = json.loads(el.content) if isinstance(el.content, str) else el.content
-            if isinstance(c, dict) and "description" in c:
-                desc = f": {str(c['description'])[:100]}..."
-        except: pass
-        catalog_lines.append(f"- {el.name} ({el.type}){desc}")
+        desc = f": {el.description[:100]}..." if el.description is not None else ""
+        catalog_lines.append(f"{el.catalog_line}{desc}")
 
     bible_catalog = "\n".join(catalog_lines)
     
@@ -761,92 +659,51 @@ async def propose_bible_element(payload: ProposeBibleElementRequest):
     Create a robust profile for this new element. Make it fit the existing world. Keep it below 250 words.
     """
     
-    # 3. Call LLM
-    llm_url = crud.get_global_setting("llm_url")
-    def parse_url(s): 
-        if not s: return "http://localhost:1234/v1/chat/completions"
-        try: 
-            v = json.loads(s.value)
-            return v if isinstance(v, str) else s.value
-        except: return s.value
-    url = parse_url(llm_url)
-    
-    import httpx
-    try:
-        async with httpx.AsyncClient() as client:
-            resp = await client.post(url, json={
-                "model": "model-identifier",
-                "messages": [
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt}
-                ],
-                "temperature": 0.7,
-                "stream": False 
-            }, timeout=60.0)
-            
-            if resp.status_code != 200:
-                raise HTTPException(status_code=500, detail=f"LLM Error: {resp.text}")
-                
-            data = resp.json()
-            content = data["choices"][0]["message"]["content"]
-            
-            # Helper to strip code fences
-            def clean_markdown_json(text):
-                pattern = r"```(?:json)?\s*([\s\S]*?)\s*```"
-                match = re.search(pattern, text)
-                if match:
-                    return match.group(1)
-                return text.strip()
-
-            cleaned_content = clean_markdown_json(content)
-            
-            # extract JSON
-            try:
-                # Find first { and last }
-                start = cleaned_content.find('{')
-                end = cleaned_content.rfind('}') + 1
-                if start != -1 and end != -1:
-                    json_str = cleaned_content[start:end]
-                    # strict=False allows control characters (newlines) in strings
-                    data_obj = json.loads(json_str, strict=False)
-                    
-                    # Post-processing: Flatten description if it's an object/dict
-                    def flatten_to_markdown(val, depth=0):
-                        if isinstance(val, dict):
-                            lines = []
-                            for k, v in val.items():
-                                prefix = "#" * (depth + 3) # start at h3
-                                lines.append(f"{prefix} {k}")
-                                lines.append(flatten_to_markdown(v, depth + 1))
-                            return "\n\n".join(lines)
-                        elif isinstance(val, list):
-                            return "\n".join([f"- {flatten_to_markdown(item, depth)}" for item in val])
-                        else:
-                            return str(val)
-
-                    if "content" in data_obj and "description" in data_obj["content"]:
-                        desc = data_obj["content"]["description"]
-                        if isinstance(desc, (dict, list)):
-                            data_obj["content"]["description"] = flatten_to_markdown(desc)
-                    
-                    return data_obj
-                else:
-                    raise Exception("No JSON braces found")
-            except Exception as e:
-                print(f"JSON Parse Error: {e}")
-                # Fallback: Try regex to at least get the Name if parsable
-                fallback_name = "New Element"
-                try:
-                    name_match = re.search(r'"name":\s*"([^"]+)"', cleaned_content)
-                    if name_match:
-                        fallback_name = name_match.group(1)
-                except: pass
-
-                return {
-                    "name": fallback_name,
-                    "type": payload.element_type,
-                    "content": { "description": cleaned_content }
-                }
+    # 3. Stream from the LLM; name and type arrive well before the description is done
+    url = await settings_service.get_llm_url_async()
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt}
+    ]
+    spec = structured.Spec("propose_bible_element", structured.element_schema(payload.element_type))
+    constrained = structured.enabled(payload.structured)
+    params = {"temperature": 0.7, **(spec.params() if constrained else {})}
+    if constrained:
+        messages = spec.instruct(messages)
+    parser = json_stream.Parser(depth=2)
+    source = llm.stream_cached(url, messages, "propose_bible_element", cache=not payload.no_cache, **params)
+    async for path, value in json_stream.fields(source, parser):
+        # Post-processing: Flatten description if it's an object/dict
+        if path == ("content", "description") and isinstance(value, (dict, list)):
+            value = structured.flatten_to_markdown(value)
+        yield {"path": list(path), "value": value}
+
+    data_obj = await structured.settle(spec, parser, constrained, url, messages, **params)
+    if not isinstance(data_obj, dict) or not isinstance(data_obj.get("name"), str):
+        # Fallback: keep the raw reply as the description
+        structured.fell_back("propose_bible_element")
+        print("JSON Parse Error: no element in reply")
+        yield {"result": {
+            "name": "New Element",
+            "type": payload.element_type,
+            "content": { "description": parser.text().strip() }
+        }}
+        return
+
+    content = data_obj.get("content")
+    if isinstance(content, dict) and isinstance(content.get("description"), (dict, list)):
+        content["description"] = structured.flatten_to_markdown(content["description"])
+    yield {"result": data_obj}
 
+@app.post("/ai/propose-bible-element")
+async def propose_bible_element(payload: ProposeBibleElementRequest, request: Request):
+    events = bible_proposal_events(payload)
+    if payload.stream:
+        router.check(await settings_service.get_llm_url_async())
+        return structured_response(events, request, "propose_bible_element")
+    try:
+        return await json_stream.result(events)
+    except scheduler.Overloaded:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
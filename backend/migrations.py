@@ -0,0 +1,223 @@
+from datetime import datetime
+
+# Versioned schema migrations, applied in order on startup after
+# create_all(). Every step must be idempotent: a crash between running a step
+# and recording it simply re-runs the step on the next start.
+MIGRATIONS = []
+
+def migration(version: int, name: str):
+    def register(fn):
+        MIGRATIONS.append((version, name, fn))
+        return fn
+    return register
+
+def applied_versions(conn):
+    return {row[0] for row in conn.exec_driver_sql("SELECT version FROM schema_migrations")}
+
+def run_migrations(engine):
+    with engine.begin() as conn:
+        conn.exec_driver_sql(
+            "CREATE TABLE IF NOT EXISTS schema_migrations ("
+            "version INTEGER PRIMARY KEY, name TEXT NOT NULL, applied_at TEXT NOT NULL)"
+        )
+        applied = applied_versions(conn)
+
+    for version, name, fn in sorted(MIGRATIONS, key=lambda m: m[0]):
+        if version in applied:
+            continue
+        with engine.begin() as conn:
+            fn(conn)
+            conn.exec_driver_sql(
+                "INSERT OR IGNORE INTO schema_migrations (version, name, applied_at) VALUES (?, ?, ?)",
+                (version, name, datetime.utcnow().isoformat()),
+            )
+        print(f"Applied migration {version}: {name}")
+
+@migration(1, "index hot lookup columns")
+def add_lookup_indexes(conn):
+    # Live bible elements of a story (every /ai/* handler, bible listing)
+    conn.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_bibleelement_story_live "
+        "ON bibleelement (story_id, type) WHERE is_deleted = 0"
+    )
+    # Live chapters of a story in reading order; also satisfies ORDER BY "order"
+    conn.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_chapter_story_live_order "
+        "ON chapter (story_id, \"order\") WHERE is_deleted = 0"
+    )
+    # History listings, newest version first
+    conn.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_versionhistory_chapter_version "
+        "ON versionhistory (chapter_id, version) WHERE chapter_id IS NOT NULL"
+    )
+    conn.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_versionhistory_bible_element_version "
+        "ON versionhistory (bible_element_id, version) WHERE bible_element_id IS NOT NULL"
+    )
+
+def column_names(conn, table: str):
+    return {row[1] for row in conn.exec_driver_sql(f"PRAGMA table_info({table})")}
+
+@migration(2, "version history storage columns")
+def add_history_storage_columns(conn):
+    columns = column_names(conn, "versionhistory")
+    if "storage" not in columns:
+        conn.exec_driver_sql("ALTER TABLE versionhistory ADD COLUMN storage VARCHAR NOT NULL DEFAULT 'full'")
+    if "delta" not in columns:
+        conn.exec_driver_sql("ALTER TABLE versionhistory ADD COLUMN delta BLOB")
+
+@migration(3, "delta-compress existing version history")
+def compress_history(conn):
+    from history import KEYFRAME_INTERVAL, STORAGE_DELTA, apply_delta, encode_delta
+
+    for owner in ("chapter_id", "bible_element_id"):
+        rows = conn.exec_driver_sql(
+            f"SELECT id, {owner}, version, content, storage, delta FROM versionhistory "
+            f"WHERE {owner} IS NOT NULL ORDER BY {owner}, version"
+        ).all()
+        previous_owner, previous_version, previous_content = None, None, None
+        for row_id, owner_id, version, content, storage, delta in rows:
+            if storage == STORAGE_DELTA:
+                content = apply_delta(previous_content, delta)
+            elif (
+                owner_id == previous_owner
+                and version == previous_version + 1
+                and version % KEYFRAME_INTERVAL != 1
+            ):
+                new_delta = encode_delta(previous_content, content)
+                if len(new_delta) < len(content.encode("utf-8")):
+                    conn.exec_driver_sql(
+                        "UPDATE versionhistory SET storage = ?, delta = ?, content = '' WHERE id = ?",
+                        (STORAGE_DELTA, new_delta, row_id),
+                    )
+            previous_owner, previous_version, previous_content = owner_id, version, content
+
+@migration(4, "version history listing metadata")
+def add_history_listing_metadata(conn):
+    from history import replay, word_count
+
+    columns = column_names(conn, "versionhistory")
+    if "size" not in columns:
+        conn.exec_driver_sql("ALTER TABLE versionhistory ADD COLUMN size INTEGER")
+    if "word_count" not in columns:
+        conn.exec_driver_sql("ALTER TABLE versionhistory ADD COLUMN word_count INTEGER")
+
+    for owner in ("chapter_id", "bible_element_id"):
+        owner_ids = [row[0] for row in conn.exec_driver_sql(
+            f"SELECT DISTINCT {owner} FROM versionhistory WHERE {owner} IS NOT NULL AND word_count IS NULL"
+        )]
+        for owner_id in owner_ids:
+            rows = conn.exec_driver_sql(
+                f"SELECT id, version, content, storage, delta FROM versionhistory WHERE {owner} = ? ORDER BY version",
+                (owner_id,),
+            ).all()
+            for row, content in replay(rows):
+                conn.exec_driver_sql(
+                    "UPDATE versionhistory SET size = ?, word_count = ? WHERE id = ?",
+                    (len(content.encode("utf-8")), word_count(content), row.id),
+                )
+
+    # Covering indexes so history pages are answered from the index alone
+    conn.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_versionhistory_chapter_listing "
+        "ON versionhistory (chapter_id, version, timestamp, size, word_count) WHERE chapter_id IS NOT NULL"
+    )
+    conn.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_versionhistory_bible_element_listing "
+        "ON versionhistory (bible_element_id, version, timestamp, size, word_count) WHERE bible_element_id IS NOT NULL"
+    )
+    conn.exec_driver_sql("DROP INDEX IF EXISTS ix_versionhistory_chapter_version")
+    conn.exec_driver_sql("DROP INDEX IF EXISTS ix_versionhistory_bible_element_version")
+
+@migration(5, "chapter and bible listing summaries")
+def add_listing_summaries(conn):
+    from history import word_count
+
+    for table, owner in (("chapter", "chapter_id"), ("bibleelement", "bible_element_id")):
+        columns = column_names(conn, table)
+        if "word_count" not in columns:
+            conn.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN word_count INTEGER NOT NULL DEFAULT 0")
+        if "updated_at" not in columns:
+            conn.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN updated_at DATETIME")
+        for row_id, content in conn.exec_driver_sql(f"SELECT id, content FROM {table}").all():
+            conn.exec_driver_sql(f"UPDATE {table} SET word_count = ? WHERE id = ?", (word_count(content), row_id))
+        # Last save time is the newest history entry
+        conn.exec_driver_sql(
+            f"UPDATE {table} SET updated_at = (SELECT MAX(timestamp) FROM versionhistory WHERE {owner} = {table}.id) "
+            f"WHERE updated_at IS NULL"
+        )
+
+    # Covering indexes for the summary listings (and still usable by the full ones)
+    conn.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_chapter_story_live_summary "
+        "ON chapter (story_id, \"order\", title, version, word_count, updated_at, is_deleted) WHERE is_deleted = 0"
+    )
+    conn.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_bibleelement_story_live_summary "
+        "ON bibleelement (story_id, type, name, version, word_count, updated_at, is_deleted) WHERE is_deleted = 0"
+    )
+    conn.exec_driver_sql("DROP INDEX IF EXISTS ix_chapter_story_live_order")
+    conn.exec_driver_sql("DROP INDEX IF EXISTS ix_bibleelement_story_live")
+
+@migration(6, "story revision counter")
+def add_story_revision(conn):
+    if "revision" not in column_names(conn, "story"):
+        conn.exec_driver_sql("ALTER TABLE story ADD COLUMN revision INTEGER NOT NULL DEFAULT 0")
+
+@migration(7, "story so far summary cache keys")
+def add_synopsis_keys(conn):
+    # One summary per chapter version; older versions are pruned on write
+    conn.exec_driver_sql(
+        "CREATE UNIQUE INDEX IF NOT EXISTS ux_chaptersynopsis_chapter_version "
+        "ON chaptersynopsis (chapter_id, version)"
+    )
+    conn.exec_driver_sql(
+        "CREATE UNIQUE INDEX IF NOT EXISTS ux_storysynopsis_story_digest "
+        "ON storysynopsis (story_id, digest)"
+    )
+
+@migration(8, "llm response cache expiry index")
+def add_llm_cache_index(conn):
+    # Serves expiry purges
+    conn.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_llmcacheentry_expires "
+        "ON llmcacheentry (expires_at)"
+    )
+
+@migration(9, "generation job retention index")
+def add_generation_job_index(conn):
+    conn.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_generationjob_updated "
+        "ON generationjob (updated_at)"
+    )
+
+@migration(10, "settings version counter")
+def add_settings_version(conn):
+    # Bumped by every settings write so other processes know to reload, unlike
+    # PRAGMA data_version, which moves on any commit
+    conn.exec_driver_sql(
+        "CREATE TABLE IF NOT EXISTS settings_version ("
+        "id INTEGER PRIMARY KEY CHECK (id = 1), version INTEGER NOT NULL)"
+    )
+    conn.exec_driver_sql("INSERT OR IGNORE INTO settings_version (id, version) VALUES (1, 0)")
+
+@migration(11, "generation job owner")
+def add_generation_job_owner(conn):
+    # Lets a starting worker interrupt only the jobs of processes that are gone
+    if "owner" not in column_names(conn, "generationjob"):
+        conn.exec_driver_sql("ALTER TABLE generationjob ADD COLUMN owner INTEGER")
+    conn.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_generationjob_status_owner "
+        "ON generationjob (status, owner)"
+    )
+
+@migration(12, "llm response cache last hit")
+def add_llm_cache_last_hit(conn):
+    # Size eviction drops the least recently used entries, not the soonest to expire
+    if "last_hit_at" not in column_names(conn, "llmcacheentry"):
+        conn.exec_driver_sql("ALTER TABLE llmcacheentry ADD COLUMN last_hit_at DATETIME")
+        conn.exec_driver_sql("UPDATE llmcacheentry SET last_hit_at = created_at")
+    conn.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_llmcacheentry_last_hit "
+        "ON llmcacheentry (last_hit_at, size, key)"
+    )
@@ -12,6 +12,7 @@ class Story(SQLModel, table=True):
     description: Optional[str] = None
     created_at: datetime = Field(default_factory=datetime.utcnow)
     is_deleted: bool = Field(default=False)
+    revision: int = Field(default=0)  # bumped on every chapter/bible write, drives ETags
     
     bible_elements: List["BibleElement"] = Relationship(back_populates="story")
     chapters: List["Chapter"] = Relationship(back_populates="story")
@@ -24,6 +25,8 @@ class BibleElement(SQLModel, table=True):
     content: str
     version: int = Field(default=1)
     is_deleted: bool = Field(default=False)
+    word_count: int = Field(default=0)
+    updated_at: Optional[datetime] = Field(default_factory=datetime.utcnow)
     
     story: Story = Relationship(back_populates="bible_elements")
     history: List["VersionHistory"] = Relationship(back_populates="bible_element")
@@ -36,6 +39,8 @@ class Chapter(SQLModel, table=True):
     content: str
     version: int = Field(default=1)
     is_deleted: bool = Field(default=False)
+    word_count: int = Field(default=0)
+    updated_at: Optional[datetime] = Field(default_factory=datetime.utcnow)
     
     story: Story = Relationship(back_populates="chapters")
     history: List["VersionHistory"] = Relationship(back_populates="chapter")
@@ -45,8 +50,86 @@ class VersionHistory(SQLModel, table=True):
     bible_element_id: Optional[int] = Field(default=None, foreign_key="bibleelement.id")
     chapter_id: Optional[int] = Field(default=None, foreign_key="chapter.id")
     version: int
-    content: str
+    content: str  # full text for keyframes, empty for delta rows (see history.py)
     timestamp: datetime = Field(default_factory=datetime.utcnow)
+    storage: str = Field(default="full")  # "full" keyframe or "delta"
+    delta: Optional[bytes] = None
+    size: Optional[int] = None  # bytes of the reconstructed content
+    word_count: Optional[int] = None
     
     bible_element: Optional[BibleElement] = Relationship(back_populates="history")
     chapter: Optional[Chapter] = Relationship(back_populates="history")
+
+# Cached LLM summaries behind "story so far" (see summaries.py)
+class ChapterSynopsis(SQLModel, table=True):
+    id: Optional[int] = Field(default=None, primary_key=True)
+    chapter_id: int = Field(foreign_key="chapter.id")
+    version: int  # chapter version the summary was written from
+    content: str
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+
+class StorySynopsis(SQLModel, table=True):
+    id: Optional[int] = Field(default=None, primary_key=True)
+    story_id: int = Field(foreign_key="story.id")
+    digest: str  # hash of the lower-level summaries this one combines
+    level: int
+    content: str
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+
+# Disk tier of the LLM response cache (see llm_cache.py)
+class LLMCacheEntry(SQLModel, table=True):
+    key: str = Field(primary_key=True)  # sha256 of url, model, messages and sampling params
+    value: str
+    size: int
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    expires_at: datetime
+    last_hit_at: datetime = Field(default_factory=datetime.utcnow)  # stored or last read from disk; eviction order
+
+# Server-side streaming generation; text is appended as it arrives (see jobs.py)
+class GenerationJob(SQLModel, table=True):
+    id: str = Field(primary_key=True)
+    endpoint: str
+    story_id: Optional[int] = Field(default=None, foreign_key="story.id")
+    status: str = Field(default="running")  # running, completed, failed, cancelled, interrupted
+    content: str = ""
+    error: Optional[str] = None
+    owner: Optional[int] = None  # pid of the server process streaming it
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
+
+class VersionHistoryRead(SQLModel):
+    id: int
+    bible_element_id: Optional[int] = None
+    chapter_id: Optional[int] = None
+    version: int
+    content: str
+    timestamp: datetime
+
+# Listing projections: selected column-by-column so content is never loaded
+class ChapterSummary(SQLModel):
+    id: int
+    order: int
+    title: str
+    version: int
+    word_count: int
+    updated_at: Optional[datetime] = None
+
+class BibleElementSummary(SQLModel):
+    id: int
+    type: str
+    name: str
+    version: int
+    word_count: int
+    updated_at: Optional[datetime] = None
+
+class VersionSummary(SQLModel):
+    id: int
+    version: int
+    timestamp: datetime
+    size: int
+    word_count: int
+    word_delta: int
+
+class VersionPage(SQLModel):
+    items: List[VersionSummary]
+    next_cursor: Optional[int] = None
@@ -0,0 +1,30 @@
+from typing import Iterable, List, Tuple
+
+import bible_context
+import context_packer
+
+# Prompts for the writing endpoints are laid out from the most stable text to
+# the most volatile, so consecutive requests for one story share a long
+# prefix. llama.cpp / LM Studio style servers keep the last prompt's KV cache
+# and only prefill from the first token that differs:
+#   system prompt      the same for every writing task
+#   bible context      story settings first, then elements in id order
+#   story so far       changes when chapters do
+#   request material   brief, outline, draft, feedback
+#   task               the only stage-specific instruction
+# Backend cache hints (e.g. cache_prompt) are added by the router.
+
+def bible_sections(context: bible_context.StoryContext, elements: Iterable[bible_context.CompiledElement]) -> List[context_packer.Section]:
+    sections = []
+    settings = context.settings()
+    if settings:
+        sections.append(context_packer.Section("story_settings", f"### Story Settings\n{settings.content}", context_packer.STORY_SETTINGS, "bible", context_packer.KEEP_HEAD))
+    return sections + context_packer.element_sections([el for el in elements if el.type != "story_settings"])
+
+def messages(system: str, parts: List[Tuple[str, str]], task: str) -> List[dict]:
+    # parts: (heading, text) from most to least stable; empty ones are left out
+    body = "\n\n".join(f"{heading}:\n{text}" for heading, text in parts if text)
+    return [
+        {"role": "system", "content": system},
+        {"role": "user", "content": f"{body}\n\nTASK:\n{task}"},
+    ]
@@ -0,0 +1,197 @@
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+import html
+import json
+import math
+import re
+import threading
+
+import bible_context
+import crud
+import settings_service
+from defaults import DEFAULT_RETRIEVAL
+
+# In-process BM25 index over bible elements and chapter text, one per story.
+# Documents are keyed by id and version and resynced incrementally like the
+# bible context cache: only rows whose version changed are re-tokenized.
+
+TOKEN_RE = re.compile(r"[a-z0-9]+(?:'[a-z]+)?")
+STOPWORDS = frozenset(
+    "a an and are as at be but by for from had has have he her his i in into is it its of on or she so "
+    "that the their them then there they this to was were will with you your we our not no".split()
+)
+TAG_RE = re.compile(r"<[^>]*>")
+NAME_BOOST = 3  # element names are repeated so a brief naming an element ranks it first
+
+def tokenize(text: str) -> List[str]:
+    return [t for t in TOKEN_RE.findall(text.lower()) if len(t) > 1 and t not in STOPWORDS]
+
+def content_text(content: str) -> str:
+    # Index the values of JSON bible content, not its field names
+    try:
+        parsed = json.loads(content)
+    except (TypeError, ValueError):
+        return content or ""
+    values = []
+    stack = [parsed]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, dict):
+            stack.extend(item.values())
+        elif isinstance(item, list):
+            stack.extend(item)
+        elif item is not None:
+            values.append(str(item))
+    return " ".join(values)
+
+def plain_text(text: str) -> str:
+    # Chapters (and some descriptions) are saved as editor HTML; index the words, not the markup
+    return html.unescape(TAG_RE.sub(" ", text or ""))
+
+class BM25Index:
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings: Dict[str, Dict[Any, int]] = {}
+        self.lengths: Dict[Any, int] = {}
+        self.terms: Dict[Any, List[str]] = {}
+        self.total_length = 0
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def add(self, doc_id, tokens: List[str]):
+        if doc_id in self.lengths:
+            self.remove(doc_id)
+        counts = Counter(tokens)
+        for term, tf in counts.items():
+            self.postings.setdefault(term, {})[doc_id] = tf
+        self.terms[doc_id] = list(counts)
+        self.lengths[doc_id] = len(tokens)
+        self.total_length += len(tokens)
+
+    def remove(self, doc_id):
+        for term in self.terms.pop(doc_id, []):
+            docs = self.postings[term]
+            docs.pop(doc_id, None)
+            if not docs:
+                del self.postings[term]
+        self.total_length -= self.lengths.pop(doc_id, 0)
+
+    def search(self, tokens: List[str], limit: Optional[int] = None) -> List[Tuple[Any, float]]:
+        n = len(self.lengths)
+        if not n:
+            return []
+        avg_length = self.total_length / n or 1
+        scores: Dict[Any, float] = {}
+        for term in set(tokens):
+            docs = self.postings.get(term)
+            if not docs:
+                continue
+            idf = math.log(1 + (n - len(docs) + 0.5) / (len(docs) + 0.5))
+            for doc_id, tf in docs.items():
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[doc_id] / avg_length)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        return ranked[:limit] if limit else ranked
+
+@dataclass
+class StoryIndex:
+    story_id: int
+    revision: Optional[int]
+    elements: BM25Index
+    chapters: BM25Index
+    element_versions: Dict[int, int] = field(default_factory=dict)
+    chapter_versions: Dict[int, int] = field(default_factory=dict)
+    chapter_titles: Dict[int, str] = field(default_factory=dict)
+
+def config(mode: Optional[str] = None) -> dict:
+    cfg = {**DEFAULT_RETRIEVAL, **(settings_service.get("retrieval") or {})}
+    if mode:
+        cfg["mode"] = mode
+    return cfg
+
+def element_tokens(el) -> List[str]:
+    return tokenize(el.name) * NAME_BOOST + tokenize(el.type) + tokenize(plain_text(content_text(el.content)))
+
+indexes: Dict[int, StoryIndex] = {}
+lock = threading.Lock()
+
+def sync(story_id: int) -> Tuple[StoryIndex, "bible_context.StoryContext"]:
+    # Blocking; async callers go through database.run_db
+    context = bible_context.get_story_context(story_id)
+    cfg = config()
+    with lock:
+        entry = indexes.get(story_id)
+        if entry is None:
+            entry = StoryIndex(story_id, None, BM25Index(cfg["k1"], cfg["b"]), BM25Index(cfg["k1"], cfg["b"]))
+            indexes[story_id] = entry
+
+        # 1. Elements follow the (already revalidated) compiled bible context
+        for element_id in [i for i in entry.element_versions if i not in context.elements]:
+            entry.elements.remove(element_id)
+            del entry.element_versions[element_id]
+        for el in context.elements.values():
+            if entry.element_versions.get(el.id) != el.version:
+                entry.elements.add(el.id, element_tokens(el))
+                entry.element_versions[el.id] = el.version
+
+        # 2. Chapters are only rechecked when the story revision moved
+        if context.revision is None or entry.revision != context.revision:
+            versions = crud.get_chapter_version_map(story_id)
+            for chapter_id in [i for i in entry.chapter_versions if i not in versions]:
+                entry.chapters.remove(chapter_id)
+                del entry.chapter_versions[chapter_id]
+                entry.chapter_titles.pop(chapter_id, None)
+            stale = [i for i, v in versions.items() if entry.chapter_versions.get(i) != v]
+            if stale:
+                for chapter in crud.get_chapters_by_id(stale):
+                    entry.chapters.add(chapter.id, tokenize(chapter.title) * NAME_BOOST + tokenize(plain_text(chapter.content)))
+                    entry.chapter_versions[chapter.id] = chapter.version
+                    entry.chapter_titles[chapter.id] = chapter.title
+            entry.revision = context.revision
+    return entry, context
+
+def ranked_elements(entry: StoryIndex, context: "bible_context.StoryContext", tokens: List[str]):
+    with lock:
+        ranked = entry.elements.search(tokens)
+    # Story settings are always sent separately; they are never "relevant" on their own
+    return [(context.elements[i], score) for i, score in ranked
+            if i in context.elements and context.elements[i].type != "story_settings"]
+
+def rank_elements(story_id: int, query: str, limit: Optional[int] = None) -> List[Tuple["bible_context.CompiledElement", float]]:
+    entry, context = sync(story_id)
+    results = ranked_elements(entry, context, tokenize(query))
+    return results[:limit] if limit else results
+
+def candidates(story_id: int, query: str, limit: int) -> List["bible_context.CompiledElement"]:
+    # Top-ranked elements, topped up in catalog order so small stories keep the full catalog
+    entry, context = sync(story_id)
+    chosen = {el.id for el, _ in ranked_elements(entry, context, tokenize(query))[:limit]}
+    for el in context.ordered():
+        if len(chosen) >= limit:
+            break
+        chosen.add(el.id)
+    return [el for el in context.ordered() if el.id in chosen]
+
+def search(story_id: int, query: str, limit: int = 10) -> dict:
+    entry, context = sync(story_id)
+    tokens = tokenize(query)
+    with lock:
+        chapters = entry.chapters.search(tokens, limit)
+        titles = dict(entry.chapter_titles)
+    return {
+        "elements": [
+            {"id": el.id, "name": el.name, "type": el.type, "score": round(score, 4)}
+            for el, score in ranked_elements(entry, context, tokens)[:limit]
+        ],
+        "chapters": [
+            {"id": chapter_id, "title": titles.get(chapter_id), "score": round(score, 4)}
+            for chapter_id, score in chapters
+        ],
+    }
+
+def story_deleted(story_id: int):
+    with lock:
+        indexes.pop(story_id, None)
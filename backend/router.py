@@ -0,0 +1,230 @@
+import asyncio
+import time
+from collections import deque
+from typing import Callable, Dict, Iterable, List, Optional
+
+import httpx
+
+import scheduler
+import settings_service
+from defaults import DEFAULT_LLM_BACKENDS
+
+# Spreads LLM calls over the pool of model servers in the "llm_backends"
+# setting. Each call goes to the healthy backend with the fewest outstanding
+# requests per unit of weight; a backend that fails to connect or answers
+# with a 5xx is retried elsewhere, and after failure_threshold errors in a row
+# it is skipped until a health probe finds it answering again. With no pool
+# configured the llm_url setting is the only backend, as before.
+
+# Payload fields only some servers accept
+SERVER_PARAMS = {
+    "llama.cpp": {"cache_prompt": True},
+    "lmstudio": {"cache_prompt": True},
+}
+
+def config() -> dict:
+    return {**DEFAULT_LLM_BACKENDS, **(settings_service.get("llm_backends") or {})}
+
+def health_url(url: str) -> str:
+    # OpenAI-style servers list models next to the chat endpoint
+    if url.endswith("/chat/completions"):
+        return url[: -len("/chat/completions")] + "/models"
+    return url
+
+def average_ms(samples: Iterable[float]) -> Optional[float]:
+    samples = list(samples)
+    return round(sum(samples) / len(samples) * 1000, 1) if samples else None
+
+class Target:
+    def __init__(self, url: str):
+        self.url = url
+        self.model: Optional[str] = None
+        self.server: Optional[str] = None  # kind of model server, see SERVER_PARAMS
+        self.max_slots: Optional[int] = None
+        self.weight = 1.0
+        self.params: dict = {}  # extra payload fields, e.g. prompt cache hints
+        self.response_format = True  # configured: can constrain output to a JSON schema
+        self.format_rejected = False  # learned: answered a response_format request with a 4xx
+        self.health_url = health_url(url)
+        self.healthy = True
+        self.failures = 0  # consecutive
+        self.last_error: Optional[str] = None
+        self.checked_at: Optional[float] = None
+        self.latencies = deque(maxlen=200)  # seconds per completed call
+        self.first_tokens = deque(maxlen=200)  # seconds to the first streamed token
+        self.stats = {"requests": 0, "errors": 0, "failovers": 0, "probes": 0, "probe_failures": 0}
+
+    def configure(self, entry: dict, params: dict, response_format: bool = True, server: Optional[str] = None):
+        self.model = entry.get("model")
+        self.server = entry.get("server", server)
+        self.params = {**SERVER_PARAMS.get((self.server or "").lower(), {}), **entry.get("params", params)}
+        self.response_format = entry.get("response_format", response_format)
+        self.max_slots = entry.get("max_slots")
+        self.weight = max(float(entry.get("weight", 1.0)), 0.01)
+        self.health_url = entry.get("health_url") or health_url(self.url)
+
+    def payload(self, payload: dict) -> dict:
+        payload = {**self.params, **payload}
+        if not self.response_format or self.format_rejected:
+            # The schema is in the prompt as well; the reply gets checked and repaired instead
+            payload.pop("response_format", None)
+        return {**payload, "model": self.model} if self.model else payload
+
+    def outstanding(self) -> int:
+        backend = scheduler.backends.get(self.url)
+        return backend.active + len(backend.waiters) if backend else 0
+
+    def load(self) -> float:
+        # +1 so weight still decides between idle backends
+        return (self.outstanding() + 1) / self.weight
+
+    def succeeded(self, seconds: float, streamed: bool = False):
+        (self.first_tokens if streamed else self.latencies).append(seconds)
+        self.failures = 0
+        if not self.healthy:
+            print(f"DEBUG: LLM backend {self.url} is answering again")
+            self.healthy = True
+
+    def failed(self, error: Exception, threshold: Optional[int]):
+        # threshold None: the request was at fault (4xx), not the backend
+        self.stats["errors"] += 1
+        self.last_error = str(error) or type(error).__name__
+        if threshold is None:
+            return
+        self.failures += 1
+        if self.healthy and self.failures >= threshold:
+            print(f"DEBUG: Taking LLM backend {self.url} out of rotation: {self.last_error}")
+            self.healthy = False
+
+    async def probe(self, client: httpx.AsyncClient, timeout: float):
+        self.stats["probes"] += 1
+        try:
+            resp = await client.get(self.health_url, timeout=timeout)
+            error = f"Health check returned {resp.status_code}" if resp.status_code >= 500 else None
+        except httpx.HTTPError as e:
+            error = str(e) or type(e).__name__
+        self.checked_at = time.time()
+        if error is None:
+            if not self.healthy:
+                print(f"DEBUG: LLM backend {self.url} passed its health check")
+            self.healthy = True
+            self.failures = 0
+            return
+        self.stats["probe_failures"] += 1
+        self.last_error = error
+        if self.healthy:
+            print(f"DEBUG: LLM backend {self.url} failed its health check: {error}")
+            self.healthy = False
+
+    def snapshot(self) -> dict:
+        latencies = sorted(self.latencies)
+        return {
+            **self.stats,
+            "url": self.url,
+            "model": self.model,
+            "server": self.server,
+            "weight": self.weight,
+            "max_slots": self.max_slots,
+            "healthy": self.healthy,
+            "outstanding": self.outstanding(),
+            "consecutive_failures": self.failures,
+            "last_error": self.last_error,
+            "checked_at": self.checked_at,
+            "latency_ms_avg": average_ms(latencies),
+            "latency_ms_p95": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000, 1) if latencies else None,
+            "first_token_ms_avg": average_ms(self.first_tokens),
+            "response_format": self.response_format and not self.format_rejected,
+        }
+
+targets: Dict[str, Target] = {}
+prober: Optional[asyncio.Task] = None
+
+def pool(url: str) -> List[Target]:
+    cfg = config()
+    result = []
+    for entry in cfg["backends"] or [{"url": url}]:
+        target = targets.get(entry["url"])
+        if target is None:
+            target = targets[entry["url"]] = Target(entry["url"])
+        target.configure(entry, cfg["params"], cfg["response_format"], cfg["server"])
+        result.append(target)
+    return result
+
+def model(url: str) -> Optional[str]:
+    # The model the next call would be sent to, so prompts can be packed for its context window
+    candidates = pool(url)
+    return min([t for t in candidates if t.healthy] or candidates, key=Target.load).model
+
+def choose(url: str, tried: Iterable[str] = ()) -> Target:
+    # Least outstanding work per unit of weight; if every backend is down, try them anyway
+    candidates = [t for t in pool(url) if t.url not in tried] or pool(url)
+    healthy = [t for t in candidates if t.healthy] or candidates
+    target = min(healthy, key=Target.load)
+    target.stats["requests"] += 1
+    return target
+
+def retryable(error: Exception) -> bool:
+    # Connection trouble and server errors; a read timeout means the model was already working on it
+    if isinstance(error, httpx.TransportError):
+        return not isinstance(error, httpx.ReadTimeout)
+    status_code = getattr(error, "status_code", None)
+    return status_code is not None and status_code >= 500
+
+def failed(target: Target, error: Exception, tried: Iterable[str], url: str, retry: bool = True) -> bool:
+    # Records the failure and says whether the call should move to another backend
+    cfg = config()
+    target.failed(error, cfg["failure_threshold"] if retryable(error) else None)
+    tried = set(tried)
+    if not retry or not retryable(error) or len(tried) >= cfg["max_attempts"]:
+        return False
+    if not any(t.url not in tried for t in pool(url)):
+        return False
+    target.stats["failovers"] += 1
+    print(f"DEBUG: LLM backend {target.url} failed ({target.last_error}), failing over")
+    return True
+
+def rejected_format(target: Target, error: Exception, payload: dict) -> bool:
+    # Servers without structured output answer 400/422 naming the field; stop sending it there and retry
+    if "response_format" not in payload or not target.response_format or target.format_rejected:
+        return False
+    message = str(error).lower()
+    if getattr(error, "status_code", None) not in (400, 422) or not any(word in message for word in ("response_format", "json_schema", "schema", "grammar")):
+        return False
+    print(f"DEBUG: LLM backend {target.url} rejected response_format, sending schemas in the prompt only")
+    target.format_rejected = True
+    return True
+
+def check(url: str):
+    # Fail fast before a streaming response is started
+    target = min(pool(url), key=Target.load)
+    scheduler.check(target.url, target.max_slots)
+
+async def probe_loop(get_client: Callable[[], httpx.AsyncClient]):
+    while True:
+        cfg = config()
+        await asyncio.sleep(cfg["health_interval"])
+        # Only a configured pool is probed; a lone llm_url has nowhere to fail over to
+        if not cfg["backends"]:
+            continue
+        try:
+            await asyncio.gather(*(t.probe(get_client(), cfg["health_timeout"]) for t in pool(settings_service.get_llm_url())))
+        except Exception as e:
+            print(f"ERROR in LLM health checks: {e}")
+
+def start(get_client: Callable[[], httpx.AsyncClient]):
+    global prober
+    if prober is None:
+        prober = asyncio.get_event_loop().create_task(probe_loop(get_client))
+
+async def stop():
+    global prober
+    if prober is not None:
+        prober.cancel()
+        try:
+            await prober
+        except asyncio.CancelledError:
+            pass
+        prober = None
+
+def snapshot() -> List[dict]:
+    return [target.snapshot() for target in pool(settings_service.get_llm_url())]
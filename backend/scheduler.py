@@ -0,0 +1,143 @@
+import asyncio
+import heapq
+import itertools
+import math
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Dict, Optional
+
+import settings_service
+from defaults import DEFAULT_LLM_SCHEDULER
+
+# Admission control for upstream LLM calls. Each backend URL gets a fixed
+# number of slots; callers beyond that wait in a priority queue (interactive
+# streams ahead of outlines ahead of background analysis) until a slot frees,
+# their queue deadline passes, or the queue is full, in which case they are
+# turned away with a Retry-After estimate.
+
+class Overloaded(Exception):
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.status_code = 429
+        self.retry_after = retry_after
+
+def config() -> dict:
+    return {**DEFAULT_LLM_SCHEDULER, **(settings_service.get("llm_scheduler") or {})}
+
+def traffic_class(endpoint: str, cfg: dict) -> str:
+    return cfg["endpoints"].get(endpoint, cfg["default_class"])
+
+class Backend:
+    def __init__(self, url: str):
+        self.url = url
+        self.limit = 1
+        self.max_queue = 0
+        self.active = 0
+        self.waiters = []  # heap of [priority, seq, future, class]
+        self.seq = itertools.count()
+        self.waits = deque(maxlen=500)  # seconds spent queued
+        self.holds = deque(maxlen=50)  # seconds a slot was held
+        self.stats = {"admitted": 0, "queued": 0, "rejected": 0, "timed_out": 0}
+
+    def configure(self, cfg: dict, limit: Optional[int] = None):
+        limit = limit or cfg["backends"].get(self.url, cfg["max_concurrency"])
+        self.max_queue = cfg["max_queue"]
+        if limit != self.limit:
+            self.limit = limit
+            self.wake()
+
+    def retry_after(self) -> int:
+        hold = sum(self.holds) / len(self.holds) if self.holds else 5.0
+        return max(1, math.ceil(hold * (len(self.waiters) + 1) / self.limit))
+
+    def check(self):
+        if len(self.waiters) >= self.max_queue and self.active >= self.limit:
+            self.stats["rejected"] += 1
+            raise Overloaded(f"LLM backend busy: {len(self.waiters)} requests queued", self.retry_after())
+
+    def wake(self):
+        # Hand free slots to the highest-priority live waiters
+        while self.active < self.limit and self.waiters:
+            _, _, future, _ = heapq.heappop(self.waiters)
+            if not future.done():
+                self.active += 1
+                future.set_result(None)
+
+    async def acquire(self, traffic: str, cfg: dict):
+        start = time.monotonic()
+        if self.active < self.limit and not self.waiters:
+            self.active += 1
+            self.stats["admitted"] += 1
+            self.waits.append(0.0)
+            return
+        self.check()
+
+        entry = [cfg["classes"][traffic]["priority"], next(self.seq), asyncio.get_running_loop().create_future(), traffic]
+        heapq.heappush(self.waiters, entry)
+        self.stats["queued"] += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(entry[2]), cfg["classes"][traffic]["queue_timeout"])
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if entry[2].done() and not entry[2].cancelled():
+                self.release()  # granted at the last moment; give it back
+            else:
+                entry[2].cancel()
+                self.waiters.remove(entry)
+                heapq.heapify(self.waiters)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            self.stats["timed_out"] += 1
+            raise Overloaded(f"LLM backend busy: waited {time.monotonic() - start:.0f}s in queue", self.retry_after())
+        self.stats["admitted"] += 1
+        self.waits.append(time.monotonic() - start)
+
+    def release(self):
+        self.active -= 1
+        self.wake()
+
+    def snapshot(self) -> dict:
+        waits = sorted(self.waits)
+        by_class: Dict[str, int] = {}
+        for _, _, future, traffic in self.waiters:
+            if not future.done():
+                by_class[traffic] = by_class.get(traffic, 0) + 1
+        return {
+            **self.stats,
+            "max_concurrency": self.limit,
+            "active": self.active,
+            "queue_depth": len(self.waiters),
+            "queue_depth_by_class": by_class,
+            "wait_ms_avg": round(sum(waits) / len(waits) * 1000, 1) if waits else None,
+            "wait_ms_p95": round(waits[min(len(waits) - 1, int(len(waits) * 0.95))] * 1000, 1) if waits else None,
+            "wait_ms_max": round(waits[-1] * 1000, 1) if waits else None,
+        }
+
+backends: Dict[str, Backend] = {}
+
+def get_backend(url: str, cfg: dict, limit: Optional[int] = None) -> Backend:
+    # limit: max_slots from the router's backend pool, ahead of the per-URL setting
+    backend = backends.get(url)
+    if backend is None:
+        backend = backends[url] = Backend(url)
+    backend.configure(cfg, limit)
+    return backend
+
+def check(url: str, limit: Optional[int] = None):
+    # Fail fast before a streaming response is started
+    get_backend(url, config(), limit).check()
+
+@asynccontextmanager
+async def slot(url: str, endpoint: str, limit: Optional[int] = None):
+    cfg = config()
+    backend = get_backend(url, cfg, limit)
+    await backend.acquire(traffic_class(endpoint, cfg), cfg)
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        backend.holds.append(time.monotonic() - start)
+        backend.release()
+
+def snapshot() -> dict:
+    return {url: backend.snapshot() for url, backend in backends.items()}
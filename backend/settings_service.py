@@ -0,0 +1,154 @@
+from sqlmodel import Session, select
+from typing import Any, Optional
+import asyncio
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+import database
+from models import GlobalSetting
+
+DEFAULT_LLM_URL = "http://localhost:1234/v1/chat/completions"
+DEFAULT_SYSTEM_PROMPT = "You are a creative writing assistant."
+
+def digest(value: Any) -> str:
+    return hashlib.sha1(json.dumps(value, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:16]
+
+def parse_value(raw: str) -> Any:
+    try:
+        return json.loads(raw)
+    except (TypeError, ValueError):
+        return raw
+
+class SettingsService:
+    # Parsed global settings held in memory. Writes through crud reload the
+    # cache straight away; writes from other worker processes are noticed
+    # through the settings_version row, which set_global_setting bumps in the
+    # same commit, so saving chapters or jobs never touches this cache. The
+    # version is looked up at most every check_interval seconds, and never on
+    # the event loop: there a stale cache is served while the check (and a
+    # reload, if the version moved) runs on the DB executor.
+    check_interval = 1.0
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.lock = threading.Lock()
+        self.values = {}
+        self.fingerprint = None
+        self.loaded = False
+        self.version = None
+        self.checked_at = 0.0
+        self.watch = None
+        self.syncing = False
+
+    def _current_version(self) -> Optional[int]:
+        if self.engine.url.database in (None, "", ":memory:"):
+            return None
+        if self.watch is None:
+            self.watch = sqlite3.connect(self.engine.url.database, check_same_thread=False)
+        try:
+            row = self.watch.execute("SELECT version FROM settings_version WHERE id = 1").fetchone()
+        except sqlite3.OperationalError:
+            return None  # before migrations have run
+        return row[0] if row else None
+
+    def is_fresh(self) -> bool:
+        # No I/O: whether the last check is recent enough to trust
+        return self.loaded and time.monotonic() - self.checked_at < self.check_interval
+
+    def refresh(self):
+        with self.lock:
+            # Read the version first: a write landing mid-load just triggers another reload
+            version = self._current_version()
+            with Session(self.engine) as session:
+                rows = session.exec(select(GlobalSetting)).all()
+            self.values = {row.key: parse_value(row.value) for row in rows}
+            self.fingerprint = digest(self.values)
+            self.version = version
+            self.loaded = True
+            self.checked_at = time.monotonic()
+
+    def sync(self):
+        # Worker threads only: reload if another process changed the settings
+        with self.lock:
+            if self.loaded and self._current_version() == self.version:
+                self.checked_at = time.monotonic()
+                return
+        self.refresh()
+
+    def ensure_fresh(self):
+        if self.is_fresh():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.sync()
+            return
+        if not self.loaded:
+            self.refresh()  # first read, during startup
+        elif not self.syncing:
+            self.syncing = True
+            loop.run_in_executor(database.db_executor, self.sync).add_done_callback(self._synced)
+
+    def _synced(self, future):
+        self.syncing = False
+        if future.exception() is not None:
+            print(f"ERROR refreshing settings: {future.exception()}")
+
+    def get(self, key: str, default: Any = None) -> Any:
+        self.ensure_fresh()
+        return self.values.get(key, default)
+
+    def get_all(self) -> dict:
+        self.ensure_fresh()
+        return dict(self.values)
+
+    def etag(self, key: Optional[str] = None) -> Optional[str]:
+        self.ensure_fresh()
+        if key is None:
+            return f'"settings-{self.fingerprint}"'
+        if key not in self.values:
+            return None
+        return f'"setting-{digest(self.values[key])}"'
+
+    def get_str(self, key: str, default: str) -> str:
+        value = self.get(key)
+        if isinstance(value, str):
+            value = value.strip('"').strip("'")
+        return value if isinstance(value, str) and value else default
+
+settings = SettingsService(database.engine)
+
+def get(key: str, default: Any = None) -> Any:
+    return settings.get(key, default)
+
+def get_all() -> dict:
+    return settings.get_all()
+
+def etag(key: Optional[str] = None) -> Optional[str]:
+    return settings.etag(key)
+
+def reload():
+    # After a write in this process
+    settings.refresh()
+
+def get_llm_url() -> str:
+    return settings.get_str("llm_url", DEFAULT_LLM_URL)
+
+def get_system_prompt() -> str:
+    return settings.get_str("llm_system_prompt", DEFAULT_SYSTEM_PROMPT)
+
+async def synced():
+    # Cache hits stay on the event loop; version checks and reloads go through the DB executor
+    if not settings.is_fresh():
+        await database.run_db(settings.sync)
+
+async def get_llm_url_async() -> str:
+    await synced()
+    return get_llm_url()
+
+async def get_system_prompt_async() -> str:
+    await synced()
+    return get_system_prompt()
@@ -0,0 +1,106 @@
+import asyncio
+import json
+import time
+from typing import AsyncIterator, Iterable, Optional
+
+import settings_service
+from defaults import DEFAULT_SSE
+
+# Shared SSE relay for the streaming /ai/* endpoints. Upstream deltas are
+# coalesced and flushed every flush_ms or once flush_chars have built up, so
+# a fast model produces tens of events per second instead of one per token.
+
+try:
+    import orjson
+
+    def dumps(data) -> str:
+        return orjson.dumps(data).decode()
+
+    loads = orjson.loads
+except ImportError:
+    def dumps(data) -> str:
+        return json.dumps(data)
+
+    loads = json.loads
+
+def config() -> dict:
+    return {**DEFAULT_SSE, **(settings_service.get("sse") or {})}
+
+def event(data: dict, event_id: Optional[str] = None) -> str:
+    prefix = f"id: {event_id}\n" if event_id is not None else ""
+    return f"{prefix}data: {dumps(data)}\n\n"
+
+async def relay(source: AsyncIterator[str], prelude: Iterable[dict] = (), label: str = "stream",
+                job_id: Optional[str] = None, offset: int = 0, fields: Optional[dict] = None) -> AsyncIterator[str]:
+    # With a job_id, content events carry "id: <job id>:<offset>" so clients can resume via Last-Event-ID.
+    # fields are added to every content and error event (e.g. the pipeline stage).
+    fields = fields or {}
+
+    def content_event(text: str) -> str:
+        nonlocal offset
+        offset += len(text)
+        return event({**fields, "content": text}, f"{job_id}:{offset}" if job_id else None)
+
+    for data in prelude:
+        yield event(data)
+
+    cfg = config()
+    if not cfg["coalesce"]:
+        try:
+            async for content in source:
+                yield content_event(content)
+        except Exception as e:
+            print(f"ERROR in {label} stream: {e}")
+            yield event({**fields, "error": str(e)})
+        return
+
+    flush_after = cfg["flush_ms"] / 1000
+    buffer = []
+    size = 0
+    last_flush = time.monotonic() - flush_after  # the first delta goes out as soon as it arrives
+    iterator = source.__aiter__()
+    pending = None
+    try:
+        while True:
+            # Wait for the next delta, but no longer than the flush deadline
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+            timeout = max(0.0, last_flush + flush_after - time.monotonic()) if buffer else None
+            done, _ = await asyncio.wait({pending}, timeout=timeout)
+            if done:
+                try:
+                    content = pending.result()
+                except StopAsyncIteration:
+                    break
+                finally:
+                    pending = None
+                buffer.append(content)
+                size += len(content)
+            if buffer and (size >= cfg["flush_chars"] or time.monotonic() - last_flush >= flush_after):
+                yield content_event("".join(buffer))
+                buffer, size = [], 0
+                last_flush = time.monotonic()
+        if buffer:
+            yield content_event("".join(buffer))
+    except Exception as e:
+        print(f"ERROR in {label} stream: {e}")
+        if buffer:
+            yield content_event("".join(buffer))
+        yield event({**fields, "error": str(e)})
+    finally:
+        if pending is not None:
+            pending.cancel()
+            try:
+                await pending
+            except (asyncio.CancelledError, StopAsyncIteration, Exception):
+                pass
+        await iterator.aclose()
+
+async def structured(source: AsyncIterator[dict], label: str = "stream") -> AsyncIterator[str]:
+    # Structured endpoints: {"path": [...], "value": ...} as fields complete, then {"result": ...}
+    try:
+        async for data in source:
+            yield event(data)
+    except Exception as e:
+        print(f"ERROR in {label} stream: {e}")
+        yield event({"error": str(e), **({"retry_after": e.retry_after} if hasattr(e, "retry_after") else {})})
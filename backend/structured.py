@@ -0,0 +1,257 @@
+import json
+import re
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import json_stream
+import llm
+import settings_service
+from defaults import DEFAULT_STRUCTURED_OUTPUT
+
+# Schema-constrained replies for the JSON endpoints. Each endpoint describes
+# its reply as a JSON Schema (element content comes from the bible_schema
+# setting). With structured output on, the schema is sent as response_format,
+# which llama.cpp, LM Studio, vLLM and OpenAI turn into a grammar, and is
+# spelled out in the prompt for backends that can't take it (see router).
+# The finished reply is checked against the schema: types are coerced
+# locally where the intent is clear, and only the fields still missing or
+# invalid are asked for again. Replies are checked with the mode off too, so
+# /ai/stats shows how often each endpoint would have fallen back.
+
+def config() -> dict:
+    return {**DEFAULT_STRUCTURED_OUTPUT, **(settings_service.get("structured_output") or {})}
+
+def enabled(requested: Optional[bool] = None) -> bool:
+    return config()["enabled"] if requested is None else requested
+
+def flatten_to_markdown(val, depth=0):
+    if isinstance(val, dict):
+        lines = []
+        for k, v in val.items():
+            prefix = "#" * (depth + 3) # start at h3
+            lines.append(f"{prefix} {k}")
+            lines.append(flatten_to_markdown(v, depth + 1))
+        return "\n\n".join(lines)
+    elif isinstance(val, list):
+        return "\n".join([f"- {flatten_to_markdown(item, depth)}" for item in val])
+    else:
+        return str(val)
+
+# -- schemas --
+
+def object_schema(properties: Dict[str, dict]) -> dict:
+    # Every property required and nothing else allowed, as strict json_schema modes expect
+    return {"type": "object", "properties": properties, "required": list(properties), "additionalProperties": False}
+
+def field_schema(field: dict) -> dict:
+    kind = field.get("type", "text")
+    if kind == "select" and field.get("options"):
+        return {"type": "string", "enum": list(field["options"])}
+    if kind == "array":
+        return {"type": "array", "items": {"type": "string"}}
+    if kind == "object":
+        return object_schema({f["key"]: field_schema(f) for f in field.get("fields", []) if f.get("key")})
+    if kind == "number":
+        return {"type": "number"}
+    return {"type": "string"}
+
+def names_schema(names: Iterable[str]) -> dict:
+    names = list(dict.fromkeys(names))
+    item = {"type": "string", "enum": names} if names and len(names) <= config()["max_enum"] else {"type": "string"}
+    return {"type": "array", "items": item}
+
+def bible_schema() -> dict:
+    schema = settings_service.get("bible_schema")
+    return schema if isinstance(schema, dict) else {}
+
+def element_schema(element_type: str) -> dict:
+    # Content fields follow the bible_schema entry for the type; description is always asked for
+    types = [key for key in bible_schema() if key != "story_settings"] or [element_type]
+    fields = bible_schema().get(element_type, {}).get("fields", [])
+    content = {"description": {"type": "string"}, **{f["key"]: field_schema(f) for f in fields if f.get("key")}}
+    return object_schema({
+        "name": {"type": "string"},
+        "type": {"type": "string", "enum": types},
+        "content": object_schema(content),
+    })
+
+def bible_brief_schema(names: Iterable[str]) -> dict:
+    return object_schema({"relevant_elements": names_schema(names), "reasoning": {"type": "string"}})
+
+def smart_context_schema(names: Iterable[str], story_so_far: bool) -> dict:
+    suggestion = object_schema({"name": {"type": "string"}, "type": {"type": "string"}, "reason": {"type": "string"}})
+    return object_schema({
+        **({"story_so_far": {"type": "string"}} if story_so_far else {}),
+        "relevant_elements": names_schema(names),
+        "suggested_new_elements": {"type": "array", "items": suggestion},
+    })
+
+class Spec:
+    def __init__(self, endpoint: str, schema: dict):
+        self.endpoint = endpoint
+        self.schema = schema
+
+    def params(self, schema: Optional[dict] = None) -> dict:
+        return {"response_format": {"type": "json_schema", "json_schema": {"name": self.endpoint, "strict": True, "schema": schema or self.schema}}}
+
+    def instruct(self, messages: List[dict]) -> List[dict]:
+        # The schema also goes in the prompt, for backends that ignore response_format
+        last = messages[-1]
+        note = f"\n\nReply with one JSON object matching this JSON Schema:\n{json.dumps(self.schema)}"
+        return [*messages[:-1], {**last, "content": last["content"] + note}]
+
+# -- checking --
+
+class Check:
+    def __init__(self):
+        self.problems: List[Tuple] = []  # paths still missing or invalid
+        self.fixes: List[Tuple] = []  # paths coerced locally
+
+    def conform(self, schema: dict, value: Any, path: Tuple = ()) -> Any:
+        # Returns a coerced copy; the input is left alone
+        kind = schema.get("type")
+        if kind == "object":
+            if not isinstance(value, dict):
+                self.problems.append(path)
+                return value
+            properties = schema.get("properties", {})
+            result = dict(value)
+            if schema.get("additionalProperties") is False:
+                for key in [key for key in result if key not in properties]:
+                    del result[key]
+                    self.fixes.append(path + (key,))
+            for key, sub in properties.items():
+                if key in result:
+                    result[key] = self.conform(sub, result[key], path + (key,))
+                elif key in schema.get("required", ()):
+                    self.problems.append(path + (key,))
+            return result
+        if kind == "array":
+            if isinstance(value, str):
+                # "Alice, Bob" for ["Alice", "Bob"]
+                value = [part.strip() for part in re.split(r"[,;\n]", value) if part.strip()]
+                self.fixes.append(path)
+            if not isinstance(value, list):
+                self.problems.append(path)
+                return value
+            items = []
+            for i, item in enumerate(value):
+                check = Check()
+                item = check.conform(schema.get("items", {}), item, path + (i,))
+                if check.problems:
+                    # e.g. a name that isn't in the bible: drop it rather than fail the reply
+                    self.fixes.append(path + (i,))
+                    continue
+                self.fixes += check.fixes
+                items.append(item)
+            return items
+        if kind == "string":
+            if isinstance(value, (dict, list)):
+                value = flatten_to_markdown(value)
+                self.fixes.append(path)
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                value = str(value)
+                self.fixes.append(path)
+            elif not isinstance(value, str):
+                self.problems.append(path)
+                return value
+            enum = schema.get("enum")
+            if enum and value not in enum:
+                match = next((option for option in enum if option.lower() == value.strip().lower()), None)
+                if match is None:
+                    self.problems.append(path)
+                    return value
+                value = match
+                self.fixes.append(path)
+            return value
+        if kind == "number" and (isinstance(value, bool) or not isinstance(value, (int, float))):
+            try:
+                value = float(str(value).replace(",", ""))
+                self.fixes.append(path)
+            except ValueError:
+                self.problems.append(path)
+        return value
+
+# -- metrics --
+
+COUNTERS = ("replies", "constrained", "parse_repairs", "valid", "fixed_locally", "needed_repair",
+            "repair_calls", "repaired", "still_invalid", "fallbacks")
+stats: Dict[str, Dict[str, int]] = {}
+
+def counts(endpoint: str) -> Dict[str, int]:
+    if endpoint not in stats:
+        # parse_repair_kinds: replies the streaming parser repaired, by kind ("trailing comma", ...)
+        stats[endpoint] = {**dict.fromkeys(COUNTERS, 0), "parse_repair_kinds": {}}
+    return stats[endpoint]
+
+def fell_back(endpoint: str):
+    # The endpoint had to return degraded output (the case users retry by hand)
+    counts(endpoint)["fallbacks"] += 1
+
+def rate(part: int, whole: int) -> Optional[float]:
+    return round(part / whole, 3) if whole else None
+
+def snapshot() -> dict:
+    return {
+        "enabled": enabled(),
+        "endpoints": {endpoint: {**c, "fallback_rate": rate(c["fallbacks"], c["replies"]),
+                                 "repair_call_rate": rate(c["repair_calls"], c["replies"]),
+                                 "invalid_rate": rate(c["still_invalid"], c["replies"])}
+                      for endpoint, c in stats.items()},
+    }
+
+# -- settling a reply --
+
+def repair_request(spec: Spec, value: Any, problems: List[Tuple]) -> Tuple[Optional[List[str]], dict, str]:
+    # Ask again for just the top-level fields at fault, or for everything if there was no object at all
+    properties = spec.schema.get("properties", {})
+    keys = list(dict.fromkeys(path[0] for path in problems if path and path[0] in properties))
+    if not isinstance(value, dict) or not keys or any(not path for path in problems):
+        return None, spec.schema, f"That reply was not a JSON object in the requested format. Reply with only a JSON object matching this JSON Schema:\n{json.dumps(spec.schema)}"
+    schema = object_schema({key: properties[key] for key in keys})
+    return keys, schema, f"That reply was missing or had invalid values for: {', '.join(keys)}. Reply with only a JSON object holding these fields, matching this JSON Schema:\n{json.dumps(schema)}"
+
+async def settle(spec: Spec, parser: json_stream.Parser, constrained: bool, url: str, messages: List[dict], **params) -> Any:
+    # Checks a finished reply. Off: the parsed value is returned as is, only counted.
+    # On: fixes what it can locally, then spends up to repair_calls asking for the rest.
+    c = counts(spec.endpoint)
+    c["replies"] += 1
+    c["constrained"] += constrained
+    c["parse_repairs"] += bool(parser.repairs)
+    for kind in parser.repairs:
+        c["parse_repair_kinds"][kind] = c["parse_repair_kinds"].get(kind, 0) + 1
+    check = Check()
+    value = check.conform(spec.schema, parser.value)
+    if not check.problems and not check.fixes:
+        c["valid"] += 1
+        return value
+    if not check.problems:
+        c["fixed_locally"] += 1
+        return value if constrained else parser.value
+    c["needed_repair"] += 1
+    if not constrained:
+        c["still_invalid"] += 1
+        return parser.value
+
+    reply = parser.text()
+    for _ in range(config()["repair_calls"]):
+        keys, schema, ask = repair_request(spec, value, check.problems)
+        print(f"DEBUG: {spec.endpoint} reply invalid at {', '.join('.'.join(map(str, p)) or '(root)' for p in check.problems)}; asking for {keys or 'everything'}")
+        c["repair_calls"] += 1
+        try:
+            reply = await llm.call_llm(url, [*messages, {"role": "assistant", "content": reply}, {"role": "user", "content": ask}],
+                                       spec.endpoint, **{**params, **spec.params(schema)})
+        except Exception as e:
+            print(f"ERROR in {spec.endpoint} repair call: {e}")
+            break
+        fixed = json_stream.loads(reply)
+        if keys is None:
+            value = fixed
+        elif isinstance(fixed, dict):
+            value = {**value, **{key: fixed[key] for key in keys if key in fixed}}
+        check = Check()
+        value = check.conform(spec.schema, value)
+        if not check.problems:
+            c["repaired"] += 1
+            return value
+    c["still_invalid"] += 1
+    return value
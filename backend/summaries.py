@@ -0,0 +1,128 @@
+import asyncio
+import hashlib
+import json
+from typing import List, Optional, Tuple
+
+import context_packer
+import crud
+import database
+import llm
+import router
+import settings_service
+from defaults import DEFAULT_SUMMARIES
+
+# "Story so far" built from cached per-chapter summaries. Chapter summaries are
+# keyed by (chapter_id, version), so only chapters edited since the last
+# request go back to the LLM. When they no longer fit together they are
+# condensed in groups, level by level; each group summary is keyed by a digest
+# of what it combines, so unchanged groups are reused too.
+
+CHAPTER_PROMPT = (
+    "You summarize chapters of a story for continuity. Write a factual summary of at most {words} words "
+    "covering key events, character changes and open threads. No commentary."
+)
+COMBINE_PROMPT = (
+    "You condense consecutive chapter summaries of a story into one summary of at most {words} words "
+    "that keeps every event needed for continuity. No commentary."
+)
+
+def config() -> dict:
+    return {**DEFAULT_SUMMARIES, **(settings_service.get("summaries") or {})}
+
+def chunks(text: str, tokens: int, estimate) -> List[str]:
+    # Split on line breaks into pieces that fit one summarization prompt
+    pieces, current, size = [], [], 0
+    for line in text.split("\n"):
+        cost = estimate(line) + 1
+        if current and size + cost > tokens:
+            pieces.append("\n".join(current))
+            current, size = [], 0
+        current.append(line)
+        size += cost
+    if current:
+        pieces.append("\n".join(current))
+    return [context_packer.truncate(piece, tokens, context_packer.KEEP_HEAD, estimate) for piece in pieces]
+
+async def condense(url: str, texts: List[str], words: int, endpoint: str) -> str:
+    return (await llm.call_llm(url, [
+        {"role": "system", "content": COMBINE_PROMPT.format(words=words)},
+        {"role": "user", "content": "\n\n".join(texts)}
+    ], endpoint, temperature=0.3)).strip()
+
+async def summarize_chapter(url: str, chapter, cfg: dict) -> str:
+    if not chapter.content.strip():
+        summary = ""
+    else:
+        # 1. Fit the chapter into the model budget, in several pieces if needed
+        model = router.model(url)
+        budget = context_packer.model_budget(model)
+        estimate = context_packer.estimator(model)
+        system_prompt = CHAPTER_PROMPT.format(words=cfg["chapter_words"])
+        room = budget["context_window"] - budget["reserve_output"] - estimate(system_prompt) - 64
+        parts = []
+        for piece in chunks(chapter.content, room, estimate):
+            parts.append((await llm.call_llm(url, [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": f"CHAPTER {chapter.order}: {chapter.title}\n\n{piece}"}
+            ], "summarize_chapter", temperature=0.3)).strip())
+
+        # 2. Long chapters: merge the piece summaries
+        summary = parts[0] if len(parts) == 1 else await condense(url, parts, cfg["chapter_words"], "summarize_chapter")
+
+    await database.run_db(crud.save_chapter_synopsis, chapter.id, chapter.version, summary)
+    return summary
+
+async def combine(story_id: int, url: str, items: List[Tuple[int, int, str]], level: int, cfg: dict, keep: List[str]) -> str:
+    # items: (first chapter order, last chapter order, rendered summary)
+    estimate = context_packer.estimator(router.model(url))
+    text = "\n\n".join(body for _, _, body in items)
+    if len(items) == 1 or estimate(text) <= cfg["story_tokens"]:
+        return text
+
+    size = max(2, cfg["group_size"])
+    grouped = []
+    for i in range(0, len(items), size):
+        group = items[i:i + size]
+        first, last = group[0][0], group[-1][1]
+        if len(group) == 1:
+            grouped.append(group[0])
+            continue
+        digest = hashlib.sha1(json.dumps([level, group]).encode()).hexdigest()
+        keep.append(digest)
+        summary = await database.run_db(crud.get_story_synopsis, story_id, digest)
+        if summary is None:
+            words = cfg["chapter_words"] * 2
+            summary = await condense(url, [body for _, _, body in group], words, "summarize_story")
+            await database.run_db(crud.save_story_synopsis, story_id, digest, level, summary)
+        grouped.append((first, last, f"Chapters {first}-{last}\n{summary}"))
+    return await combine(story_id, url, grouped, level + 1, cfg, keep)
+
+async def story_so_far(story_id: int, url: Optional[str] = None) -> Optional[str]:
+    chapters = await database.run_db(crud.get_chapter_summaries, story_id)
+    if not chapters:
+        return None
+    cfg = config()
+    url = url or await settings_service.get_llm_url_async()
+
+    # 1. Reuse summaries of unchanged chapter versions
+    cached = await database.run_db(crud.get_chapter_synopses, [c.id for c in chapters])
+    missing = [c for c in chapters if (c.id, c.version) not in cached]
+
+    # 2. Summarize only edited or new chapters
+    if missing:
+        print(f"DEBUG: Summarizing {len(missing)} of {len(chapters)} chapters for story {story_id}")
+        rows = {c.id: c for c in await database.run_db(crud.get_chapters_by_id, [c.id for c in missing])}
+        limit = asyncio.Semaphore(cfg["concurrency"])
+
+        async def fill(c):
+            async with limit:
+                cached[(c.id, c.version)] = await summarize_chapter(url, rows[c.id], cfg)
+
+        await asyncio.gather(*(fill(c) for c in missing))
+
+    # 3. Combine hierarchically into the story-level summary
+    items = [(c.order, c.order, f"Chapter {c.order}: {c.title}\n{cached[(c.id, c.version)]}") for c in chapters]
+    keep: List[str] = []
+    text = await combine(story_id, url, items, 1, cfg, keep)
+    await database.run_db(crud.prune_story_synopses, story_id, keep)
+    return text
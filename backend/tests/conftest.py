@@ -0,0 +1,99 @@
+import asyncio
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+import pytest
+import uvicorn
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+# database.py opens ./story_agent.db: give the suite its own
+os.chdir(tempfile.mkdtemp(prefix="story-agent-tests-"))
+
+import crud
+import database
+from fake_llm import FakeLLM
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def wait_for(condition, timeout: float = 5.0, interval: float = 0.02) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(interval)
+    return condition()
+
+class Server:
+    # Serves an ASGI app with uvicorn on a thread of its own, with its own event loop
+    def __init__(self, app):
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=self.port, log_level="warning", lifespan="on"))
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_until_complete, args=(self.server.serve(),), daemon=True)
+
+    def start(self):
+        self.thread.start()
+        assert wait_for(lambda: self.server.started, 10), "server did not start"
+        return self
+
+    def stop(self):
+        self.server.should_exit = True
+        self.thread.join(10)
+
+    def run(self, coro, timeout: float = 30):
+        # Runs a coroutine on the server's loop, as a request handler would
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+@pytest.fixture(scope="session", autouse=True)
+def db():
+    database.create_db_and_tables()
+
+@pytest.fixture
+def setting():
+    # Sets global settings for one test and puts the previous values back afterwards
+    saved = {}
+
+    def set_setting(key, value):
+        if key not in saved:
+            row = crud.get_global_setting(key)
+            saved[key] = json.loads(row.value) if row else {}
+        crud.set_global_setting(key, value)
+
+    yield set_setting
+    for key, value in saved.items():
+        crud.set_global_setting(key, value)
+
+@pytest.fixture(scope="session")
+def app_server(db):
+    # One app for the whole session: its shutdown stops the shared DB executor.
+    # Backends are probed often so health tests don't wait out the default interval.
+    crud.set_global_setting("llm_backends", {"health_interval": 0.2})
+    import main
+    server = Server(main.app).start()
+    yield server
+    server.stop()
+
+@pytest.fixture
+def fake_llm():
+    servers = []
+
+    def start(**options) -> FakeLLM:
+        fake = FakeLLM(**options)
+        server = Server(fake.app).start()
+        servers.append(server)
+        fake.url = f"{server.url}/v1/chat/completions"
+        return fake
+
+    yield start
+    for server in servers:
+        server.stop()
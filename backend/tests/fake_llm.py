@@ -0,0 +1,76 @@
+import asyncio
+import json
+from typing import List, Optional
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+# Stand-in for an OpenAI-compatible model server. Streams `tokens` numbered
+# tokens `delay` seconds apart (or answers `reply` in one go) and counts what
+# happened to each request, so tests can tell whether the app closed it early.
+# `replies` are answered in turn to non-streaming calls before `reply` is.
+
+class FakeLLM:
+    def __init__(self, tokens: int = 20, delay: float = 0.01, reply: str = "ok", reply_delay: float = 0.0,
+                 replies: Optional[List[str]] = None):
+        self.tokens = tokens
+        self.delay = delay
+        self.reply = reply
+        self.replies = list(replies or [])
+        self.reply_delay = reply_delay
+        self.status = 200  # e.g. 503 to play a backend that is down (chat and health checks)
+        self.requests = 0
+        self.active = 0  # streams / calls still being answered
+        self.max_active = 0
+        self.completed = 0
+        self.closed = 0  # streams the client went away from before the end
+        self.probes = 0
+        self.bodies = []
+        self.url = None  # chat completions URL, set once served
+        self.app = Starlette(routes=[
+            Route("/v1/chat/completions", self.chat, methods=["POST"]),
+            Route("/v1/models", self.models),
+        ])
+
+    async def chat(self, request: Request):
+        if self.status != 200:
+            return JSONResponse({"error": "unavailable"}, status_code=self.status)
+        body = await request.json()
+        self.requests += 1
+        self.bodies.append(body)
+        self.started()
+        if not body.get("stream"):
+            try:
+                await asyncio.sleep(self.reply_delay)
+                self.completed += 1
+                reply = self.replies.pop(0) if self.replies else self.reply
+                return JSONResponse({"choices": [{"message": {"content": reply}}]})
+            finally:
+                self.active -= 1
+        return StreamingResponse(self.stream(), media_type="text/event-stream")
+
+    def started(self):
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+
+    async def stream(self):
+        finished = False
+        try:
+            for i in range(self.tokens):
+                await asyncio.sleep(self.delay)
+                yield "data: " + json.dumps({"choices": [{"delta": {"content": f"tok{i} "}}]}) + "\n\n"
+            yield "data: [DONE]\n\n"
+            finished = True
+            self.completed += 1
+        finally:
+            self.active -= 1
+            if not finished:
+                self.closed += 1
+
+    async def models(self, request: Request):
+        self.probes += 1
+        if self.status != 200:
+            return JSONResponse({"error": "unavailable"}, status_code=self.status)
+        return JSONResponse({"data": [{"id": "fake"}]})
@@ -0,0 +1,41 @@
+import json
+import time
+
+import httpx
+
+import crud
+import models
+
+# A paused pipeline carries on as soon as the client posts its edits, and
+# a second resume is refused.
+
+def events(lines):
+    for line in lines:
+        if line.startswith("data:"):
+            yield json.loads(line[len("data:"):])
+
+def test_resume_wakes_the_paused_pipeline(app_server, fake_llm, setting):
+    fake = fake_llm(tokens=3, delay=0.01)
+    setting("llm_url", fake.url)
+    setting("sse", {"coalesce": False})
+    setting("jobs", {"disconnect_poll_ms": 10000})  # the disconnect poll must not be what wakes it
+    story = crud.create_story(models.Story(title="Paused"))
+
+    with httpx.Client(base_url=app_server.url, timeout=30) as client:
+        with client.stream("POST", "/ai/chapter-pipeline", json={
+            "story_id": story.id, "chapter_brief": "A quiet morning", "outline": "1. Wake up",
+            "pause_after": ["context"], "retrieval_mode": "lexical",
+        }) as response:
+            pipeline_id = response.headers["x-pipeline-id"]
+            stream = events(response.iter_lines())
+            assert next(event for event in stream if event.get("status") == "paused")["stage"] == "context"
+
+            resumed = time.monotonic()
+            answer = client.post(f"/ai/chapter-pipeline/{pipeline_id}/resume", json={"smart_context": {"story_so_far": "Edited"}})
+            assert answer.json() == {"id": pipeline_id, "resumed": True}
+            assert next(event for event in stream if event.get("stage") == "prose")["status"] == "started"
+            assert time.monotonic() - resumed < 1.0
+
+            # Not paused any more
+            assert client.post(f"/ai/chapter-pipeline/{pipeline_id}/resume", json={}).status_code == 409
+            assert any(event.get("status") == "done" and event.get("stage") == "prose" for event in stream)
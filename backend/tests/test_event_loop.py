@@ -0,0 +1,63 @@
+import asyncio
+import threading
+import time
+
+import httpx
+from sqlmodel import Session, insert
+
+import crud
+import database
+import models
+
+# A token stream must keep flowing while async handlers run heavy queries:
+# their DB work goes through database.run_db, never a Session on the loop.
+# (Some gap remains on a busy machine: the query threads still share the GIL.)
+
+MAX_GAP = 0.5  # seconds between streamed tokens the model sends every 20ms
+
+def add_elements(story_id: int, count: int, size: int):
+    with Session(database.engine) as session:
+        session.exec(insert(models.BibleElement), params=[
+            {"story_id": story_id, "type": "character", "name": f"Character {i}", "content": f"{i} " + "x" * size}
+            for i in range(count)
+        ])
+        session.commit()
+
+def test_tokens_keep_flowing_during_heavy_bible_queries(app_server, fake_llm, setting):
+    fake = fake_llm(tokens=60, delay=0.02)
+    setting("llm_url", fake.url)
+    setting("sse", {"coalesce": False})
+    story = crud.create_story(models.Story(title="Heavy bible"))
+    add_elements(story.id, 40000, 300)
+    streamed = crud.create_story(models.Story(title="Streamed"))
+
+    # Run on the loop, a single one of these would already break the bound
+    start = time.monotonic()
+    crud.get_bible_elements(story.id)
+    assert time.monotonic() - start > MAX_GAP
+
+    stop = threading.Event()
+    queries = []
+
+    async def heavy():
+        while not stop.is_set():
+            queries.append(len(await database.run_db(crud.get_bible_elements, story.id)))
+
+    workers = [asyncio.run_coroutine_threadsafe(heavy(), app_server.loop) for _ in range(2)]
+    arrivals = []
+    try:
+        with httpx.stream("POST", f"{app_server.url}/ai/generate-chapter",
+                          json={"story_id": streamed.id, "description": "A storm hits the harbour"}, timeout=60) as response:
+            assert response.status_code == 200
+            for line in response.iter_lines():
+                if line.startswith("data:") and '"content"' in line:
+                    arrivals.append(time.monotonic())
+    finally:
+        stop.set()
+        for worker in workers:
+            worker.result(60)
+
+    gaps = [later - earlier for earlier, later in zip(arrivals, arrivals[1:])]
+    assert len(arrivals) == fake.tokens
+    assert len(queries) >= 2 and set(queries) == {40001}  # the queries really overlapped the stream
+    assert max(gaps) < MAX_GAP, f"longest gap between tokens {max(gaps):.3f}s"
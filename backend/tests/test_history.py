@@ -0,0 +1,137 @@
+import random
+from datetime import datetime, timedelta
+
+import pytest
+from sqlmodel import Session, SQLModel, create_engine, select
+
+import history
+import migrations
+import models
+
+# Version history stored as keyframes plus deltas must give back every
+# version byte for byte, and a database from before that storage (full
+# content in every row, none of the newer columns) must read the same after
+# its migrations.
+
+PIECES = [
+    "Ada walked to the harbour. ", "The fog was thick!\n", "¿Dónde está el faro? ", "灯台の明かりが消えた。",
+    "<p>She said \"wait\".</p>", "Über die Brücke… ", "🌊🌊 waves ", "\r\nA line with CRLF.\r\n", "   ", "Why? Why not. ",
+]
+
+def versions(count: int, seed: int = 5):
+    # Edits as a writer makes them: insertions, deletions and rewrites of a few pieces at a time
+    rng = random.Random(seed)
+    parts = [rng.choice(PIECES) for _ in range(12)]
+    texts = ["".join(parts)]
+    for _ in range(count - 1):
+        change = rng.random()
+        i = rng.randrange(len(parts) + 1)
+        if change < 0.4:
+            parts.insert(i, rng.choice(PIECES))
+        elif change < 0.7 and parts:
+            parts.pop(min(i, len(parts) - 1))
+        elif change < 0.95 and parts:
+            parts[min(i, len(parts) - 1)] = rng.choice(PIECES) + str(rng.randrange(100))
+        # else: saved without changes
+        texts.append("".join(parts))
+    texts[30] = ""  # cleared, then written again
+    return texts
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'history.db'}")
+    yield engine
+    engine.dispose()
+
+def test_every_version_round_trips(engine):
+    SQLModel.metadata.create_all(engine)
+    texts = versions(3 * history.KEYFRAME_INTERVAL + 5)
+    with Session(engine) as session:
+        previous = None
+        for version, text in enumerate(texts, start=1):
+            session.add(history.new_version(session, previous, version, text, chapter_id=1))
+            session.commit()
+            previous = text
+
+        rows = session.exec(select(models.VersionHistory).order_by(models.VersionHistory.version)).all()
+        keyframes = [row.version for row in rows if row.storage == history.STORAGE_FULL]
+        # Keyframes every KEYFRAME_INTERVAL versions (and wherever a delta would not be smaller), deltas between
+        assert {1, 21, 41, 61} <= set(keyframes)
+        assert sum(row.storage == history.STORAGE_DELTA for row in rows) > len(rows) // 2
+        assert all(row.size == len(text.encode("utf-8")) for row, text in zip(rows, texts))
+
+        listed = history.read_history(session, chapter_id=1)
+        assert [entry.version for entry in listed] == list(range(len(texts), 0, -1))
+        assert [entry.content.encode("utf-8") for entry in reversed(listed)] == [text.encode("utf-8") for text in texts]
+        for version, text in enumerate(texts, start=1):
+            assert history.read_version(session, version, chapter_id=1).content.encode("utf-8") == text.encode("utf-8")
+        assert history.read_version(session, len(texts) + 1, chapter_id=1) is None
+
+# The tables as they were before any migration (see the baseline models.py)
+BASELINE_SCHEMA = [
+    "CREATE TABLE globalsetting (key VARCHAR NOT NULL, value VARCHAR NOT NULL, PRIMARY KEY (key))",
+    "CREATE TABLE story (id INTEGER NOT NULL, title VARCHAR NOT NULL, description VARCHAR, created_at DATETIME NOT NULL, "
+    "is_deleted BOOLEAN NOT NULL, PRIMARY KEY (id))",
+    "CREATE TABLE bibleelement (id INTEGER NOT NULL, story_id INTEGER NOT NULL, type VARCHAR NOT NULL, name VARCHAR NOT NULL, "
+    "content VARCHAR NOT NULL, version INTEGER NOT NULL, is_deleted BOOLEAN NOT NULL, PRIMARY KEY (id), "
+    "FOREIGN KEY(story_id) REFERENCES story (id))",
+    "CREATE TABLE chapter (id INTEGER NOT NULL, story_id INTEGER NOT NULL, \"order\" INTEGER NOT NULL, title VARCHAR NOT NULL, "
+    "content VARCHAR NOT NULL, version INTEGER NOT NULL, is_deleted BOOLEAN NOT NULL, PRIMARY KEY (id), "
+    "FOREIGN KEY(story_id) REFERENCES story (id))",
+    "CREATE TABLE versionhistory (id INTEGER NOT NULL, bible_element_id INTEGER, chapter_id INTEGER, version INTEGER NOT NULL, "
+    "content VARCHAR NOT NULL, timestamp DATETIME NOT NULL, PRIMARY KEY (id), "
+    "FOREIGN KEY(bible_element_id) REFERENCES bibleelement (id), FOREIGN KEY(chapter_id) REFERENCES chapter (id))",
+]
+
+HISTORY_COLUMNS = "id, bible_element_id, chapter_id, version, content, timestamp"
+
+def baseline_database(engine, chapter_texts, element_texts):
+    start = datetime(2024, 3, 1, 9, 0)
+    with engine.begin() as conn:
+        for statement in BASELINE_SCHEMA:
+            conn.exec_driver_sql(statement)
+        conn.exec_driver_sql("INSERT INTO story VALUES (1, 'Old story', NULL, ?, 0)", (str(start),))
+        conn.exec_driver_sql("INSERT INTO chapter VALUES (1, 1, 1, 'One', ?, ?, 0)", (chapter_texts[-1], len(chapter_texts)))
+        conn.exec_driver_sql("INSERT INTO bibleelement VALUES (1, 1, 'character', 'Ada', ?, ?, 0)", (element_texts[-1], len(element_texts)))
+        for owner, texts in (("chapter_id", chapter_texts), ("bible_element_id", element_texts)):
+            for version, text in enumerate(texts, start=1):
+                conn.exec_driver_sql(
+                    f"INSERT INTO versionhistory ({owner}, version, content, timestamp) VALUES (?, ?, ?, ?)",
+                    (1, version, text, str(start + timedelta(minutes=version))),
+                )
+
+def as_read(row) -> dict:
+    # A history entry the way the API returns it
+    return models.VersionHistoryRead(**dict(zip(HISTORY_COLUMNS.split(", "), row))).model_dump()
+
+def test_baseline_history_reads_the_same_after_migrating(engine):
+    chapter_texts = versions(2 * history.KEYFRAME_INTERVAL + 3)
+    element_texts = ['{"description": "Engineer"}', '{"description": "Engineer ⚙"}', '{"description": "Engineer ⚙, lighthouse keeper"}']
+    baseline_database(engine, chapter_texts, element_texts)
+    with engine.connect() as conn:
+        before = {
+            owner: [as_read(row) for row in conn.exec_driver_sql(
+                f"SELECT {HISTORY_COLUMNS} FROM versionhistory WHERE {owner} = 1 ORDER BY version DESC")]
+            for owner in ("chapter_id", "bible_element_id")
+        }
+
+    # What startup does: create what is missing, then migrate
+    SQLModel.metadata.create_all(engine)
+    migrations.run_migrations(engine)
+
+    with Session(engine) as session:
+        rows = session.exec(select(models.VersionHistory).where(models.VersionHistory.chapter_id == 1)).all()
+        assert any(row.storage == history.STORAGE_DELTA for row in rows)  # existing history was compressed
+        for owner in ("chapter_id", "bible_element_id"):
+            listed = [entry.model_dump() for entry in history.read_history(session, **{owner: 1})]
+            assert listed == before[owner]
+            for entry in before[owner]:
+                assert history.read_version(session, entry["version"], **{owner: 1}).model_dump() == entry
+
+        # The listing metadata was backfilled from the reconstructed content
+        page = history.list_versions(session, chapter_id=1, limit=100)
+        assert [item.size for item in page.items] == [len(text.encode("utf-8")) for text in reversed(chapter_texts)]
+        assert [item.word_count for item in page.items] == [history.word_count(text) for text in reversed(chapter_texts)]
+        chapter = session.get(models.Chapter, 1)
+        assert chapter.word_count == history.word_count(chapter_texts[-1])
+        assert chapter.updated_at == before["chapter_id"][0]["timestamp"]
@@ -0,0 +1,86 @@
+import os
+import subprocess
+import sys
+import uuid
+
+import httpx
+import pytest
+
+import crud
+import jobs
+import models
+import scheduler
+from conftest import wait_for
+
+# A generation nobody wants any more must give its scheduler slot back and
+# close the upstream request straight away, not when the model finishes.
+
+@pytest.fixture
+def long_stream(app_server, fake_llm, setting):
+    fake = fake_llm(tokens=500, delay=0.02)  # ten seconds of output
+    setting("llm_url", fake.url)
+    setting("sse", {"coalesce": False})
+    setting("jobs", {"orphan_grace_ms": 0, "disconnect_poll_ms": 50})
+    return fake
+
+def read_tokens(lines, count: int):
+    seen = 0
+    for line in lines:
+        if line.startswith("data:") and '"content"' in line:
+            seen += 1
+            if seen == count:
+                return
+
+def slot_freed(fake) -> bool:
+    return scheduler.backends[fake.url].active == 0 and fake.active == 0 and fake.closed == 1
+
+def start_chapter(client: httpx.Client):
+    story = crud.create_story(models.Story(title="Stopped early"))
+    return client.stream("POST", "/ai/generate-chapter", json={"story_id": story.id, "description": "A long night"})
+
+def test_disconnect_frees_the_slot(app_server, long_stream):
+    with httpx.Client(base_url=app_server.url, timeout=30) as client:
+        with start_chapter(client) as response:
+            job_id = response.headers["x-generation-id"]
+            read_tokens(response.iter_lines(), 5)
+            assert scheduler.backends[long_stream.url].active == 1
+        # Leaving the block drops the connection mid-stream
+
+        assert wait_for(lambda: slot_freed(long_stream), 3), scheduler.snapshot()[long_stream.url]
+        assert long_stream.completed == 0
+        assert client.get(f"/ai/jobs/{job_id}").json()["status"] == "cancelled"
+
+def test_cancel_endpoint_frees_the_slot(app_server, long_stream):
+    with httpx.Client(base_url=app_server.url, timeout=30) as client:
+        with start_chapter(client) as response:
+            job_id = response.headers["x-generation-id"]
+            lines = response.iter_lines()
+            read_tokens(lines, 5)
+
+            # Stop button, while the client is still connected
+            cancelled = client.post(f"/ai/jobs/{job_id}/cancel").json()
+            assert cancelled["cancelled"] and cancelled["status"] == "cancelled"
+            assert wait_for(lambda: slot_freed(long_stream), 3), scheduler.snapshot()[long_stream.url]
+            assert long_stream.completed == 0
+
+            # The follower is told, and its stream ends
+            rest = list(lines)
+            assert any('"error"' in line for line in rest)
+
+def test_startup_only_interrupts_jobs_of_dead_processes(db):
+    # A sibling worker still streaming, one that has exited, this pid from before a restart, and an old row without owner
+    sibling = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(60)"])
+    exited = subprocess.Popen([sys.executable, "-c", "pass"])
+    exited.wait()
+    try:
+        owners = {"sibling": sibling.pid, "exited": exited.pid, "restarted": os.getpid(), "legacy": None}
+        ids = {name: uuid.uuid4().hex for name in owners}
+        for name, owner in owners.items():
+            crud.create_generation_job(ids[name], "generate_chapter", None, owner)
+
+        jobs.startup()
+        status = {name: crud.get_generation_job(job_id).status for name, job_id in ids.items()}
+        assert status == {"sibling": "running", "exited": "interrupted", "restarted": "interrupted", "legacy": "interrupted"}
+    finally:
+        sibling.kill()
+        sibling.wait()
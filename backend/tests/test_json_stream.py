@@ -0,0 +1,89 @@
+import asyncio
+import json
+
+import pytest
+
+import json_stream
+import structured
+
+# The forgiving streaming parser: each model mistake it repairs, the same
+# value however the text is split into chunks, and fields reported as soon
+# as they close rather than when the reply ends.
+
+def parse(text: str, depth: int = 1) -> json_stream.Parser:
+    parser = json_stream.Parser(depth)
+    parser.feed(text)
+    parser.close()
+    return parser
+
+@pytest.mark.parametrize("text, value, repairs", [
+    ('{"a": [1, 2,], "b": 3,}', {"a": [1, 2], "b": 3}, {"trailing comma"}),
+    ('{"a": "line one\nline two\ttabbed"}', {"a": "line one\nline two\ttabbed"}, {"control characters"}),
+    ('{"a": "she said "hi" to me", "b": 1}', {"a": 'she said "hi" to me', "b": 1}, {"unescaped quote"}),
+    ('```json\n{"a": 1}\n```', {"a": 1}, {"text around JSON"}),
+    ('Sure! Here it is:\n{"a": {"b": [2]}}\nHope that helps.', {"a": {"b": [2]}}, {"text around JSON"}),
+    ("{'a': True, 'b': None, c: False}", {"a": True, "b": None, "c": False}, {"single quotes", "bare key", "python literals"}),
+    ('{"a": 1 "b": 2}', {"a": 1, "b": 2}, {"missing comma"}),
+    ('{"a": 1, // the first\n "b": /* second */ 2}', {"a": 1, "b": 2}, {"comments"}),
+])
+def test_repairs(text, value, repairs):
+    parser = parse(text)
+    assert parser.value == value
+    assert parser.complete
+    assert parser.repairs == repairs
+
+def test_valid_json_needs_no_repair():
+    text = json.dumps({"name": "Ada", "tags": ["a", "b"], "age": 36, "note": 'quote " and \\ slash é'})
+    parser = parse(text)
+    assert parser.value == json.loads(text) and parser.complete and not parser.repairs
+
+def test_truncated_reply_keeps_what_arrived():
+    parser = parse('{"a": "hello", "b": [1, 2, {"c": "wor')
+    assert parser.value == {"a": "hello", "b": [1, 2, {"c": "wor"}]}
+    assert not parser.complete
+    assert parser.repairs == {"truncated", "unclosed string"}
+
+def test_no_object_at_all():
+    assert json_stream.loads("I could not find anything relevant.") is None
+
+REPLY = 'Here you go: {"story_so_far": "It rained, \\"hard\\".", "relevant_elements": ["Ada", "Storm",], "extra": {"n": 12}}'
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 16, len(REPLY)])
+def test_chunked_feeding_gives_the_same_result(size):
+    parser = json_stream.Parser(depth=2)
+    events = []
+    for i in range(0, len(REPLY), size):
+        events += parser.feed(REPLY[i:i + size])
+    events += parser.close()
+    assert parser.value == parse(REPLY).value == {"story_so_far": 'It rained, "hard".', "relevant_elements": ["Ada", "Storm"], "extra": {"n": 12}}
+    assert parser.repairs == {"text around JSON", "trailing comma"}
+    assert events == [
+        (("story_so_far",), 'It rained, "hard".'),
+        (("relevant_elements", 0), "Ada"),
+        (("relevant_elements", 1), "Storm"),
+        (("relevant_elements",), ["Ada", "Storm"]),
+        (("extra", "n"), 12),
+        (("extra",), {"n": 12}),
+    ]
+
+def test_fields_are_emitted_before_the_reply_ends():
+    parser = json_stream.Parser(depth=2)
+    emitted = {}
+    for i, char in enumerate(REPLY):
+        for path, _ in parser.feed(char):
+            emitted[path] = i
+    # A string is out once the next token shows its closing quote really closed it
+    # (not an unescaped quote inside), a number once the next character ends it
+    assert emitted[("story_so_far",)] == REPLY.index('"relevant_elements"')
+    assert emitted[("relevant_elements", 0)] == REPLY.index('"Storm"')
+    assert emitted[("relevant_elements",)] == REPLY.index("]")
+    assert emitted[("extra", "n")] == emitted[("extra",)] == REPLY.index("12}") + 2
+    assert max(emitted.values()) < len(REPLY) - 1
+
+def test_repairs_are_counted_per_endpoint():
+    spec = structured.Spec("json_stream_test", structured.object_schema({"a": {"type": "number"}}))
+    for text in ('{"a": 1,}', "{'a': 2,}", '{"a": 3}'):
+        asyncio.run(structured.settle(spec, parse(text), False, "http://unused", []))
+    counts = structured.snapshot()["endpoints"]["json_stream_test"]
+    assert counts["replies"] == 3 and counts["parse_repairs"] == 2
+    assert counts["parse_repair_kinds"] == {"trailing comma": 2, "single quotes": 1}
@@ -0,0 +1,60 @@
+import pytest
+from sqlalchemy import event
+
+import database
+import llm_cache
+
+# The disk tier of the response cache: entries read back from disk are kept
+# over ones nobody asked for again, and the table is only summed when a put
+# could take it over disk_bytes.
+
+VALUE = "x" * 1000
+
+@pytest.fixture
+def cache(setting):
+    # Memory holds a single entry, so earlier keys are read from disk
+    setting("llm_cache", {"memory_entries": 1, "disk_bytes": 3500})
+    cache = llm_cache.ResponseCache()
+    cache.clear()
+    yield cache
+    cache.clear()
+
+@pytest.fixture
+def sums():
+    sent = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if "sum(" in statement.lower():
+            sent.append(statement)
+
+    event.listen(database.engine, "before_cursor_execute", record)
+    yield sent
+    event.remove(database.engine, "before_cursor_execute", record)
+
+def test_disk_hits_are_kept_over_cold_entries(cache):
+    for key in ("a", "b", "c"):
+        cache.put(key, VALUE)
+    assert cache.get("a") == VALUE and cache.stats["disk_hits"] == 1
+
+    # Over the limit: b is the least recently used, though a expires first
+    cache.put("d", VALUE)
+    assert cache.stats["disk_evictions"] == 1
+    assert cache.get("b") is None
+    assert [cache.get(key) for key in ("a", "c", "d")] == [VALUE] * 3
+    assert cache.snapshot()["disk_bytes"] == 3000
+
+def test_size_is_only_summed_near_the_limit(cache, sums):
+    cache.put("a", VALUE)
+    cache.put("b", VALUE)
+    cache.put("b", VALUE)  # replacing an entry does not grow the tier
+    cache.put("c", VALUE)
+    assert sums == [] and cache.snapshot()["disk_bytes"] == 3000
+    cache.put("d", VALUE)
+    assert len(sums) == 1 and cache.stats["disk_evictions"] == 1
+    assert cache.snapshot()["disk_bytes"] == 3000
+
+def test_first_put_sums_what_other_processes_stored(cache, sums):
+    cache.put("a", VALUE)
+    restarted = llm_cache.ResponseCache()
+    restarted.put("b", VALUE)
+    assert len(sums) == 1 and restarted.snapshot()["disk_bytes"] == 2000
@@ -0,0 +1,97 @@
+import pytest
+from sqlalchemy import event
+from sqlmodel import SQLModel, create_engine
+
+import crud
+import database
+import migrations
+import models
+
+# Migrations on a fresh database, and EXPLAIN QUERY PLAN for the hot reads in
+# crud.py: each must be answered through one of the ix_* indexes, never by
+# scanning the table.
+
+@pytest.fixture
+def fresh(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'fresh.db'}")
+    SQLModel.metadata.create_all(engine)
+    migrations.run_migrations(engine)
+    yield engine
+    engine.dispose()
+
+def applied(engine):
+    with engine.connect() as conn:
+        return [row[0] for row in conn.exec_driver_sql("SELECT version FROM schema_migrations ORDER BY version")]
+
+def indexes(engine):
+    with engine.connect() as conn:
+        return {row[0] for row in conn.exec_driver_sql("SELECT name FROM sqlite_master WHERE type = 'index' AND name LIKE 'ix_%'")}
+
+def statements(fn, *args):
+    # The SQL a crud function sends, with its parameters
+    sent = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        sent.append((statement, parameters))
+
+    event.listen(database.engine, "before_cursor_execute", record)
+    try:
+        fn(*args)
+    finally:
+        event.remove(database.engine, "before_cursor_execute", record)
+    return sent
+
+def query_plan(engine, statement, parameters) -> str:
+    with engine.connect() as conn:
+        return " | ".join(row[-1] for row in conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters))
+
+def test_fresh_database_gets_every_migration(fresh):
+    assert applied(fresh) == sorted(version for version, _, _ in migrations.MIGRATIONS)
+    assert {
+        "ix_bibleelement_story_live_summary",
+        "ix_chapter_story_live_summary",
+        "ix_versionhistory_chapter_listing",
+        "ix_versionhistory_bible_element_listing",
+    } <= indexes(fresh)
+
+def test_migrations_are_idempotent(fresh):
+    before = indexes(fresh)
+    migrations.run_migrations(fresh)
+    assert applied(fresh) == sorted(version for version, _, _ in migrations.MIGRATIONS)
+
+    # A crash between running a step and recording it re-runs the step
+    with fresh.begin() as conn:
+        conn.exec_driver_sql("DELETE FROM schema_migrations")
+    migrations.run_migrations(fresh)
+    assert applied(fresh) == sorted(version for version, _, _ in migrations.MIGRATIONS)
+    assert indexes(fresh) == before
+
+@pytest.fixture(scope="module")
+def owners():
+    # Rows for the lookups to find
+    story = crud.create_story(models.Story(title="Indexed"))
+    chapter = crud.create_chapter(models.Chapter(story_id=story.id, title="One", content="Text", order=1))
+    return {"story": story.id, "chapter": chapter.id, "element": crud.get_bible_elements(story.id)[0].id}
+
+@pytest.mark.parametrize("fn, args, index", [
+    (crud.get_bible_elements, ("story",), "ix_bibleelement_story_live_summary"),
+    (crud.get_bible_summaries, ("story",), "ix_bibleelement_story_live_summary"),
+    (crud.get_bible_element_versions, ("story",), "ix_bibleelement_story_live_summary"),
+    (crud.get_chapters, ("story",), "ix_chapter_story_live_summary"),
+    (crud.get_chapter_summaries, ("story",), "ix_chapter_story_live_summary"),
+    (crud.get_chapter_version_map, ("story",), "ix_chapter_story_live_summary"),
+    (crud.get_chapter_history, ("chapter",), "ix_versionhistory_chapter_listing"),
+    (crud.get_chapter_versions, ("chapter",), "ix_versionhistory_chapter_listing"),
+    (crud.get_chapter_version, ("chapter", 1), "ix_versionhistory_chapter_listing"),
+    (crud.get_bible_history, ("element",), "ix_versionhistory_bible_element_listing"),
+    (crud.get_bible_versions, ("element",), "ix_versionhistory_bible_element_listing"),
+    (crud.get_bible_version, ("element", 1), "ix_versionhistory_bible_element_listing"),
+])
+def test_hot_queries_use_the_indexes(fresh, owners, fn, args, index):
+    sent = statements(fn, *(owners.get(arg, arg) for arg in args))
+    assert sent
+    for statement, parameters in sent:
+        plan = query_plan(fresh, statement, parameters)
+        # A SEARCH through the index, with ORDER BY served by it too (no temp b-tree)
+        assert plan.startswith("SEARCH") and f"INDEX {index} " in plan, f"{fn.__name__}: {plan}"
+        assert "TEMP B-TREE" not in plan, f"{fn.__name__}: {plan}"
@@ -0,0 +1,120 @@
+from types import SimpleNamespace
+
+import pytest
+
+import bible_context
+import retrieval
+
+# The BM25 index built from in-memory elements and chapters, without the
+# database: ranking, incremental sync after edits and deletes, and what the
+# lexical mode falls back to when nothing matches.
+
+STORY_ID = -1
+
+class Story:
+    def __init__(self):
+        self.revision = 1
+        self.elements = {}
+        self.chapters = {}
+        self.tokenized = []  # element ids re-tokenized, in order
+
+    def element(self, id, type, name, content, version=1):
+        self.elements[id] = SimpleNamespace(id=id, type=type, name=name, content=content, version=version)
+
+    def chapter(self, id, title, content, version=1):
+        self.chapters[id] = SimpleNamespace(id=id, title=title, content=content, version=version)
+        self.revision += 1
+
+    def context(self, story_id):
+        elements = {el.id: bible_context.compile_element(el) for el in self.elements.values()}
+        return bible_context.StoryContext(story_id, self.revision, elements)
+
+@pytest.fixture
+def story(monkeypatch):
+    story = Story()
+    element_tokens = retrieval.element_tokens
+
+    def counted(el):
+        story.tokenized.append(el.id)
+        return element_tokens(el)
+
+    monkeypatch.setattr(retrieval.bible_context, "get_story_context", story.context)
+    monkeypatch.setattr(retrieval.crud, "get_chapter_version_map", lambda story_id: {c.id: c.version for c in story.chapters.values()})
+    monkeypatch.setattr(retrieval.crud, "get_chapters_by_id", lambda ids: [story.chapters[i] for i in ids])
+    monkeypatch.setattr(retrieval, "element_tokens", counted)
+    story.element(1, "story_settings", "Settings", '{"genre": "harbour noir"}')
+    story.element(2, "character", "Ada", '{"description": "An engineer who maps the tides"}')
+    story.element(3, "location", "Harbour", '{"description": "Foggy docks full of fishing boats"}')
+    story.element(4, "event", "Storm", '{"description": "A storm floods the harbour and the harbour wall breaks"}')
+    yield story
+    retrieval.story_deleted(STORY_ID)
+
+def names(query, limit=None):
+    return [el.name for el, _ in retrieval.rank_elements(STORY_ID, query, limit)]
+
+def test_bm25_ranks_by_matched_terms(story):
+    # Both terms beat one; story settings never rank on their own
+    assert names("storm in the harbour") == ["Storm", "Harbour"]
+    # A name outranks the same word in someone else's description
+    assert names("harbour") == ["Harbour", "Storm"]
+    assert names("ada tides", limit=1) == ["Ada"]
+
+def test_rarer_and_denser_terms_score_higher():
+    index = retrieval.BM25Index()
+    index.add("common", ["ship", "ship", "sea"])
+    index.add("rare", ["ship", "lantern"])
+    index.add("long", ["ship", "sea"] + ["filler"] * 20)
+    ranked = [doc for doc, _ in index.search(["lantern", "sea"])]
+    assert ranked == ["rare", "common", "long"]
+    index.remove("rare")
+    assert [doc for doc, _ in index.search(["lantern"])] == []
+    assert len(index) == 2 and index.total_length == 25
+
+def test_sync_only_retokenizes_what_changed(story):
+    names("harbour")
+    assert sorted(story.tokenized) == [1, 2, 3, 4]
+
+    # An unchanged story is not re-tokenized
+    story.tokenized.clear()
+    names("harbour")
+    assert story.tokenized == []
+
+    # An edit re-indexes that element alone, and its old words stop matching
+    story.element(2, "character", "Ada", '{"description": "A lighthouse keeper"}', version=2)
+    assert names("lighthouse") == ["Ada"]
+    assert names("tides") == []
+    assert story.tokenized == [2]
+
+    # A delete drops it from the index
+    del story.elements[3]
+    assert names("harbour") == ["Storm"]
+    assert STORY_ID in retrieval.indexes and len(retrieval.indexes[STORY_ID].elements) == 3
+
+def test_chapters_follow_edits_and_deletes(story):
+    story.chapter(10, "The Flood", "<p>Water rose over the quay.</p>")
+    story.chapter(11, "Morning", "<p>Bread and coffee.</p>")
+    assert [c["id"] for c in retrieval.search(STORY_ID, "water quay")["chapters"]] == [10]
+
+    story.chapter(11, "Morning", "<p>The quay was gone.</p>", version=2)
+    assert [c["id"] for c in retrieval.search(STORY_ID, "quay")["chapters"]] == [11, 10]
+    del story.chapters[10]
+    story.revision += 1
+    assert [c["title"] for c in retrieval.search(STORY_ID, "quay")["chapters"]] == ["Morning"]
+
+def test_chapter_markup_is_not_indexed(story):
+    story.chapter(10, "Night", '<p class="intro">The keeper&apos;s lamp</p><p>Salt&nbsp;&amp;&nbsp;rope<br/>strong tide</p>')
+
+    def search(query):
+        return [c["id"] for c in retrieval.search(STORY_ID, query)["chapters"]]
+
+    assert search("class intro br nbsp amp") == []
+    assert search("keeper's") == [10]
+    assert search("salt rope") == [10]
+
+def test_nothing_matching_falls_back_to_the_catalog(story):
+    assert names("zeppelin") == []
+    assert retrieval.search(STORY_ID, "zeppelin") == {"elements": [], "chapters": []}
+    # Candidates are topped up in catalog order instead
+    assert [el.name for el in retrieval.candidates(STORY_ID, "zeppelin", 2)] == ["Settings", "Ada"]
+    assert [el.name for el in retrieval.candidates(STORY_ID, "storm", 2)] == ["Settings", "Storm"]
+    assert [el.name for el in retrieval.candidates(STORY_ID, "", 10)] == ["Settings", "Ada", "Harbour", "Storm"]
@@ -0,0 +1,73 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import pytest
+
+import crud
+import models
+import router
+from conftest import wait_for
+
+# The llm_backends pool against several fake model servers: load is spread
+# by outstanding requests, a dead backend is failed over and taken out of
+# rotation, and a health probe brings it back once it answers again.
+
+CALLS = 8
+REPLY_DELAY = 0.3  # seconds per call; each backend takes max_concurrency (2) at once
+
+@pytest.fixture
+def story(app_server):
+    return crud.create_story(models.Story(title="Routed"))
+
+@pytest.fixture
+def pool(fake_llm, setting):
+    def configure(count: int, health_interval: float = 0.2):
+        fakes = [fake_llm(reply="An outline", reply_delay=REPLY_DELAY) for _ in range(count)]
+        setting("llm_backends", {"backends": [{"url": fake.url} for fake in fakes], "health_interval": health_interval, "failure_threshold": 2})
+        return fakes
+    return configure
+
+def outlines(app_server, story, count: int = CALLS):
+    # Concurrent non-streaming calls, each with its own brief so none is cached or coalesced
+    def call(i):
+        return httpx.post(f"{app_server.url}/ai/generate-outline", timeout=30, json={
+            "story_id": story.id, "smart_context": {}, "chapter_brief": f"Chapter brief {i} {time.monotonic()}", "no_cache": True,
+        })
+    start = time.monotonic()
+    with ThreadPoolExecutor(count) as executor:
+        responses = list(executor.map(call, range(count)))
+    assert [r.status_code for r in responses] == [200] * count, [r.text for r in responses]
+    return time.monotonic() - start
+
+def test_load_is_spread_over_the_pool(app_server, story, pool):
+    fakes = pool(2)
+    outlines(app_server, story)
+    assert [fake.requests for fake in fakes] == [CALLS // 2, CALLS // 2]
+    assert all(fake.max_active == 2 for fake in fakes)
+
+def test_throughput_scales_with_backends(app_server, story, pool):
+    pool(1)
+    single = outlines(app_server, story)
+    pool(2)
+    double = outlines(app_server, story)
+    assert double < single * 0.75, f"1 backend {single:.2f}s, 2 backends {double:.2f}s"
+
+def test_dead_backend_is_failed_over_then_probed_back(app_server, story, pool):
+    # Probes spaced out so the calls, not the probes, find the dead backend first
+    alive, dead = pool(2, health_interval=1.0)
+    dead.status = 503
+
+    # Every call still succeeds; the dead backend leaves rotation after failure_threshold errors
+    outlines(app_server, story)
+    assert alive.requests == CALLS and dead.requests == 0
+    target = router.targets[dead.url]
+    assert not target.healthy and target.stats["failovers"] >= 1
+
+    # Once it answers again a probe puts it back, and it takes calls
+    dead.status = 200
+    probes = dead.probes
+    assert wait_for(lambda: router.targets[dead.url].healthy, 5)
+    assert dead.probes > probes
+    outlines(app_server, story)
+    assert dead.requests > 0
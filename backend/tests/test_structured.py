@@ -0,0 +1,106 @@
+import uuid
+
+import httpx
+import pytest
+
+import crud
+import json_stream
+import models
+import structured
+
+# Checking replies against their schema: local coercion first, then at most
+# repair_calls calls to the model for what is still missing, and a fallback
+# counted in /ai/stats when even that fails.
+
+SCHEMA = structured.object_schema({
+    "name": {"type": "string"},
+    "age": {"type": "number"},
+    "tags": {"type": "array", "items": {"type": "string", "enum": ["hero", "villain"]}},
+    "description": {"type": "string"},
+})
+
+def test_conform_drops_disallowed_keys_and_fixes_types():
+    reply = {"name": 12, "age": "1,200", "tags": "Hero, sidekick", "description": {"looks": "tall"}, "secret": "x", "notes": []}
+    check = structured.Check()
+    value = check.conform(SCHEMA, reply)
+    assert value == {"name": "12", "age": 1200.0, "tags": ["hero"], "description": structured.flatten_to_markdown({"looks": "tall"})}
+    assert check.problems == []
+    assert set(check.fixes) == {("secret",), ("notes",), ("name",), ("age",), ("tags",), ("tags", 0), ("tags", 1), ("description",)}
+    assert "secret" in reply and reply["name"] == 12  # the input is left alone
+
+def test_conform_reports_what_it_cannot_fix():
+    check = structured.Check()
+    check.conform(SCHEMA, {"name": None, "age": "many", "tags": []})
+    assert sorted(check.problems) == [("age",), ("description",), ("name",)]
+    check = structured.Check()
+    check.conform(SCHEMA, ["not", "an", "object"])
+    assert check.problems == [()]
+
+def parsed(text: str) -> json_stream.Parser:
+    parser = json_stream.Parser()
+    parser.feed(text)
+    parser.close()
+    return parser
+
+def settle(app_server, fake, endpoint: str, reply: str):
+    # As an endpoint would once its stream ends, on the app's loop and client
+    spec = structured.Spec(endpoint, SCHEMA)
+    messages = [{"role": "user", "content": f"Describe someone ({uuid.uuid4().hex})"}]
+    return app_server.run(structured.settle(spec, parsed(reply), True, fake.url, messages))
+
+@pytest.fixture
+def endpoint():
+    name = f"structured_test_{uuid.uuid4().hex[:8]}"
+    yield name
+    structured.stats.pop(name, None)
+
+def test_only_the_fields_at_fault_are_asked_for(app_server, fake_llm, endpoint):
+    fake = fake_llm(replies=['{"age": 36}'])
+    value = settle(app_server, fake, endpoint, '{"name": "Ada", "age": "old", "tags": ["hero"], "description": "Engineer"}')
+    assert value == {"name": "Ada", "age": 36, "tags": ["hero"], "description": "Engineer"}
+    assert fake.requests == 1
+    asked = fake.bodies[0]["response_format"]["json_schema"]["schema"]
+    assert list(asked["properties"]) == ["age"]
+    counts = structured.stats[endpoint]
+    assert (counts["needed_repair"], counts["repair_calls"], counts["repaired"], counts["still_invalid"]) == (1, 1, 1, 0)
+
+@pytest.mark.parametrize("repair_calls", [0, 1, 3])
+def test_repair_calls_are_capped(app_server, fake_llm, setting, endpoint, repair_calls):
+    setting("structured_output", {"repair_calls": repair_calls})
+    fake = fake_llm(reply="Sorry, I can't do JSON.")
+    settle(app_server, fake, endpoint, "Here is a person: Ada, an engineer.")
+    assert fake.requests == repair_calls
+    counts = structured.stats[endpoint]
+    assert (counts["repair_calls"], counts["repaired"], counts["still_invalid"]) == (repair_calls, 0, 1)
+
+def test_locally_fixed_replies_cost_no_calls(app_server, fake_llm, endpoint):
+    fake = fake_llm()
+    value = settle(app_server, fake, endpoint, '{"name": "Ada", "age": "36", "tags": "hero", "description": "Engineer", "mood": "calm"}')
+    assert value == {"name": "Ada", "age": 36.0, "tags": ["hero"], "description": "Engineer"}
+    assert fake.requests == 0
+    assert structured.stats[endpoint]["fixed_locally"] == 1
+
+def test_endpoint_fallbacks_are_counted(app_server, fake_llm, setting):
+    # The streamed reply is prose, and so is every repair: the endpoint falls back
+    fake = fake_llm(tokens=5, reply="Still no JSON, sorry.")
+    setting("llm_url", fake.url)
+    setting("structured_output", {"repair_calls": 2})
+    story = crud.create_story(models.Story(title="Fallback"))
+
+    def stats():
+        endpoints = httpx.get(f"{app_server.url}/ai/stats").json()["structured_output"]["endpoints"]
+        return endpoints.get("analyze_bible_brief", dict.fromkeys(structured.COUNTERS, 0))
+
+    before = stats()
+    response = httpx.post(f"{app_server.url}/ai/analyze-bible-brief", timeout=30, json={
+        "story_id": story.id, "user_brief": "A lighthouse keeper", "element_type": "character",
+        "retrieval_mode": "llm", "no_cache": True, "structured": True,
+    })
+    assert response.status_code == 200
+    assert response.json()["relevant_elements"] == []
+    after = stats()
+    assert fake.requests == 1 + 2
+    assert {key: after[key] - before[key] for key in ("replies", "repair_calls", "still_invalid", "fallbacks")} == {
+        "replies": 1, "repair_calls": 2, "still_invalid": 1, "fallbacks": 1,
+    }
+    assert after["fallback_rate"] is not None
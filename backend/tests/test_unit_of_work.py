@@ -0,0 +1,56 @@
+import json
+
+import pytest
+from sqlalchemy import event
+
+import crud
+import database
+import models
+
+# Each write operation is one unit of work: exactly one commit (one fsync)
+# however many rows it touches.
+
+class Counter:
+    def __init__(self):
+        self.commits = 0
+        self.statements = []
+
+    def executed(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+    def committed(self, conn):
+        self.commits += 1
+
+@pytest.fixture
+def counter():
+    counter = Counter()
+    event.listen(database.engine, "after_cursor_execute", counter.executed)
+    event.listen(database.engine, "commit", counter.committed)
+    yield counter
+    event.remove(database.engine, "after_cursor_execute", counter.executed)
+    event.remove(database.engine, "commit", counter.committed)
+
+@pytest.fixture
+def story():
+    return crud.create_story(models.Story(title="Counted"))
+
+def test_create_story_commits_once(counter):
+    story = crud.create_story(models.Story(title="One commit"))
+    assert counter.commits == 1, counter.statements
+    # Story, its settings element and that element's first version all landed
+    assert [el.type for el in crud.get_bible_elements(story.id)] == ["story_settings"]
+    assert len(crud.get_bible_history(crud.get_bible_elements(story.id)[0].id)) == 1
+
+def test_create_bible_element_commits_once(story, counter):
+    crud.create_bible_element(models.BibleElement(story_id=story.id, type="character", name="Ada", content="Engineer"))
+    assert counter.commits == 1, counter.statements
+
+def test_create_chapter_commits_once(story, counter):
+    crud.create_chapter(models.Chapter(story_id=story.id, title="Opening", content="It was dark.", order=1))
+    assert counter.commits == 1, counter.statements
+
+@pytest.mark.parametrize("value", [{"value": 1}, {"value": 2}])  # insert, then update
+def test_set_global_setting_commits_once(counter, value):
+    crud.set_global_setting("unit_of_work_test", value)
+    assert counter.commits == 1, counter.statements
+    assert json.loads(crud.get_global_setting("unit_of_work_test").value) == value
@@ -0,0 +1,91 @@
+from concurrent.futures import Future
+from sqlmodel import Session
+import os
+import queue
+import threading
+
+from database import engine
+
+# Single-writer commit queue. Concurrent saves (autosaves from several tabs,
+# bible edits) are handed to one writer thread which applies everything that
+# is pending in a single transaction, so N saves cost one fsync instead of N
+# and never fight over SQLite's write lock.
+MAX_BATCH = int(os.environ.get("STORY_AGENT_WRITE_BATCH", "64"))
+# Optional linger to widen batches; by default only already-queued saves are
+# grouped, so a lone save never waits on the queue.
+MAX_WAIT = float(os.environ.get("STORY_AGENT_WRITE_WAIT_MS", "0")) / 1000
+
+class WriteQueue:
+    def __init__(self, engine, max_batch: int = MAX_BATCH, max_wait: float = MAX_WAIT):
+        self.engine = engine
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.jobs = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.stats = {"jobs": 0, "batches": 0, "fallbacks": 0}
+
+    def submit(self, fn, *args):
+        # fn(session, *args) stages its changes without committing
+        self._ensure_started()
+        future = Future()
+        self.jobs.put((fn, args, future))
+        return future.result()
+
+    def _ensure_started(self):
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+                    self.thread.start()
+
+    def _collect(self):
+        batch = [self.jobs.get()]
+        while len(batch) < self.max_batch:
+            try:
+                if self.max_wait > 0:
+                    batch.append(self.jobs.get(timeout=self.max_wait))
+                else:
+                    batch.append(self.jobs.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            try:
+                self._apply(batch)
+            except Exception as e:
+                print(f"ERROR in db writer: {e}")
+
+    def _apply(self, batch):
+        self.stats["jobs"] += len(batch)
+        self.stats["batches"] += 1
+        try:
+            with Session(self.engine, expire_on_commit=False) as session:
+                results = [fn(session, *args) for fn, args, _ in batch]
+                session.commit()
+        except Exception:
+            # One bad job must not fail its neighbours: replay them one per transaction
+            self.stats["fallbacks"] += 1
+            for job in batch:
+                self._apply_one(job)
+            return
+        for (_, _, future), result in zip(batch, results):
+            future.set_result(result)
+
+    def _apply_one(self, job):
+        fn, args, future = job
+        try:
+            with Session(self.engine, expire_on_commit=False) as session:
+                result = fn(session, *args)
+                session.commit()
+            future.set_result(result)
+        except Exception as e:
+            future.set_exception(e)
+
+write_queue = WriteQueue(engine)
+
+def submit(fn, *args):
+    return write_queue.submit(fn, *args)